@@ -3,8 +3,9 @@
 import os
 import os.path
 import io
-import sys
+import argparse
 import safetensors_hack
+import hash_cache
 import glob
 import tqdm
 from PIL import Image
@@ -15,6 +16,14 @@ from sqlalchemy.orm import relationship, sessionmaker, declarative_base
 from db_models import Base, LoRAModel
 
 
+parser = argparse.ArgumentParser()
+parser.add_argument("paths", nargs="+")
+parser.add_argument("--hash-cache", default=hash_cache.DEFAULT_PATH, help="SQLite file to keep computed hashes in")
+parser.add_argument("--hash-missing", action="store_true", help="Hash models without embedded hashes instead of leaving their hashes empty")
+parser.add_argument("--verify", action="store_true", help="Hash every model again, report where the embedded hashes are wrong and use the computed ones")
+args = parser.parse_args()
+
+
 DATABASE_NAME = os.getenv("DATABASE_NAME", "lora_db")
 if os.path.exists(DATABASE_NAME + ".db"):
     os.remove(DATABASE_NAME + ".db")
@@ -23,7 +32,7 @@ Base.metadata.create_all(engine)
 Session = sessionmaker(bind=engine)
 
 
-paths = sys.argv[1:]
+paths = args.paths
 for p in paths:
     if not os.path.isdir(p):
         print(f"Invalid path: {p}")
@@ -73,6 +82,7 @@ def get_preview_image(path):
 
 
 print("Building model database...")
+cache = hash_cache.HashCache(args.hash_cache)
 
 with Session() as session:
     all_files = []
@@ -88,6 +98,20 @@ with Session() as session:
             continue
         if "ss_lr_scheduler" not in metadata:
             continue
+        model_hash = metadata.get("sshs_model_hash", None)
+        legacy_hash = metadata.get("sshs_legacy_hash", None)
+        if args.verify:
+            hashes, _ = safetensors_hack.get_hashes(f, cache, True)
+            if model_hash is not None and model_hash != hashes["model_hash"]:
+                print(f"HASH MISMATCH - {f} ({model_hash} != {hashes['model_hash']})")
+            if legacy_hash is not None and legacy_hash != hashes["legacy_hash"]:
+                print(f"LEGACY HASH MISMATCH - {f} ({legacy_hash} != {hashes['legacy_hash']})")
+            model_hash = hashes["model_hash"]
+            legacy_hash = hashes["legacy_hash"]
+        elif args.hash_missing and (model_hash is None or legacy_hash is None):
+            hashes, _ = safetensors_hack.get_hashes(f, cache)
+            model_hash = model_hash or hashes["model_hash"]
+            legacy_hash = legacy_hash or hashes["legacy_hash"]
         lora_model = LoRAModel(
             filepath=f,
             filename=os.path.basename(f),
@@ -99,8 +123,8 @@ with Session() as session:
             description=metadata.get("ssmd_description", None),
             rating=to_int(metadata.get("ssmd_rating", None)),
             tags=metadata.get("ssmd_tags", None),
-            model_hash=metadata.get("sshs_model_hash", None),
-            legacy_hash=metadata.get("sshs_legacy_hash", None),
+            model_hash=model_hash,
+            legacy_hash=legacy_hash,
             session_id=to_int(metadata.get("ss_session_id", None)),
             training_started_at=to_datetime(metadata.get("ss_training_started_at", None)),
             output_name=metadata.get("ss_output_name", None),
@@ -156,4 +180,5 @@ with Session() as session:
 
     session.commit()
 
+cache.close()
 print("Finished!")
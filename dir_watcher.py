@@ -0,0 +1,183 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+RACY_NS = 1_000_000_000
+
+
+class PollingWatcher:
+    """Finds new files under a set of directories by polling. Each poll only
+    stats the directories it knows about, and lists the ones whose mtime
+    changed since the last poll. A file counts as new when its name or inode
+    wasn't in its directory the last time it was listed, so files replaced by
+    a rename are found too."""
+
+    def __init__(self, roots, recursive=True):
+        self.recursive = recursive
+        self.directories = {}  # path -> (mtime_ns, {name: inode})
+        for root in roots:
+            self._list(root, report=False)
+
+    def _list(self, path, report=True):
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            self.directories.pop(path, None)
+            return []
+
+        _, old_files = self.directories.get(path, (None, {}))
+        files = {}
+        new_files = []
+        subdirectories = []
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if self.recursive and entry.path not in self.directories:
+                        subdirectories.append(entry.path)
+                elif entry.is_file():
+                    files[entry.name] = entry.inode()
+                    if report and old_files.get(entry.name) != files[entry.name]:
+                        new_files.append(entry.path)
+            except OSError:
+                continue
+        # Directory mtimes come from a coarse clock, so a file added right
+        # after listing could leave it unchanged. Those get listed again.
+        if time.time_ns() - mtime_ns < RACY_NS:
+            mtime_ns = None
+        self.directories[path] = (mtime_ns, files)
+
+        for subdirectory in subdirectories:
+            new_files.extend(self._list(subdirectory, report))
+        return new_files
+
+    def scan(self):
+        new_files = []
+        for path, (mtime_ns, _) in list(self.directories.items()):
+            try:
+                changed = os.stat(path).st_mtime_ns != mtime_ns
+            except OSError:
+                del self.directories[path]
+                continue
+            if changed:
+                new_files.extend(self._list(path))
+        return new_files
+
+    def changes(self, timeout):
+        """Waits for `timeout` seconds and returns the paths of new files"""
+        time.sleep(timeout)
+        return self.scan()
+
+    def close(self):
+        pass
+
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """Same as PollingWatcher, but woken up by inotify on Linux. Files are
+    reported once they are closed after writing or moved into place. If the
+    kernel's event queue overflows, every directory is polled once instead."""
+
+    def __init__(self, roots, recursive=True):
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.recursive = recursive
+        self.watches = {}  # watch descriptor -> directory path
+        # Directories are listed after their watch is added, so files created
+        # in between aren't missed. The poller is also the overflow fallback.
+        self.poller = PollingWatcher([], recursive)
+        for root in roots:
+            self._watch_tree(root)
+            self.poller._list(root, report=False)
+
+    def _watch(self, path):
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd >= 0:
+            self.watches[wd] = path
+
+    def _watch_tree(self, path):
+        self._watch(path)
+        if not self.recursive:
+            return
+        for directory, subdirectories, _ in os.walk(path, followlinks=True):
+            for subdirectory in subdirectories:
+                self._watch(os.path.join(directory, subdirectory))
+
+    def changes(self, timeout):
+        """Waits up to `timeout` seconds for files to be written and returns
+        their paths"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        new_files = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                new_files.extend(self.poller.scan())
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+                    new_files.extend(self.poller._list(path))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                new_files.append(path)
+
+        return new_files
+
+    def close(self):
+        os.close(self.fd)
+
+
+def open_watcher(roots, recursive=True, inotify=False):
+    """Returns an InotifyWatcher if asked for and available, otherwise a
+    PollingWatcher"""
+    if inotify:
+        if sys.platform.startswith("linux"):
+            try:
+                return InotifyWatcher(roots, recursive)
+            except (OSError, AttributeError) as ex:
+                print(f"!!! inotify is unavailable ({ex}), polling instead")
+        else:
+            print("!!! inotify is only available on Linux, polling instead")
+    return PollingWatcher(roots, recursive)
@@ -3,9 +3,8 @@
 import sys
 import os
 import os.path
-import shutil
+import json
 import safetensors_hack
-from safetensors.torch import save_file
 
 
 file = sys.argv[1]
@@ -25,17 +24,16 @@ def write_model_metadata(model_path, updates):
   if not os.path.exists(model_path):
     return None
 
-  back_up = True
-  if back_up:
-    backup_path = model_path + ".backup"
+  if os.path.splitext(model_path)[1] == '.safetensors':
+    # Only the header is rewritten, so keep the old metadata instead of a copy of the whole model.
+    # safetensors_hack.restore_metadata puts it back however the tensors have moved since.
+    backup_path = model_path + ".metadata.backup.json"
     if not os.path.exists(backup_path):
-      print(f"Backing up current model to {backup_path}")
-      shutil.copyfile(model_path, backup_path)
+      print(f"Backing up current metadata to {backup_path}")
+      with open(backup_path, "w", encoding="utf-8") as f:
+        json.dump(safetensors_hack.read_metadata(model_path), f, indent=2, ensure_ascii=False)
 
-  metadata = None
-  tensors = {}
-  if os.path.splitext(model_path)[1] == '.safetensors':
-    tensors, metadata = safetensors_hack.load_file(model_path, "cpu")
+    metadata = safetensors_hack.read_metadata(model_path)
 
     for k, v in updates.items():
       if v is None and k in metadata:
@@ -43,7 +41,8 @@ def write_model_metadata(model_path, updates):
       else:
           metadata[k] = str(v)
 
-    save_file(tensors, model_path, metadata)
+    if safetensors_hack.write_metadata(model_path, metadata):
+      print("Header rewritten in place")
     print(f"Model saved: {model_path}")
 
 key = sys.argv[2].strip()
@@ -0,0 +1,71 @@
+import os
+import sqlite3
+import threading
+
+DEFAULT_PATH = "model_hash_cache.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    model_hash TEXT NOT NULL,
+    legacy_hash TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    crc32 TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+FIELDS = ("model_hash", "legacy_hash", "sha256", "crc32")
+
+
+def file_key(filename):
+    """(path, size, mtime_ns, inode) of a file. The hashes stored for a path
+    are only used while the rest of its key is the same, so files that are
+    rewritten or replaced get hashed again."""
+    path = os.path.realpath(filename)
+    st = os.stat(path)
+    return path, st.st_size, st.st_mtime_ns, st.st_ino
+
+
+class HashCache:
+    """Hashes of model files, stored in SQLite so that hashing multi-gigabyte
+    models only happens once per change. Entries are dicts with the new
+    model hash (weights only), the legacy hash, and the SHA-256 and CRC32 of
+    the whole file."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def get(self, key):
+        """Returns the hashes stored for a file_key, or None if the file
+        changed since or was never hashed"""
+        path, size, mtime_ns, inode = key
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, inode, model_hash, legacy_hash, sha256, crc32 FROM hashes WHERE path = ?", (path,)
+            ).fetchone()
+            if row is None or tuple(row[:3]) != (size, mtime_ns, inode):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return dict(zip(FIELDS, row[3:]))
+
+    def put(self, key, hashes):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, *(hashes[field] for field in FIELDS)),
+            )
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
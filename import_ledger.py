@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import threading
+import time
+
+TEXT_CACHE_PATH = "hydrus_import_cache.txt"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    realpath TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    hash TEXT,
+    imported_at REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+CREATE TABLE IF NOT EXISTS black_checks (
+    realpath TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    is_black INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS directories (
+    realpath TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    entry_count INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+"""
+
+
+class BlackChecks:
+    """Dict-like view of the all-black verdicts, realpath -> (size, mtime_ns, is_black)"""
+
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+
+    def get(self, realpath, default=None):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, is_black FROM black_checks WHERE realpath = ?", (realpath,)
+            ).fetchone()
+        if row is None:
+            return default
+        return row[0], row[1], bool(row[2])
+
+    def __setitem__(self, realpath, value):
+        size, mtime_ns, is_black = value
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO black_checks VALUES (?, ?, ?, ?)",
+                (realpath, size, mtime_ns, int(is_black)),
+            )
+
+
+class ImportLedger:
+    """Record of every file that import_to_hydrus is done with, keyed by realpath.
+
+    Lookups go through the primary key index, so nothing is loaded into memory
+    up front. Writes are buffered in a transaction until commit(), which is
+    called once per imported batch. Safe to share between threads."""
+
+    def __init__(self, path="hydrus_import_cache.db"):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.black_checks = BlackChecks(self.conn, self.lock)
+        self.migrate_text_cache()
+
+    def __contains__(self, realpath):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM files WHERE realpath = ?", (realpath,)).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def add(self, realpath, hash_=None):
+        try:
+            st = os.stat(realpath)
+            size, mtime_ns, inode = st.st_size, st.st_mtime_ns, st.st_ino
+        except OSError:
+            size, mtime_ns, inode = None, None, None
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (realpath, size, mtime_ns, inode, hash_, time.time()),
+            )
+
+    def get_hash(self, realpath):
+        with self.lock:
+            row = self.conn.execute("SELECT hash FROM files WHERE realpath = ?", (realpath,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_directory(self, realpath):
+        """(mtime_ns, entry_count) of the directory when all of its files were
+        last found to be imported, or None"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT mtime_ns, entry_count FROM directories WHERE realpath = ?", (realpath,)
+            ).fetchone()
+
+    def set_directory(self, realpath, mtime_ns, entry_count):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (realpath, mtime_ns, entry_count)
+            )
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def migrate_text_cache(self):
+        """One-time import of the old plain text cache. It only stored the
+        realpath, so the stat fields of migrated entries are left empty."""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'migrated_text_cache'").fetchone():
+            return
+
+        if os.path.isfile(TEXT_CACHE_PATH):
+            print(f"Migrating {TEXT_CACHE_PATH} to the import ledger...")
+            with open(TEXT_CACHE_PATH, "r", encoding="utf-8") as f:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO files (realpath) VALUES (?)",
+                    ((line.strip(),) for line in f if line.strip()),
+                )
+
+        self.conn.execute("INSERT INTO meta VALUES ('migrated_text_cache', '1')")
+        self.conn.commit()
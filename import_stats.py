@@ -0,0 +1,157 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+
+# Counters the periodic snapshots report rates for
+RATE_COUNTERS = ("files_seen", "files_parsed", "files_uploaded", "bytes_uploaded")
+
+
+class ImportStats:
+    """Time spent in each stage of an import and counts of what happened.
+
+    Stage times are only measured when `enabled`, counters are always kept.
+    Stages are timed on whichever thread runs them, so with upload workers
+    or parse jobs the stage totals can add up to more than the elapsed
+    time."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.seconds = collections.defaultdict(float)  # stage -> seconds
+        self.calls = collections.Counter()  # stage -> times it ran
+        self.counters = collections.Counter()
+        self.snapshots = []
+        self._snapshot_thread = None
+        self._stop_snapshots = threading.Event()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed_iter(self, stage, iterable):
+        """Yields from `iterable`, timing how long each item took to produce"""
+        if not self.enabled:
+            yield from iterable
+            return
+        it = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start, 0)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def add_time(self, stage, seconds, calls=1):
+        with self.lock:
+            self.seconds[stage] += seconds
+            self.calls[stage] += calls
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def take(self):
+        """Returns everything recorded so far and starts over, for sending
+        the stats of a worker process back to the main one"""
+        with self.lock:
+            taken = (dict(self.seconds), dict(self.calls), dict(self.counters))
+            self.seconds.clear()
+            self.calls.clear()
+            self.counters.clear()
+        return taken
+
+    def merge(self, taken):
+        seconds, calls, counters = taken
+        with self.lock:
+            for stage, s in seconds.items():
+                self.seconds[stage] += s
+            self.calls.update(calls)
+            self.counters.update(counters)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            return {
+                "elapsed_seconds": elapsed,
+                "stages": {
+                    stage: {
+                        "seconds": self.seconds[stage],
+                        "calls": self.calls[stage],
+                        "mean_ms": self.seconds[stage] / self.calls[stage] * 1000 if self.calls[stage] else 0.0,
+                    }
+                    for stage in sorted(self.seconds, key=self.seconds.get, reverse=True)
+                },
+                "counters": dict(sorted(self.counters.items())),
+                "rates": {
+                    f"{counter}_per_second": self.counters[counter] / elapsed if elapsed else 0.0
+                    for counter in RATE_COUNTERS
+                },
+                "snapshots": list(self.snapshots),
+            }
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"Profile ({summary['elapsed_seconds']:.1f} s):")
+        for stage, timing in summary["stages"].items():
+            print(f"  {stage:<12} {timing['seconds']:>10.2f} s {timing['calls']:>8} calls {timing['mean_ms']:>10.2f} ms/call")
+        for counter, value in summary["counters"].items():
+            print(f"  {counter:<24} {value}")
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def snapshot(self, last=None):
+        """Records the rates since `last`, another snapshot, or since the
+        start and returns it"""
+        now = time.monotonic()
+        with self.lock:
+            counters = {counter: self.counters[counter] for counter in RATE_COUNTERS}
+        since = last["elapsed_seconds"] if last else 0.0
+        elapsed = now - self.started
+        interval = elapsed - since
+        snapshot = {"elapsed_seconds": elapsed, "counters": counters}
+        for counter in RATE_COUNTERS:
+            previous = last["counters"][counter] if last else 0
+            snapshot[f"{counter}_per_second"] = (counters[counter] - previous) / interval if interval else 0.0
+        with self.lock:
+            self.snapshots.append(snapshot)
+        return snapshot
+
+    def start_snapshots(self, interval):
+        """Prints the current rates every `interval` seconds from a
+        background thread until stop_snapshots is called"""
+        def run():
+            last = None
+            while not self._stop_snapshots.wait(interval):
+                last = self.snapshot(last)
+                print(
+                    f"[{last['elapsed_seconds']:.0f} s] "
+                    f"{last['files_seen_per_second']:.1f} files/s seen, "
+                    f"{last['files_parsed_per_second']:.1f} files/s parsed, "
+                    f"{last['files_uploaded_per_second']:.1f} files/s uploaded "
+                    f"({last['bytes_uploaded_per_second'] / (1024 * 1024):.1f} MB/s)"
+                )
+
+        self._stop_snapshots.clear()
+        self._snapshot_thread = threading.Thread(target=run, daemon=True)
+        self._snapshot_thread.start()
+
+    def stop_snapshots(self):
+        if self._snapshot_thread is not None:
+            self._stop_snapshots.set()
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
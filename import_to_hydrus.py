@@ -17,7 +17,10 @@
 
 
 import argparse
-import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
 from collections import defaultdict
 from dataclasses import dataclass
 from io import BytesIO
@@ -26,22 +29,34 @@ import re
 import dotenv
 import tqdm
 import signal
+import time
 import json
 from PIL import Image
 from pprint import pp
 import prompt_parser
+import png_chunks
+import import_ledger
+import import_stats
+import dir_watcher
+import tag_cache
+from stealth_pnginfo import read_info_from_image_stealth
 from typing import Tuple, Any
 from pprint import pp
-import gzip
+import hashlib
 
 import hydrus_api
 import hydrus_api.utils
+import requests.adapters
 
 
 def null_handler(signum, frame):
     pass
 
 MAX_IMPORT_SIZE = 100
+MAX_IMPORT_BYTES = 256 * 1024 * 1024
+NOTES_IN_FLIGHT = 8
+NOTES_RETRIES = 3
+TAG_CACHE_SIZE = 4096
 
 ERROR_EXIT_CODE = 1
 REQUIRED_PERMISSIONS = {
@@ -59,12 +74,27 @@ parser.add_argument("--service", "-s", default="stable-diffusion-webui")
 parser.add_argument("--personal-service", "-p", default="my tags")
 parser.add_argument("--api-url", "-a", default=hydrus_api.DEFAULT_API_URL)
 parser.add_argument("--api_key", "-k", default=None)
+parser.add_argument(
+    "--tags-cache", default=None, help="SQLite file to keep parsed tags in, shared between import and retag runs"
+)
 parser.add_argument(
     "--no-protect-decompression",
     "-d",
     action="store_false",
     dest="protect_decompression",
 )
+parser.add_argument(
+    "--quiet", "-q", action="store_true", help="Don't print every file as it's processed"
+)
+parser.add_argument(
+    "--profile", action="store_true", help="Time each stage of the import and print a summary at exit"
+)
+parser.add_argument(
+    "--profile-json", default=None, help="Also write the profile summary to this JSON file (implies --profile)"
+)
+parser.add_argument(
+    "--profile-interval", type=float, default=30.0, help="Seconds between the rates printed while profiling (0 to disable)"
+)
 subparsers = parser.add_subparsers(dest="command", help="sub-command help")
 
 parser_import = subparsers.add_parser("import", help="Import new files")
@@ -79,40 +109,185 @@ parser_import.add_argument(
     action="store_false",
     dest="protect_decompression",
 )
+parser_import.add_argument(
+    "--black-check",
+    choices=["strips", "full", "none"],
+    default="strips",
+    help="How to detect all-black images: decode and scan a strip at a time, convert the whole image at once, or don't check",
+)
+parser_import.add_argument(
+    "--no-check-hashes",
+    action="store_false",
+    dest="check_hashes",
+    help="Upload every file instead of skipping the upload for files Hydrus already has",
+)
+parser_import.add_argument(
+    "--jobs", "-j", type=int, default=1, help="Number of processes to parse images with (in watch mode, only for the first import)"
+)
+parser_import.add_argument(
+    "--upload-workers",
+    "-u",
+    type=int,
+    default=0,
+    help="Upload batches on this many background threads while parsing continues (0 to alternate parsing and uploading)",
+)
+parser_import.add_argument(
+    "--batch-size", type=int, default=MAX_IMPORT_SIZE, help="Maximum number of files per upload batch"
+)
+parser_import.add_argument(
+    "--notes-in-flight", type=int, default=NOTES_IN_FLIGHT, help="Maximum number of concurrent requests when writing notes"
+)
+parser_import.add_argument(
+    "--batch-mb", type=int, default=MAX_IMPORT_BYTES // (1024 * 1024), help="Maximum total size of an upload batch in MB"
+)
+parser_import.add_argument(
+    "--watch", "-w", action="store_true", help="Keep running after the import and import new files as they appear"
+)
+parser_import.add_argument(
+    "--watch-interval", type=float, default=5.0, help="Seconds between polls for new files in watch mode"
+)
+parser_import.add_argument(
+    "--debounce", type=float, default=3.0, help="Seconds a new file must stay unchanged before it's imported in watch mode"
+)
+parser_import.add_argument(
+    "--watch-latency", type=float, default=10.0, help="Maximum seconds a parsed file waits for its batch to fill up in watch mode"
+)
+parser_import.add_argument(
+    "--inotify", action="store_true", help="Use inotify instead of polling in watch mode (Linux only)"
+)
 # parser_import.add_argument("--no-read-metadata", "-m", action="store_false", dest="read_metadata")
 
 parser_retag = subparsers.add_parser("retag", help="Retag existing files")
 parser_retag.add_argument("query", nargs="+")
+parser_retag.add_argument(
+    "--jobs", "-j", type=int, default=8, help="Number of files to fetch from Hydrus at once"
+)
 # parser_import.add_argument("--no-read-metadata", "-m", action="store_false", dest="read_metadata")
 
 
+# Replaced with an import_ledger.ImportLedger and its black check table by cmd_import
 cache = set()
+# Replaced with one backed by --tags-cache in main and in each parse worker
+parsed_tags = tag_cache.TagCache(TAG_CACHE_SIZE)
+# Replaced with an enabled one by main and each parse worker with --profile
+stats = import_stats.ImportStats()
+# Set by --quiet
+quiet = False
+# realpath -> (size, mtime_ns, is_black)
+black_check_cache = {}
+# Paths parse_image couldn't open or parse, taken out again by whoever
+# handles its result
+failed_paths = set()
+
+
+# Files and directories changed more recently than this may still be being
+# written to, so their directory isn't marked as done yet
+SETTLE_NS = 60 * 1_000_000_000
+
+
+def scan_files(path, recursive=True, snapshots=None, on_listed=None):
+    """Yields (path, realpath, directory realpath, DirEntry) for every file
+    under path as each directory is listed. Symlinks are followed, but every
+    directory is only listed once.
+
+    With a snapshots ledger, the files of directories whose mtime and entry
+    count match their last snapshot aren't yielded at all. Every other
+    directory is passed to on_listed(realpath, (mtime_ns, entry_count)) once
+    all of its files have been yielded, with None instead of the snapshot if
+    it changed too recently."""
+    pending = [(path, os.path.realpath(path))]
+    visited = set()
+    while pending:
+        path, realpath = pending.pop()
+        if realpath in visited:
+            continue
+        visited.add(realpath)
 
+        try:
+            st = os.stat(path)
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError as ex:
+            print(f"!!! FAILED to list: {path} ({ex})")
+            continue
 
-def yield_paths(path, predicate=lambda path: path, recursive=True):
-    for path, directories, file_names in os.walk(path, followlinks=True):
-        if predicate(path):
-            yield path
-
-        for file_name in file_names:
-            file_path = os.path.join(path, file_name)
-            if predicate(file_path):
-                yield file_path
-
-        if not recursive:
-            break
-
+        snapshot = (st.st_mtime_ns, len(entries))
+        unchanged = snapshots is not None and snapshots.get_directory(realpath) == snapshot
+
+        subdirectories = []
+        for entry in entries:
+            try:
+                if recursive and entry.is_dir():
+                    subdirectories.append(entry)
+                elif not unchanged and entry.is_file():
+                    entry_realpath = os.path.realpath(entry.path) if entry.is_symlink() else os.path.join(realpath, entry.name)
+                    yield entry.path, entry_realpath, realpath, entry
+            except OSError:
+                continue
 
-def valid_file_path(path):
-    global cache
-    realpath = os.path.realpath(path)
-    return (
-        realpath not in cache
-        and os.path.isfile(path)
-        or os.path.islink(path)
-        and os.path.isfile(realpath)
-        and realpath.endswith(".png")
-    )
+        if not unchanged and on_listed is not None:
+            on_listed(realpath, snapshot if time.time_ns() - st.st_mtime_ns > SETTLE_NS else None)
+
+        for entry in reversed(subdirectories):
+            entry_realpath = os.path.realpath(entry.path) if entry.is_symlink() else os.path.join(realpath, entry.name)
+            pending.append((entry.path, entry_realpath))
+
+
+class DirectoryProgress:
+    """Snapshots listed directories into the ledger once every file found in
+    them is in it, so later runs can skip them. Only a count of outstanding
+    files is kept per directory, and a directory is forgotten as soon as it
+    is done. A directory with a file that couldn't be read, parsed or
+    imported, or that changed too recently, isn't snapshotted so it's looked
+    at again next time. Batches land on upload worker threads, so this is
+    thread-safe."""
+
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+        self.lock = threading.Lock()
+        self.directories = {}  # realpath -> [outstanding files, snapshot, listed, failed]
+        self.files = {}  # realpath -> directories it was found in, while in flight
+
+    def _directory(self, directory):
+        return self.directories.setdefault(directory, [0, None, False, False])
+
+    def found(self, realpath, directory, settled=True):
+        with self.lock:
+            state = self._directory(directory)
+            state[0] += 1
+            if not settled:
+                state[3] = True
+            self.files.setdefault(realpath, []).append(directory)
+
+    def changed(self, directory):
+        """Keeps the directory from being snapshotted this run"""
+        with self.lock:
+            self._directory(directory)[3] = True
+
+    def listed(self, directory, snapshot):
+        with self.lock:
+            state = self._directory(directory)
+            state[1] = snapshot
+            state[2] = True
+            if snapshot is None:
+                state[3] = True
+            self._finish(directory)
+
+    def done(self, realpath, ok=True):
+        with self.lock:
+            for directory in self.files.pop(realpath, ()):
+                state = self.directories[directory]
+                state[0] -= 1
+                if not ok:
+                    state[3] = True
+                self._finish(directory)
+
+    def _finish(self, directory):
+        outstanding, snapshot, listed, failed = self.directories[directory]
+        if listed and outstanding == 0:
+            del self.directories[directory]
+            if not failed:
+                self.snapshots.set_directory(directory, *snapshot)
 
 
 re_whitespace = re.compile(r"  +")
@@ -244,12 +419,8 @@ def parse_comfyui_prompt(prompt):
     tokens = set()
     settings = []  # TODO
 
-    ts = prompt_parser.parse_prompt_attention(positive)
-    full_line = ""
-    for token, weight in ts:
-        full_line += token + ","
-    all_tokens = get_tokens(full_line.lower())
-    tokens.update(all_tokens)
+    texts = prompt_parser.tokenize_prompt_attention(positive, tags_only=True)
+    tokens.update(get_tokens(",".join(texts).lower()))
 
     all_tokens = list(tokens) + settings
     tags = [t for t in all_tokens if t]
@@ -307,12 +478,8 @@ def parse_nai_prompt(data):
     tokens = set()
     settings = get_naiv3_settings(data)
 
-    ts = prompt_parser.parse_prompt_attention(positive)
-    full_line = ""
-    for token, weight in ts:
-        full_line += token + ","
-    all_tokens = get_tokens(full_line.lower())
-    tokens.update(all_tokens)
+    texts = prompt_parser.tokenize_prompt_attention(positive, tags_only=True)
+    tokens.update(get_tokens(",".join(texts).lower()))
 
     all_tokens = list(tokens) + settings
     tags = [t for t in all_tokens if t]
@@ -332,124 +499,6 @@ def is_naiv3_metadata(result):
         and "Source" in result \
         and result["Source"].startswith("Stable Diffusion XL")
 
-def read_info_from_image_stealth(image):
-    # geninfo, items = original_read_info_from_image(image)
-    # possible_sigs = {'stealth_pnginfo', 'stealth_pngcomp', 'stealth_rgbinfo', 'stealth_rgbcomp'}
-
-    # respecting original pnginfo
-    # if geninfo is not None:
-    #     return geninfo, items
-
-    geninfo = None
-
-    # trying to read stealth pnginfo
-    width, height = image.size
-    pixels = image.load()
-
-    has_alpha = True if image.mode == 'RGBA' else False
-    mode = None
-    compressed = False
-    binary_data = ''
-    buffer_a = ''
-    buffer_rgb = ''
-    index_a = 0
-    index_rgb = 0
-    sig_confirmed = False
-    confirming_signature = True
-    reading_param_len = False
-    reading_param = False
-    read_end = False
-    for x in range(width):
-        for y in range(height):
-            if has_alpha:
-                r, g, b, a = pixels[x, y]
-                buffer_a += str(a & 1)
-                index_a += 1
-            else:
-                r, g, b = pixels[x, y]
-            buffer_rgb += str(r & 1)
-            buffer_rgb += str(g & 1)
-            buffer_rgb += str(b & 1)
-            index_rgb += 3
-            if confirming_signature:
-                if index_a == len('stealth_pnginfo') * 8:
-                    decoded_sig = bytearray(int(buffer_a[i:i + 8], 2) for i in
-                                            range(0, len(buffer_a), 8)).decode('utf-8', errors='ignore')
-                    if decoded_sig in {'stealth_pnginfo', 'stealth_pngcomp'}:
-                        confirming_signature = False
-                        sig_confirmed = True
-                        reading_param_len = True
-                        mode = 'alpha'
-                        if decoded_sig == 'stealth_pngcomp':
-                            compressed = True
-                        buffer_a = ''
-                        index_a = 0
-                    else:
-                        read_end = True
-                        break
-                elif index_rgb == len('stealth_pnginfo') * 8:
-                    decoded_sig = bytearray(int(buffer_rgb[i:i + 8], 2) for i in
-                                            range(0, len(buffer_rgb), 8)).decode('utf-8', errors='ignore')
-                    if decoded_sig in {'stealth_rgbinfo', 'stealth_rgbcomp'}:
-                        confirming_signature = False
-                        sig_confirmed = True
-                        reading_param_len = True
-                        mode = 'rgb'
-                        if decoded_sig == 'stealth_rgbcomp':
-                            compressed = True
-                        buffer_rgb = ''
-                        index_rgb = 0
-            elif reading_param_len:
-                if mode == 'alpha':
-                    if index_a == 32:
-                        param_len = int(buffer_a, 2)
-                        reading_param_len = False
-                        reading_param = True
-                        buffer_a = ''
-                        index_a = 0
-                else:
-                    if index_rgb == 33:
-                        pop = buffer_rgb[-1]
-                        buffer_rgb = buffer_rgb[:-1]
-                        param_len = int(buffer_rgb, 2)
-                        reading_param_len = False
-                        reading_param = True
-                        buffer_rgb = pop
-                        index_rgb = 1
-            elif reading_param:
-                if mode == 'alpha':
-                    if index_a == param_len:
-                        binary_data = buffer_a
-                        read_end = True
-                        break
-                else:
-                    if index_rgb >= param_len:
-                        diff = param_len - index_rgb
-                        if diff < 0:
-                            buffer_rgb = buffer_rgb[:diff]
-                        binary_data = buffer_rgb
-                        read_end = True
-                        break
-            else:
-                # impossible
-                read_end = True
-                break
-        if read_end:
-            break
-    if sig_confirmed and binary_data != '':
-        # Convert binary string to UTF-8 encoded text
-        byte_data = bytearray(int(binary_data[i:i + 8], 2) for i in range(0, len(binary_data), 8))
-        try:
-            if compressed:
-                decoded_data = gzip.decompress(bytes(byte_data)).decode('utf-8')
-            else:
-                decoded_data = byte_data.decode('utf-8', errors='ignore')
-            geninfo = decoded_data
-        except:
-            pass
-
-    return geninfo
-
 
 def parse_a1111_prompt(params):
     raw_prompt, extra_network_params = parse_prompt(params)
@@ -534,21 +583,12 @@ def parse_a1111_prompt(params):
         settings.append("uses_multicond:true")
 
     # Reconstruct tags from parsed attention
-    for parsed in prompt_parser.get_learned_conditioning_prompt_schedules(
-        subprompts, steps
-    ):
-        if len(parsed) > 1:
+    for variants in prompt_parser.get_prompt_variants(subprompts, steps):
+        if variants.schedule_length > 1:
             settings.append("uses_prompt_editing:true")
-        for t in parsed:
-            step, prompt = t
-            ts = prompt_parser.parse_prompt_attention(prompt)
-            full_line = ""
-            for token, weight in ts:
-                if token == "BREAK":
-                    continue
-                full_line += token + ","
-            all_tokens = get_tokens(full_line.lower())
-            tokens.update(all_tokens)
+        for texts in prompt_parser.parse_prompt_attention_many(variants.texts, tags_only=True):
+            line = ",".join(text for text in texts if text != "BREAK")
+            tokens.update(get_tokens(line.lower()))
 
     extra_networks = []
     for network_type, arglists in extra_network_params.items():
@@ -575,6 +615,7 @@ class PromptParseResult:
     tags: set[str]
     positive: str
     negative: str
+    sha256: str = None
 
     def get_notes(self):
         return {"filename": self.realpath,
@@ -584,159 +625,790 @@ class PromptParseResult:
                 }
 
 
-def do_import(client, service_key, personal_service_key, tag_sets, personal_tags):
-    global cache
+def print_file(*args):
+    """Per-file progress, left out with --quiet"""
+    if not quiet:
+        print(*args)
 
-    original_sigint = signal.getsignal(signal.SIGINT)
-    signal.signal(signal.SIGINT, null_handler)
 
-    for tags, parse_results in tqdm.tqdm(tag_sets.items()):
-        paths = [pr.realpath for pr in parse_results]
-        results = hydrus_api.utils.add_and_tag_files(
-            client, paths, tags, tag_service_keys=[service_key]
-        )
-        hashes = set()
-        for parse_result, result in zip(parse_results, results):
-            path = parse_result.realpath
-            status = result.get("status", 4)
-
-            if status == 1 or status == 2:
-                cache.add(path)
-                if "hash" in result:
-                    image = Image.open(path)
-                    image.load()
-                    client.set_notes(
-                        parse_result.get_notes(),
-                        hash_=result["hash"],
-                    )
-                    hashes.add(result["hash"])
+def hash_file(path):
+    """SHA-256 of the whole file, the same hash Hydrus identifies files by."""
+    hash_sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hash_sha256.update(chunk)
+    return hash_sha256.hexdigest()
 
-        if hashes:
-            client.add_tags(hashes, service_keys_to_tags={personal_service_key: personal_tags})
 
-    tag_sets.clear()
+def get_known_hashes(client, hashes):
+    """Returns the hashes of files that are already in Hydrus' local file domain."""
+    known = set()
+    for chunk in hydrus_api.utils.yield_chunks(list(hashes), MAX_IMPORT_SIZE):
+        metas = client.get_file_metadata(hashes=chunk)
+        for meta in metas["metadata"]:
+            if meta.get("file_id", None) is not None and meta.get("is_local", False):
+                known.add(meta["hash"])
+    return known
 
-    with open("hydrus_import_cache.txt", "w", encoding="utf-8") as f:
-        for line in cache:
-            f.write(line + "\n")
 
-    signal.signal(signal.SIGINT, original_sigint)
+def pool_connections(client, size):
+    """Keeps up to `size` connections to Hydrus alive on the client's session,
+    so that many requests can be in flight at once without reconnecting.
 
+    Every thread that talks to Hydrus shares this one session. urllib3's
+    connection pool is thread-safe, and the session carries nothing else
+    that could change under a thread: the access key is a fixed header and
+    Hydrus doesn't set cookies."""
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=size)
+    client.session.mount(client.api_url, adapter)
 
-def read_parameters(image):
-    if "parameters" in image.info:  # A1111
-        params = image.info["parameters"]
+
+def set_notes_with_retries(client, notes, hash_):
+    for attempt in range(NOTES_RETRIES + 1):
+        try:
+            client.set_notes(notes, hash_=hash_)
+            return
+        except (hydrus_api.ConnectionError, hydrus_api.ServerError, hydrus_api.DatabaseLocked):
+            if attempt == NOTES_RETRIES:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+
+def write_notes(client, hashes_to_notes, max_in_flight=NOTES_IN_FLIGHT):
+    """Sets the notes of each file with up to `max_in_flight` requests running
+    at once. Returns the hashes whose notes could not be written."""
+    failed = set()
+    if not hashes_to_notes:
+        return failed
+
+    with concurrent.futures.ThreadPoolExecutor(max_in_flight) as executor:
+        futures = {
+            executor.submit(set_notes_with_retries, client, notes, hash_): hash_
+            for hash_, notes in hashes_to_notes.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as ex:
+                print(f"!!! FAILED to set notes: {futures[future]} ({ex})")
+                failed.add(futures[future])
+
+    return failed
+
+
+def add_tags_by_hash(client, service_keys_to_hashes_to_tags):
+    """Adds a different set of tags to each file with at most one request per
+    file plus one. add_tags applies the same tags to every hash it's given, so
+    the tags every file in the batch has (settings, model, personal tags) go
+    out in a single request and each file's remaining tags in one of its own."""
+    hashes = sorted(set().union(*service_keys_to_hashes_to_tags.values()))
+    if not hashes:
+        return
+
+    shared = {}
+    for service_key, hashes_to_tags in service_keys_to_hashes_to_tags.items():
+        tags = set.intersection(*(set(hashes_to_tags.get(hash_, ())) for hash_ in hashes))
+        if tags:
+            shared[service_key] = tags
+    if shared:
+        client.add_tags(hashes, service_keys_to_tags={k: sorted(tags) for k, tags in shared.items()})
+
+    for hash_ in hashes:
+        service_keys_to_tags = {}
+        for service_key, hashes_to_tags in service_keys_to_hashes_to_tags.items():
+            tags = set(hashes_to_tags.get(hash_, ())) - shared.get(service_key, set())
+            if tags:
+                service_keys_to_tags[service_key] = sorted(tags)
+        if service_keys_to_tags:
+            client.add_tags([hash_], service_keys_to_tags=service_keys_to_tags)
+
+
+def update_tags_by_hash(client, service_key, hashes_to_actions_to_tags):
+    """Adds and removes a different set of tags on each file with at most one
+    request per file plus one, like add_tags_by_hash: changes every file in
+    the chunk needs go out in a single request and each file's remaining
+    changes in one of its own."""
+    hashes = sorted(hashes_to_actions_to_tags)
+    if not hashes:
+        return
+
+    def changes(hash_):
+        return {(action, tag) for action, tags in hashes_to_actions_to_tags[hash_].items() for tag in tags}
+
+    def send(hashes, changes):
+        actions_to_tags = defaultdict(list)
+        for action, tag in sorted(changes):
+            actions_to_tags[str(action)].append(tag)
+        client.add_tags(hashes, service_keys_to_actions_to_tags={service_key: dict(actions_to_tags)})
+
+    shared = set.intersection(*(changes(hash_) for hash_ in hashes))
+    if shared:
+        send(hashes, shared)
+
+    for hash_ in hashes:
+        remaining = changes(hash_) - shared
+        if remaining:
+            send([hash_], remaining)
+
+
+def do_import(client, service_key, personal_service_key, parse_results, personal_tags, notes_in_flight=NOTES_IN_FLIGHT):
+    global cache
+
+    # Uploader threads can't install signal handlers, the main thread is
+    # responsible for letting their batches finish instead
+    in_main_thread = threading.current_thread() is threading.main_thread()
+    if in_main_thread:
+        original_sigint = signal.getsignal(signal.SIGINT)
+        signal.signal(signal.SIGINT, null_handler)
+
+    # Files Hydrus already has only get their tags and notes updated. The
+    # same goes for duplicates within the batch once the first one is uploaded.
+    known_hashes = set()
+    batch_hashes = {pr.sha256 for pr in parse_results if pr.sha256}
+    if batch_hashes:
+        with stats.timer("lookup"):
+            known_hashes = get_known_hashes(client, batch_hashes)
+        if known_hashes:
+            print(f"{len(known_hashes)} files already in Hydrus, updating tags and notes only")
+
+    to_upload = []
+    known = []
+    for pr in parse_results:
+        if pr.sha256 in known_hashes:
+            known.append(pr)
+        else:
+            to_upload.append(pr)
+            if pr.sha256:
+                known_hashes.add(pr.sha256)
+
+    results = []
+    for pr in tqdm.tqdm(to_upload):
+        with stats.timer("upload"):
+            result = client.add_file(pr.realpath)
+        if result.get("status", 4) in (1, 2):
+            stats.count("files_uploaded")
+            stats.count("bytes_uploaded", os.path.getsize(pr.realpath))
+        else:
+            known_hashes.discard(pr.sha256)
+            stats.count("upload_failures")
+        results.append((pr, result))
+
+    for pr in known:
+        if pr.sha256 in known_hashes:
+            # status 2: already in db
+            results.append((pr, {"status": 2, "hash": pr.sha256}))
+            stats.count("files_already_in_hydrus")
+
+    imported = []
+    hashes_to_tags = defaultdict(set)
+    hashes_to_notes = {}
+    for parse_result, result in results:
+        status = result.get("status", 4)
+
+        if status == 1 or status == 2:
+            imported.append((parse_result.realpath, result.get("hash", None)))
+            if "hash" in result:
+                hashes_to_notes[result["hash"]] = parse_result.get_notes()
+                hashes_to_tags[result["hash"]].update(parse_result.tags)
+
+    if hashes_to_tags:
+        with stats.timer("tag"):
+            add_tags_by_hash(client, {
+                service_key: hashes_to_tags,
+                personal_service_key: {hash_: personal_tags for hash_ in hashes_to_tags},
+            })
+
+    # The batch only goes into the ledger once every note is written, so a
+    # failed batch is picked up again on the next run
+    with stats.timer("notes"):
+        failed = write_notes(client, hashes_to_notes, notes_in_flight)
+    stats.count("batches")
+    if failed:
+        stats.count("notes_failures", len(failed))
+        print(f"!!! {len(failed)} notes could not be written, this batch will be retried on the next run")
+    else:
+        for path, hash_ in imported:
+            cache.add(path, hash_)
+
+    parse_results.clear()
+
+    cache.commit()
+
+    if in_main_thread:
+        signal.signal(signal.SIGINT, original_sigint)
+
+
+class BatchUploader:
+    """Runs do_import on background threads, so uploading a batch overlaps
+    with parsing the next one. Batches wait in a bounded queue and put()
+    blocks while it is full, which keeps the parser from getting too far
+    ahead of Hydrus. If given, on_done is called with the realpaths of each
+    batch once it has been dealt with, whether it made it into Hydrus or
+    not."""
+
+    def __init__(self, client, workers, service_key, personal_service_key, personal_tags, notes_in_flight=NOTES_IN_FLIGHT, max_queued=None, on_done=None):
+        self.service_key = service_key
+        self.personal_service_key = personal_service_key
+        self.personal_tags = personal_tags
+        self.notes_in_flight = notes_in_flight
+        self.on_done = on_done
+        self.queue = queue.Queue(max_queued or workers * 2)
+        self.error = None
+        self.threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self.run, args=(client,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self, client):
+        while True:
+            parse_results = self.queue.get()
+            if parse_results is None:
+                return
+            realpaths = [pr.realpath for pr in parse_results]
+            try:
+                if self.error is None:
+                    do_import(
+                        client, self.service_key, self.personal_service_key, parse_results, self.personal_tags, self.notes_in_flight
+                    )
+            except Exception as ex:
+                self.error = ex
+            if self.on_done is not None:
+                self.on_done(realpaths)
+
+    def put(self, parse_results):
+        if self.error is not None:
+            raise self.error
+        if parse_results:
+            self.queue.put(parse_results)
+
+    def close(self, discard=False):
+        """Waits for the queued batches to be uploaded. If `discard` is set
+        only the batches already being uploaded are finished."""
+        if discard:
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
+                pass
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def read_info_parameters(info):
+    if "parameters" in info:  # A1111
+        params = info["parameters"]
         return "a1111", params
-    elif "prompt" in image.info:  # ComfyUI
-        params = image.info["prompt"]
+    elif "prompt" in info:  # ComfyUI
+        params = info["prompt"]
         return "comfyui", params
-    elif is_naiv3_metadata(image.info): # NAI
+    elif is_naiv3_metadata(info): # NAI
         result = {}
         for key in ["Title", "Description", "Software", "Source", "Generation time", "Comment"]:
-            result[key] = image.info[key]
+            result[key] = info[key]
         params = json.dumps(result)
         return "nai_v3", params
-    else:
-        try:
-            params = read_info_from_image_stealth(image)
-            if params is not None:
-                # NAIv3
-                result = json.loads(params)
-                if is_naiv3_metadata(result):
-                    return "nai_v3", params
-        except Exception as ex:
-            print(ex)
-            return None, None
 
-        return None, None
+    return None, None
+
+
+def read_stealth_parameters(image):
+    try:
+        params = read_info_from_image_stealth(image)
+        if params is not None:
+            # NAIv3
+            result = json.loads(params)
+            if is_naiv3_metadata(result):
+                return "nai_v3", params
+    except Exception as ex:
+        print(ex)
+
+    return None, None
+
+
+def read_parameters(image):
+    prompt_type, params = read_info_parameters(image.info)
+    if prompt_type is None:
+        prompt_type, params = read_stealth_parameters(image)
+    return prompt_type, params
+
+
+def tag_parser_fingerprint():
+    """Digest of the code that turns parameters into tags, so the on-disk tag
+    cache starts over whenever the parsing changes"""
+    h = hashlib.blake2b(digest_size=16)
+    for module_path in (__file__, prompt_parser.__file__):
+        with open(module_path, "rb") as f:
+            h.update(f.read())
+    return h.digest()
+
+
+def open_tag_cache(path):
+    global parsed_tags
+
+    parsed_tags.close()
+    parsed_tags = tag_cache.TagCache(TAG_CACHE_SIZE, path, tag_parser_fingerprint() if path else b"")
+
+
+def print_tag_cache_summary():
+    print(f"Tag cache: {parsed_tags.hits} hits, {parsed_tags.misses} misses")
+
+
+# Stands in for the seed while parsing, survives lowercasing and the other
+# changes the parser makes to the settings
+SEED_PLACEHOLDER = "\ue000"
+re_seed = re.compile(r"(?:^|, )Seed: (-?\d+)(?=,|\s*$)")
+
+
+def split_seed(params):
+    """Returns A1111 parameters with the seed in their settings line replaced
+    by SEED_PLACEHOLDER, and the seed, or None if they don't have one"""
+    lines = params.split("\n")
+    for i, line in enumerate(lines):
+        if line.strip().startswith("Steps: "):
+            m = re_seed.search(line)
+            if m is None:
+                break
+            lines[i] = line[:m.start(1)] + SEED_PLACEHOLDER + line[m.end(1):]
+            return "\n".join(lines), m.group(1)
+    return params, None
+
+
+def fill_seed(result, seed):
+    tags, positive, negative = result
+    if seed is None or tags is None:
+        return result
+    return (
+        {tag.replace(SEED_PLACEHOLDER, seed) for tag in tags},
+        positive.replace(SEED_PLACEHOLDER, seed) if positive is not None else None,
+        negative.replace(SEED_PLACEHOLDER, seed) if negative is not None else None,
+    )
 
 
 def read_tags(prompt_type, params):
+    # Batches share their parameters except for the seed, or entirely. The
+    # seed is left out of what's parsed and cached and put back afterwards,
+    # so a seed sweep is only parsed once
+    seed = None
+    if prompt_type == "a1111" and params is not None:
+        params, seed = split_seed(params)
+
+    if prompt_type is not None and params is not None:
+        cached = parsed_tags.get(prompt_type, params)
+        if cached is not None:
+            return fill_seed(cached, seed)
+
     tags = None
     positive = None
     negative = None
 
-    if prompt_type == "a1111":
-        tags, positive, negative = parse_a1111_prompt(params)
-    elif prompt_type == "comfyui":
-        tags, positive, negative = parse_comfyui_prompt(params)
-    elif prompt_type == "nai_v3":
-        tags, positive, negative = parse_nai_prompt(params)
+    with stats.timer("parse"):
+        if prompt_type == "a1111":
+            tags, positive, negative = parse_a1111_prompt(params)
+        elif prompt_type == "comfyui":
+            tags, positive, negative = parse_comfyui_prompt(params)
+        elif prompt_type == "nai_v3":
+            tags, positive, negative = parse_nai_prompt(params)
 
     if tags is None:
         return None, None, None
 
     tags.add(f"prompt_type:{prompt_type}")
-    return tags, positive, negative
+    parsed_tags.put(prompt_type, params, tags, positive, negative)
+    return fill_seed((tags, positive, negative), seed)
 
 
-def parse_image(path):
-    global cache
+BLACK_CHECK_STRIP_PIXELS = 1024 * 1024
 
+
+def is_all_black(image, mode="strips"):
+    if mode == "full":
+        return image.convert("L").getextrema() == (0, 0)
+
+    # Converts one horizontal strip of the decoded image at a time so it doesn't
+    # need a second full-size buffer, and stops at the first strip that isn't
+    # all black. Strips nearest the middle go first since that's where content
+    # usually is.
+    width, height = image.size
+    rows = max(1, BLACK_CHECK_STRIP_PIXELS // width)
+    tops = sorted(range(0, height, rows), key=lambda top: abs(top + rows // 2 - height // 2))
+    for top in tops:
+        strip = image.crop((0, top, width, min(height, top + rows)))
+        if strip.convert("L").getextrema() != (0, 0):
+            return False
+    return True
+
+
+def is_png_all_black(path, png_info):
+    """is_all_black for a PNG file that hasn't been decoded yet. Only one
+    strip is decoded at a time, from the top, and decoding stops at the first
+    strip that isn't all black, so memory use doesn't grow with the image."""
+    rows = max(1, BLACK_CHECK_STRIP_PIXELS // png_info.width)
+    for band in png_chunks.iter_bands(path, rows):
+        if band.convert("L").getextrema() != (0, 0):
+            return False
+    return True
+
+
+def get_black_check_verdict(path):
+    cached = black_check_cache.get(path, None)
+    if cached is None:
+        return None
+    st = os.stat(path)
+    if cached[:2] != (st.st_size, st.st_mtime_ns):
+        return None
+    return cached[2]
+
+
+def set_black_check_verdict(path, is_black):
+    st = os.stat(path)
+    black_check_cache[path] = (st.st_size, st.st_mtime_ns, is_black)
+
+
+def load_image(path):
     try:
-        image = Image.open(path)
-        image.load()
+        with stats.timer("decode"):
+            image = Image.open(path)
+            image.load()
+        return image
+    except Exception as ex:
+        print(f"!!! FAILED to open: {path} ({ex})")
+        stats.count("open_failures")
+        failed_paths.add(path)
+        return None
 
-        extrema = image.convert("L").getextrema()
-        if extrema == (0, 0):
-            print(f"!!! SKIPPING (all black): {path}")
-            cache.add(path)
-            return None
 
+def parse_image(path, black_check="strips", check_hashes=True):
+    global cache
+
+    # Only the metadata chunks are read up front, pixels are decoded only when
+    # the stealth fallback or the all-black check needs them. Text written
+    # after the image data is only looked for if there's none before it.
+    try:
+        with stats.timer("open"):
+            png_info = png_chunks.open_png_info(path)
+            prompt_type, parameters = read_info_parameters(png_info.info)
+            if prompt_type is None:
+                png_info = png_chunks.open_png_info(path, after_idat=True)
+                prompt_type, parameters = read_info_parameters(png_info.info)
     except Exception as ex:
         print(f"!!! FAILED to open: {path} ({ex})")
+        stats.count("open_failures")
+        failed_paths.add(path)
         return None
 
-    prompt_type, parameters = read_parameters(image)
+    image = None
+    if prompt_type is None and png_info.mode in ("RGB", "RGBA"):
+        image = load_image(path)
+        if image is None:
+            return None
+        with stats.timer("metadata"):
+            prompt_type, parameters = read_parameters(image)
+
     if prompt_type is None:
+        # Nothing to import, so it's skipped from now on like an all-black image
+        stats.count("files_without_metadata")
+        cache.add(path)
         return None
 
+    if black_check != "none":
+        is_black = get_black_check_verdict(path)
+        if is_black is None:
+            if image is None and black_check == "strips" and png_chunks.can_decode_bands(png_info):
+                try:
+                    with stats.timer("black_check"):
+                        is_black = is_png_all_black(path, png_info)
+                except Exception as ex:
+                    print(f"!!! FAILED to open: {path} ({ex})")
+                    stats.count("open_failures")
+                    failed_paths.add(path)
+                    return None
+            else:
+                if image is None:
+                    image = load_image(path)
+                    if image is None:
+                        return None
+                with stats.timer("black_check"):
+                    is_black = is_all_black(image, black_check)
+            set_black_check_verdict(path, is_black)
+
+        if is_black:
+            print(f"!!! SKIPPING (all black): {path}")
+            stats.count("skipped_all_black")
+            cache.add(path)
+            return None
+
     tags, positive, negative = read_tags(prompt_type, parameters)
     if tags is None:
+        stats.count("parse_failures")
+        failed_paths.add(path)
         return None
 
     tags.add(f"prompt_type:{prompt_type}")
 
-    return PromptParseResult(path, parameters, tags, positive, negative)
+    sha256 = None
+    if check_hashes:
+        with stats.timer("hash"):
+            sha256 = hash_file(path)
+
+    stats.count("files_parsed")
+    return PromptParseResult(path, parameters, tags, positive, negative, sha256)
+
+
+def init_parse_worker(max_image_pixels, tag_cache_path, profile):
+    global stats
+
+    # The main process handles Ctrl+C and shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    Image.MAX_IMAGE_PIXELS = max_image_pixels
+    open_tag_cache(tag_cache_path)
+    stats = import_stats.ImportStats(profile)
+
+
+def parse_image_job(path, black_check, check_hashes, black_check_verdict):
+    """Runs parse_image in a worker process. The worker's caches are thrown
+    away, so whatever parse_image recorded in them is sent back instead."""
+    if black_check_verdict is not None:
+        black_check_cache[path] = black_check_verdict
+    hits, misses = parsed_tags.hits, parsed_tags.misses
+    result = parse_image(path, black_check, check_hashes)
+    failed = path in failed_paths
+    failed_paths.discard(path)
+    tag_cache_stats = (parsed_tags.hits - hits, parsed_tags.misses - misses)
+    return path, result, failed, black_check_cache.get(path, None), path in cache, tag_cache_stats, stats.take()
+
+
+def parse_images(paths, black_check="strips", check_hashes=True, jobs=1):
+    """Yields (path, parse result, whether it failed to be read or parsed) for
+    each path, in completion order. With more than one job the paths are
+    parsed in a process pool with a bounded number of paths in flight, so
+    results can be consumed as they arrive without the backlog growing while
+    the main process is busy uploading."""
+    if jobs <= 1:
+        for path in paths:
+            result = parse_image(path, black_check, check_hashes)
+            failed = path in failed_paths
+            failed_paths.discard(path)
+            yield path, result, failed
+        return
+
+    def collect(future):
+        path, result, failed, black_check_verdict, cached, (hits, misses), worker_stats = future.result()
+        parsed_tags.hits += hits
+        parsed_tags.misses += misses
+        stats.merge(worker_stats)
+        if black_check_verdict is not None:
+            black_check_cache[path] = black_check_verdict
+        if cached:
+            cache.add(path)
+        return path, result, failed
+
+    # Workers are spawned rather than forked so they start with empty caches
+    # instead of inheriting the ledger's database connection.
+    max_pending = jobs * 4
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_parse_worker,
+        initargs=(Image.MAX_IMAGE_PIXELS, parsed_tags.path, stats.enabled),
+    ) as executor:
+        pending = set()
+        for path in paths:
+            pending.add(executor.submit(parse_image_job, path, black_check, check_hashes, black_check_cache.get(path, None)))
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield collect(future)
+
+        for future in concurrent.futures.as_completed(pending):
+            yield collect(future)
+
+
+def import_path(client, target_path, service_key, personal_service_key, tags=(), recursive=True, black_check="strips", check_hashes=True, jobs=1, upload_workers=0, batch_size=MAX_IMPORT_SIZE, batch_bytes=MAX_IMPORT_BYTES, notes_in_flight=NOTES_IN_FLIGHT):
+    personal_tags = tags
+    parse_results = []
+
+    # Directories are only marked as done once every file in them that was
+    # sent to Hydrus made it into the ledger
+    snapshots = cache if isinstance(cache, import_ledger.ImportLedger) else None
+    progress = DirectoryProgress(snapshots) if snapshots is not None else None
 
+    def imported(realpaths):
+        if progress is not None:
+            for realpath in realpaths:
+                progress.done(realpath, realpath in cache)
 
-def import_path(client, target_path, service_key, personal_service_key, tags=(), recursive=True):
-    personal_tags = tags
-    tag_sets = collections.defaultdict(list)
+    uploader = None
+    if upload_workers > 0:
+        uploader = BatchUploader(client, upload_workers, service_key, personal_service_key, personal_tags, notes_in_flight, on_done=imported)
+
+    def flush(parse_results):
+        if uploader is not None:
+            uploader.put(parse_results)
+        else:
+            realpaths = [pr.realpath for pr in parse_results]
+            try:
+                do_import(client, service_key, personal_service_key, parse_results, personal_tags, notes_in_flight)
+            finally:
+                imported(realpaths)
+
+    def yield_uncached_paths():
+        files = stats.timed_iter("walk", scan_files(target_path, recursive, snapshots, progress.listed if progress is not None else None))
+        for path, realpath, directory, entry in tqdm.tqdm(files):
+            print_file(path)
+            if os.path.splitext(path)[1].lower() != ".png":
+                continue
+            stats.count("files_seen")
+
+            if realpath in cache:
+                # print(f"!!! SKIPPING (in cache): {path}")
+                stats.count("skipped_in_ledger")
+                continue
+
+            if progress is not None:
+                try:
+                    mtime_ns = entry.stat().st_mtime_ns
+                except OSError:
+                    # removed or renamed since its directory was listed
+                    progress.changed(directory)
+                    continue
+                progress.found(realpath, directory, time.time_ns() - mtime_ns > SETTLE_NS)
+            yield realpath
 
     i = 0
+    size = 0
 
-    for path in tqdm.tqdm(list(yield_paths(target_path, valid_file_path, recursive))):
-        print(path)
-        if os.path.splitext(path)[1].lower() != ".png":
-            continue
+    try:
+        for realpath, result, failed in parse_images(yield_uncached_paths(), black_check, check_hashes, jobs):
+            if result is None:
+                # Images without metadata or that are all black are done with,
+                # but ones that couldn't be read are tried again next time
+                if progress is not None:
+                    progress.done(realpath, not failed)
+                continue
 
-        realpath = os.path.realpath(path)
-        if realpath in cache:
-            # print(f"!!! SKIPPING (in cache): {path}")
-            continue
+            parse_results.append(result)
+
+            i += 1
+            size += os.path.getsize(result.realpath)
+            if i >= batch_size or size >= batch_bytes:
+                flush(parse_results)
+                parse_results = []
+                i = 0
+                size = 0
+
+        flush(parse_results)
+    except BaseException:
+        if uploader is not None:
+            uploader.close(discard=True)
+        raise
+
+    if uploader is not None:
+        uploader.close()
+
+    if snapshots is not None:
+        snapshots.commit()
+
+
+def watch_import(arguments, client, watcher, service_key, personal_service_key):
+    """Imports new files reported by the watcher until interrupted. A file is
+    parsed once its size and mtime have stayed the same for the debounce
+    time, so images still being written aren't read half-finished. Parsed
+    files are sent once the batch is full or the oldest one has waited for
+    the latency limit, on the upload workers if there are any. Files only
+    settle a few at a time, so they're parsed here rather than in a process
+    pool."""
+    print("Watching for new files, press Ctrl+C to stop...")
+    pending = {}  # realpath -> ((size, mtime_ns), monotonic time it was last seen changing)
+    parse_results = []
+    oldest = None
+
+    uploader = None
+    if arguments.upload_workers > 0:
+        uploader = BatchUploader(
+            client, arguments.upload_workers, service_key, personal_service_key, arguments.tags, arguments.notes_in_flight
+        )
 
-        result = parse_image(realpath)
-        if result is None:
-            continue
+    def flush():
+        nonlocal parse_results, oldest
+        if uploader is not None:
+            uploader.put(parse_results)
+        elif parse_results:
+            do_import(client, service_key, personal_service_key, parse_results, arguments.tags, arguments.notes_in_flight)
+        parse_results = []
+        oldest = None
 
-        tag_sets[tuple(sorted(result.tags))].append(result)
+    try:
+        try:
+            while True:
+                # Wake up often while there's something waiting to settle or be sent
+                timeout = arguments.watch_interval
+                if pending or parse_results:
+                    timeout = min(timeout, arguments.debounce / 2, arguments.watch_latency / 2)
+
+                for path in watcher.changes(timeout):
+                    if os.path.splitext(path)[1].lower() != ".png":
+                        continue
+                    realpath = os.path.realpath(path)
+                    if realpath not in cache:
+                        pending.setdefault(realpath, None)
+
+                now = time.monotonic()
+                for realpath, last_seen in list(pending.items()):
+                    try:
+                        st = os.stat(realpath)
+                    except OSError:
+                        del pending[realpath]
+                        continue
 
-        i += 1
-        if i >= MAX_IMPORT_SIZE:
-            do_import(client, service_key, personal_service_key, tag_sets, personal_tags)
-            i = 0
+                    signature = (st.st_size, st.st_mtime_ns)
+                    if last_seen is None or last_seen[0] != signature:
+                        pending[realpath] = (signature, now)
+                        continue
+                    if now - last_seen[1] < arguments.debounce:
+                        continue
+
+                    del pending[realpath]
+                    print_file(realpath)
+                    stats.count("files_seen")
+                    result = parse_image(realpath, arguments.black_check, arguments.check_hashes)
+                    failed_paths.discard(realpath)
+                    if result is not None:
+                        parse_results.append(result)
+                        oldest = oldest or now
+
+                if len(parse_results) >= arguments.batch_size or (
+                    parse_results and now - oldest >= arguments.watch_latency
+                ):
+                    flush()
+                else:
+                    # black images and ones without metadata go into the
+                    # ledger without a batch
+                    cache.commit()
+        except KeyboardInterrupt:
+            print("Stopping...")
+            flush()
+    except BaseException:
+        if uploader is not None:
+            uploader.close(discard=True)
+        raise
 
-    do_import(client, service_key, personal_service_key, tag_sets, personal_tags)
+    if uploader is not None:
+        uploader.close()
 
 
 def cmd_import(arguments, client):
-    global cache
+    global cache, black_check_cache
+
+    # Each upload worker writes the notes of its batch concurrently
+    pool_connections(client, arguments.notes_in_flight * max(1, arguments.upload_workers))
 
-    if os.path.isfile("hydrus_import_cache.txt"):
-        with open("hydrus_import_cache.txt", "r", encoding="utf-8") as f:
-            for line in f:
-                cache.add(line.strip())
+    cache = import_ledger.ImportLedger()
+    black_check_cache = cache.black_checks
 
     service_key = (
         client.get_service(service_name=arguments.service)
@@ -753,6 +1425,12 @@ def cmd_import(arguments, client):
         print(f"Unknown hydrus service: {arguments.service}")
         exit(1)
 
+    watcher = None
+    if arguments.watch:
+        # Started before the first import so nothing written during it is missed
+        roots = [path for path in arguments.paths if os.path.isdir(path)]
+        watcher = dir_watcher.open_watcher(roots, arguments.recursive, arguments.inotify)
+
     for path in arguments.paths:
         print(path)
         if os.path.isdir(path):
@@ -764,25 +1442,72 @@ def cmd_import(arguments, client):
                 personal_service_key,
                 arguments.tags,
                 arguments.recursive,
+                arguments.black_check,
+                arguments.check_hashes,
+                arguments.jobs,
+                arguments.upload_workers,
+                arguments.batch_size,
+                arguments.batch_mb * 1024 * 1024,
+                arguments.notes_in_flight,
             )
         else:
             print(f"Skipping (not a directory): {path}")
 
-    with open("hydrus_import_cache.txt", "w", encoding="utf-8") as f:
-        for line in cache:
-            f.write(line + "\n")
+    if watcher is not None:
+        try:
+            watch_import(arguments, client, watcher, service_key, personal_service_key)
+        finally:
+            watcher.close()
+
+    cache.close()
+    print_tag_cache_summary()
 
 
 NOTE_NAMES = ["filename", "parameters", "positive", "negative"]
 
 
+def fetch_parameters(client, file_id):
+    """Reads a file's parameters from Hydrus. The text chunks of a PNG are read
+    straight off the response and the connection is dropped once the image
+    data starts. The whole file is only downloaded when the stealth metadata
+    in its pixels is needed, or when it isn't a PNG."""
+    resp = client.get_file(file_id=file_id)
+    try:
+        resp.raw.decode_content = True
+        png_info = png_chunks.read_png_info(resp.raw)
+    except SyntaxError:
+        png_info = None
+    finally:
+        resp.close()
+
+    if png_info is not None:
+        prompt_type, parameters = read_info_parameters(png_info.info)
+        if prompt_type is not None or png_info.mode not in ("RGB", "RGBA"):
+            return prompt_type, parameters
+
+    resp = client.get_file(file_id=file_id)
+    with BytesIO() as b:
+        for chunk in resp.iter_content(1024 * 1024):
+            b.write(chunk)
+        img = Image.open(b)
+        return read_parameters(img)
+
+
 def cmd_retag(arguments, client):
     # keep_tags = ["board", "site", "gen_type"]
     all_file_ids = client.search_files(arguments.query)["file_ids"]
-    print(all_file_ids)
+    print_file(all_file_ids)
+    pool_connections(client, arguments.jobs)
+    with concurrent.futures.ThreadPoolExecutor(arguments.jobs) as executor:
+        retag_files(arguments, client, all_file_ids, executor)
+    print_tag_cache_summary()
+
+
+def retag_files(arguments, client, all_file_ids, executor):
     service_key = None
     for file_ids in hydrus_api.utils.yield_chunks(all_file_ids, 100):
-        metas = client.get_file_metadata(file_ids=file_ids, include_notes=True)
+        with stats.timer("lookup"):
+            metas = client.get_file_metadata(file_ids=file_ids, include_notes=True)
         if service_key is None:
             service_key = next(
                 filter(
@@ -793,10 +1518,11 @@ def cmd_retag(arguments, client):
             print(f"{arguments.service} service key: {service_key}")
             assert service_key
 
+        # Files without stored parameters are fetched from Hydrus in parallel
+        # while the rest of the chunk is being compared
+        stored = []
+        fetches = {}
         for meta in metas["metadata"]:
-            print(f"- {meta['hash']}")
-            needs_update = False
-            file_id = meta["file_id"]
             notes = meta["notes"]
             existing_tags = set(
                 meta["tags"][service_key]["storage_tags"].get(
@@ -810,15 +1536,27 @@ def cmd_retag(arguments, client):
                 prompt_type = prompt_type.removeprefix("prompt_type:")
 
             if parameters is None or prompt_type is None:
-                needs_update = True
-                resp = client.get_file(file_id=file_id)
-                with BytesIO() as b:
-                    for chunk in resp:
-                        b.write(chunk)
-                    img = Image.open(b)
-                    prompt_type, parameters = read_parameters(img)
-                    if parameters is None:
-                        continue
+                fetches[meta["file_id"]] = executor.submit(fetch_parameters, client, meta["file_id"])
+            stored.append((meta, existing_tags, prompt_type, parameters))
+
+        hashes_to_actions_to_tags = {}
+        hashes_to_notes = {}
+        for meta, existing_tags, prompt_type, parameters in stored:
+            print_file(f"- {meta['hash']}")
+            stats.count("files_seen")
+            file_id = meta["file_id"]
+            notes = meta["notes"]
+
+            if file_id in fetches:
+                try:
+                    with stats.timer("fetch"):
+                        prompt_type, parameters = fetches[file_id].result()
+                except Exception as ex:
+                    print(f"!!! FAILED to fetch: {file_id} ({ex})")
+                    stats.count("fetch_failures")
+                    continue
+                if parameters is None:
+                    continue
 
             if parameters is None or prompt_type is None:
                 print(f"Cannot detect parameters in image! {file_id}")
@@ -827,47 +1565,42 @@ def cmd_retag(arguments, client):
             new_tags, positive, negative = read_tags(prompt_type, parameters)
             if new_tags is None:
                 print(f"No tags parsed in existing image! {file_id}")
+                stats.count("parse_failures")
                 continue
+            stats.count("files_parsed")
 
             new_tags = set([t.lower() for t in new_tags])
-
-            needs_update = (
-                needs_update or (existing_tags - new_tags) or (new_tags - existing_tags)
-            )
-
-            if needs_update:
-                print(f"removing tags: {len(existing_tags - new_tags)}")
-                print(f"adding tags: {len(new_tags - existing_tags)}")
-                print("================")
-
-                params_delete = {
-                    service_key: {
-                        str(hydrus_api.TagAction.DELETE): list(existing_tags),
-                    }
-                }
-                params_add = {
-                    service_key: {
-                        str(hydrus_api.TagAction.ADD): list(new_tags),
-                    }
+            to_remove = existing_tags - new_tags
+            to_add = new_tags - existing_tags
+            if to_remove or to_add:
+                print_file(f"removing tags: {len(to_remove)}")
+                print_file(f"adding tags: {len(to_add)}")
+                print_file("================")
+                stats.count("files_retagged")
+                hashes_to_actions_to_tags[meta["hash"]] = {
+                    hydrus_api.TagAction.DELETE: to_remove,
+                    hydrus_api.TagAction.ADD: to_add,
                 }
 
-                original_sigint = signal.getsignal(signal.SIGINT)
-                signal.signal(signal.SIGINT, null_handler)
+            new_notes = {"parameters": parameters, "positive": positive, "negative": negative}
+            if any(notes.get(k) != v for k, v in new_notes.items()):
+                hashes_to_notes[meta["hash"]] = {**notes, **new_notes}
 
-                client.add_tags(
-                    file_ids=[file_id], service_keys_to_actions_to_tags=params_delete
-                )
-                client.add_tags(
-                    file_ids=[file_id], service_keys_to_actions_to_tags=params_add
-                )
+        if not hashes_to_actions_to_tags and not hashes_to_notes:
+            continue
 
-                notes["parameters"] = parameters
-                notes["positive"] = positive
-                notes["negative"] = negative
+        original_sigint = signal.getsignal(signal.SIGINT)
+        signal.signal(signal.SIGINT, null_handler)
 
-                client.set_notes(notes=notes, file_id=file_id)
+        if hashes_to_actions_to_tags:
+            with stats.timer("tag"):
+                update_tags_by_hash(client, service_key, hashes_to_actions_to_tags)
+        with stats.timer("notes"):
+            failed = write_notes(client, hashes_to_notes)
+        stats.count("notes_updated", len(hashes_to_notes) - len(failed))
+        stats.count("notes_failures", len(failed))
 
-                signal.signal(signal.SIGINT, original_sigint)
+        signal.signal(signal.SIGINT, original_sigint)
 
 
 def main(arguments):
@@ -882,13 +1615,32 @@ def main(arguments):
     # if not arguments.protect_decompression:
     Image.MAX_IMAGE_PIXELS = None
 
-    if arguments.command == "import":
-        cmd_import(arguments, client)
-    elif arguments.command == "retag":
-        cmd_retag(arguments, client)
-    else:
-        parser.print_help()
-        return 1
+    if arguments.tags_cache:
+        open_tag_cache(arguments.tags_cache)
+
+    global stats, quiet
+    quiet = arguments.quiet
+    profile = arguments.profile or arguments.profile_json is not None
+    stats = import_stats.ImportStats(profile)
+    if profile and arguments.profile_interval > 0:
+        stats.start_snapshots(arguments.profile_interval)
+
+    try:
+        if arguments.command == "import":
+            cmd_import(arguments, client)
+        elif arguments.command == "retag":
+            cmd_retag(arguments, client)
+        else:
+            parser.print_help()
+            return 1
+    finally:
+        if profile:
+            stats.stop_snapshots()
+            stats.count("tag_cache_hits", parsed_tags.hits)
+            stats.count("tag_cache_misses", parsed_tags.misses)
+            stats.print_summary()
+            if arguments.profile_json:
+                stats.write_json(arguments.profile_json)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,202 @@
+import io
+import struct
+import zlib
+from dataclasses import dataclass, field
+
+from PIL import Image, PngImagePlugin
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG color type -> PIL mode, for 8-bit images
+COLOR_TYPE_MODES = {0: "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}
+# PNG color type -> bytes per pixel, for 8-bit images
+COLOR_TYPE_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+TEXT_CHUNKS = {b"tEXt", b"zTXt", b"iTXt"}
+
+
+@dataclass
+class PngInfo:
+    width: int
+    height: int
+    mode: str
+    info: dict = field(default_factory=dict)
+    bit_depth: int = 8
+    interlace: int = 0
+
+
+def _read_exact(fp, n):
+    data = fp.read(n)
+    if len(data) != n:
+        raise SyntaxError("truncated PNG file")
+    return data
+
+
+def _skip(fp, n):
+    if fp.seekable():
+        fp.seek(n, io.SEEK_CUR)
+        return
+    while n > 0:
+        data = fp.read(min(n, 1024 * 1024))
+        if not data:
+            raise SyntaxError("truncated PNG file")
+        n -= len(data)
+
+
+def _decompress(data):
+    """Same limit PIL enforces for compressed text chunks."""
+    dobj = zlib.decompressobj()
+    plaintext = dobj.decompress(data, PngImagePlugin.MAX_TEXT_CHUNK)
+    if dobj.unconsumed_tail:
+        raise ValueError("Decompressed Data Too Large")
+    return plaintext
+
+
+def _parse_text_chunk(cid, data):
+    """Decodes a tEXt/zTXt/iTXt chunk into a key/value pair the same way
+    PIL's PngImagePlugin does."""
+    key, _, value = data.partition(b"\0")
+    key = key.decode("latin-1", "strict")
+
+    if cid == b"tEXt":
+        return key, value.decode("latin-1", "replace")
+    if cid == b"zTXt":
+        # first byte is the compression method, always zlib
+        return key, _decompress(value[1:]).decode("latin-1", "replace")
+
+    compressed, method = value[0], value[1]
+    _lang, _, rest = value[2:].partition(b"\0")
+    _translated_key, _, value = rest.partition(b"\0")
+    if compressed:
+        if method != 0:
+            return None
+        value = _decompress(value)
+    try:
+        return key, value.decode("utf-8", "strict")
+    except UnicodeError:
+        return None
+
+
+def read_png_info(fp, after_idat=False):
+    """Reads the text chunks of a PNG file without decoding any pixel data.
+    Stops at the first IDAT chunk, so only metadata written ahead of the image
+    data is returned, unless `after_idat` is set, in which case the image
+    data is skipped over and the text chunks after it are read too. Works on
+    unseekable streams like HTTP responses."""
+    if _read_exact(fp, 8) != PNG_SIGNATURE:
+        raise SyntaxError("not a PNG file")
+
+    result = None
+    while True:
+        length, cid = struct.unpack(">I4s", _read_exact(fp, 8))
+
+        if cid == b"IHDR":
+            data = _read_exact(fp, length)
+            _skip(fp, 4)
+            width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", data[:13])
+            result = PngInfo(width, height, COLOR_TYPE_MODES.get(color_type, ""), bit_depth=bit_depth, interlace=interlace)
+        elif result is None:
+            raise SyntaxError("PNG file does not start with IHDR")
+        elif cid in TEXT_CHUNKS:
+            data = _read_exact(fp, length)
+            crc = struct.unpack(">I", _read_exact(fp, 4))[0]
+            if zlib.crc32(cid + data) != crc:
+                raise SyntaxError(f"broken PNG file (bad CRC in {cid.decode()} chunk)")
+            kv = _parse_text_chunk(cid, data)
+            if kv is not None:
+                result.info[kv[0]] = kv[1]
+        elif cid == b"IEND" or cid == b"IDAT" and not after_idat:
+            return result
+        else:
+            _skip(fp, length + 4)
+
+
+def open_png_info(path, after_idat=False):
+    with open(path, "rb") as f:
+        return read_png_info(f, after_idat)
+
+
+def can_decode_bands(png_info):
+    """Whether iter_bands can decode the image"""
+    return png_info.mode != "" and png_info.bit_depth == 8 and not png_info.interlace
+
+
+def _chunk(cid, data):
+    return struct.pack(">I", len(data)) + cid + data + struct.pack(">I", zlib.crc32(cid + data))
+
+
+def _read_idat(fp, length):
+    """Yields the compressed image data in pieces, starting inside the IDAT
+    chunk of the given length that fp is at."""
+    while True:
+        while length > 0:
+            data = _read_exact(fp, min(length, 1024 * 1024))
+            length -= len(data)
+            yield data
+        _skip(fp, 4)
+        length, cid = struct.unpack(">I4s", _read_exact(fp, 8))
+        if cid != b"IDAT":
+            return
+
+
+def iter_bands(path, rows):
+    """Decodes a PNG file `rows` rows at a time from the top, yielding each
+    band as a PIL image. Only one band of compressed and decoded data is held
+    at a time, so images of any size can be looked at with bounded memory.
+    Each band is handed to PIL as a small PNG of its own, starting with the
+    last row of the band before it so PIL can undo the row filters. Only
+    works on images can_decode_bands accepts."""
+    with open(path, "rb") as fp:
+        if _read_exact(fp, 8) != PNG_SIGNATURE:
+            raise SyntaxError("not a PNG file")
+
+        ihdr = None
+        palette = b""
+        while True:
+            length, cid = struct.unpack(">I4s", _read_exact(fp, 8))
+            if cid == b"IDAT":
+                break
+            if cid == b"IEND" or (ihdr is None and cid != b"IHDR"):
+                raise SyntaxError("broken PNG file")
+            data = _read_exact(fp, length)
+            _skip(fp, 4)
+            if cid == b"IHDR":
+                ihdr = data
+            elif cid in (b"PLTE", b"tRNS"):
+                palette += _chunk(cid, data)
+
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", ihdr[:13])
+        if bit_depth != 8 or interlace or color_type not in COLOR_TYPE_CHANNELS:
+            raise ValueError("only 8-bit non-interlaced PNG files can be decoded in bands")
+        Image._decompression_bomb_check((width, height))
+
+        stride = 1 + width * COLOR_TYPE_CHANNELS[color_type]
+        compressed = _read_idat(fp, length)
+        decompressor = zlib.decompressobj()
+        previous = None
+        for top in range(0, height, rows):
+            band_rows = min(rows, height - top)
+            filtered = bytearray()
+            while len(filtered) < band_rows * stride:
+                data = decompressor.unconsumed_tail or next(compressed, None)
+                if data is None or decompressor.eof:
+                    raise SyntaxError("truncated PNG file")
+                filtered += decompressor.decompress(data, band_rows * stride - len(filtered))
+
+            if previous is not None:
+                filtered[0:0] = b"\0" + previous
+                band_rows += 1
+            png = (
+                PNG_SIGNATURE
+                + _chunk(b"IHDR", struct.pack(">II", width, band_rows) + ihdr[8:13])
+                + palette
+                + _chunk(b"IDAT", zlib.compress(filtered, 0))
+                + _chunk(b"IEND", b"")
+            )
+            del filtered
+            band = Image.open(io.BytesIO(png))
+            band.load()
+            previous = band.crop((0, band_rows - 1, width, band_rows)).tobytes()
+            if top > 0:
+                band = band.crop((0, 1, width, band_rows))
+            yield band
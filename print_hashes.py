@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import glob
-import sys
+import argparse
 import safetensors
 import json
 import mmap
@@ -9,21 +9,49 @@ import pprint
 import os.path
 
 import safetensors_hack
+import hash_cache
 
-model_dir = sys.argv[1]
+parser = argparse.ArgumentParser()
+parser.add_argument("model_dir")
+parser.add_argument("--hash-cache", default=hash_cache.DEFAULT_PATH, help="SQLite file to keep computed hashes in")
+parser.add_argument("--verify", action="store_true", help="Hash every file again instead of using the cached hashes")
+parser.add_argument("--jobs", "-j", type=int, help="Hash this many files at once, printing a JSON line for each as it finishes")
+parser.add_argument("--reads-per-device", type=int, default=2, help="With --jobs, how many files to read at once from the same disk")
+args = parser.parse_args()
+
+model_dir = args.model_dir
 if not model_dir:
     print("Provide a model path.")
     exit(1)
 
-for filename in glob.iglob(f"{model_dir}/**/*.safetensors", recursive=True):
-    metadata = safetensors_hack.read_metadata(filename)
-    precalc_hash = metadata.get("sshs_model_hash", None)
-    precalc_legacy_hash = metadata.get("sshs_legacy_hash", None)
-    hash = safetensors_hack.hash_file(filename)
-    legacy_hash = safetensors_hack.legacy_hash_file(filename)
-
-    print(f"File: {filename}")
-    print(f"  - Precalc. Hash: {precalc_hash}")
-    print(f"  - Precalc. Legacy Hash: {precalc_legacy_hash}")
-    print(f"  - Hash: {hash}")
-    print(f"  - Legacy Hash: {legacy_hash}")
+cache = hash_cache.HashCache(args.hash_cache)
+
+filenames = glob.iglob(f"{model_dir}/**/*.safetensors", recursive=True)
+
+if args.jobs:
+    for filename, hashes, speed in safetensors_hack.hash_files(filenames, cache, args.verify, args.jobs, args.reads_per_device):
+        metadata = safetensors_hack.read_metadata(filename)
+        print(json.dumps({
+            "file": filename,
+            "precalc_model_hash": metadata.get("sshs_model_hash", None),
+            "precalc_legacy_hash": metadata.get("sshs_legacy_hash", None),
+            **hashes,
+            "mb_per_second": speed,
+        }), flush=True)
+else:
+    for filename in filenames:
+        metadata = safetensors_hack.read_metadata(filename)
+        precalc_hash = metadata.get("sshs_model_hash", None)
+        precalc_legacy_hash = metadata.get("sshs_legacy_hash", None)
+        hashes, speed = safetensors_hack.get_hashes(filename, cache, args.verify)
+
+        print(f"File: {filename}")
+        print(f"  - Precalc. Hash: {precalc_hash}")
+        print(f"  - Precalc. Legacy Hash: {precalc_legacy_hash}")
+        print(f"  - Hash: {hashes['model_hash']}")
+        print(f"  - Legacy Hash: {hashes['legacy_hash']}")
+        print(f"  - SHA-256: {hashes['sha256']}")
+        print(f"  - CRC32: {hashes['crc32']}")
+        print(f"  - Read: {f'{speed:.1f} MB/s' if speed is not None else 'cached'}")
+
+cache.close()
@@ -1,4 +1,5 @@
 import re
+from array import array
 from collections import namedtuple
 from typing import List
 import lark
@@ -11,7 +12,7 @@ import lark
 # [75, 'fantasy landscape with a lake and an oak in background masterful']
 # [100, 'fantasy landscape with a lake and a christmas tree in background masterful']
 
-schedule_parser = lark.Lark(r"""
+SCHEDULE_GRAMMAR = r"""
 !start: (prompt | /[][():]/+)*
 prompt: (emphasized | scheduled | alternate | plain | WHITESPACE)*
 !emphasized: "(" prompt ")"
@@ -22,7 +23,111 @@ alternate: "[" prompt ("|" prompt)+ "]"
 WHITESPACE: /\s+/
 plain: /([^\\\[\]():|]|\\.)+/
 %import common.SIGNED_NUMBER -> NUMBER
-""")
+"""
+
+# Earley is only needed for prompts the fast parser below gives up on, so it's
+# built on first use. lark can't cache Earley grammars, only LALR ones.
+_schedule_parser = None
+
+
+def get_schedule_parser():
+    global _schedule_parser
+    if _schedule_parser is None:
+        _schedule_parser = lark.Lark(SCHEDULE_GRAMMAR)
+    return _schedule_parser
+
+
+re_plain = re.compile(r"([^\\\[\]():|]|\\.)+")
+re_schedule_end = re.compile(r"(\s+)?([+-]?(?:\d+[eE][+-]?\d+|(?:\d+\.\d*|\.\d+)(?:[eE][+-]?\d+)?|\d+))\]")
+
+
+class FastParseUnsupported(Exception):
+    pass
+
+
+def _fast_parse_prompt(text, pos):
+    children = []
+    while pos < len(text):
+        c = text[pos]
+        if c == "(":
+            node, pos = _fast_parse_round(text, pos)
+        elif c == "[":
+            node, pos = _fast_parse_square(text, pos)
+        elif c in ")]:|":
+            break
+        else:
+            m = re_plain.match(text, pos)
+            if m is None:
+                raise FastParseUnsupported()
+            node = lark.Tree("plain", [lark.Token("PLAIN", m.group(0))])
+            pos = m.end()
+        children.append(node)
+    return lark.Tree("prompt", children), pos
+
+
+def _fast_parse_round(text, pos):
+    inner, pos = _fast_parse_prompt(text, pos + 1)
+    if text.startswith(")", pos):
+        return lark.Tree("emphasized", [lark.Token("LPAR", "("), inner, lark.Token("RPAR", ")")]), pos + 1
+    if text.startswith(":", pos):
+        weight, pos = _fast_parse_prompt(text, pos + 1)
+        if text.startswith(")", pos):
+            children = [lark.Token("LPAR", "("), inner, lark.Token("COLON", ":"), weight, lark.Token("RPAR", ")")]
+            return lark.Tree("emphasized", children), pos + 1
+    raise FastParseUnsupported()
+
+
+def _scheduled(before, after, m):
+    whitespace = lark.Token("WHITESPACE", m.group(1)) if m.group(1) else None
+    return lark.Tree("scheduled", [before, after, whitespace, lark.Token("NUMBER", m.group(2))]), m.end()
+
+
+def _fast_parse_square(text, pos):
+    first, pos = _fast_parse_prompt(text, pos + 1)
+    if text.startswith("]", pos):
+        return lark.Tree("emphasized", [lark.Token("LSQB", "["), first, lark.Token("RSQB", "]")]), pos + 1
+
+    if text.startswith("|", pos):
+        options = [first]
+        while text.startswith("|", pos):
+            option, pos = _fast_parse_prompt(text, pos + 1)
+            options.append(option)
+        # at_step only keeps the first part of an alternative, and which part
+        # comes first depends on how Earley happens to split the text
+        if not text.startswith("]", pos) or any(len(option.children) > 1 for option in options):
+            raise FastParseUnsupported()
+        return lark.Tree("alternate", options), pos + 1
+
+    if text.startswith(":", pos):
+        m = re_schedule_end.match(text, pos + 1)
+        if m is not None:
+            return _scheduled(None, first, m)
+        second, pos = _fast_parse_prompt(text, pos + 1)
+        if text.startswith(":", pos):
+            m = re_schedule_end.match(text, pos + 1)
+            if m is not None:
+                return _scheduled(first, second, m)
+
+    raise FastParseUnsupported()
+
+
+def fast_parse_schedule(text):
+    """Recursive descent parser for prompts where every bracket is part of an
+    emphasis, schedule or alternation. Gives the same prompt texts at every
+    step as the Earley parser, and raises FastParseUnsupported for anything
+    else, like stray brackets that Earley has to resolve."""
+    prompt, pos = _fast_parse_prompt(text, 0)
+    if pos != len(text):
+        raise FastParseUnsupported()
+    return lark.Tree("start", [prompt])
+
+
+def parse_schedule(text):
+    try:
+        return fast_parse_schedule(text)
+    except FastParseUnsupported:
+        return get_schedule_parser().parse(text)
+
 
 def get_learned_conditioning_prompt_schedules(prompts, steps):
     """
@@ -91,7 +196,7 @@ def get_learned_conditioning_prompt_schedules(prompts, steps):
 
     def get_schedule(prompt):
         try:
-            tree = schedule_parser.parse(prompt)
+            tree = parse_schedule(prompt)
         except lark.exceptions.LarkError as e:
             if 0:
                 import traceback
@@ -103,6 +208,91 @@ def get_learned_conditioning_prompt_schedules(prompts, steps):
     return [promptdict[prompt] for prompt in prompts]
 
 
+PromptVariants = namedtuple("PromptVariants", ["schedule_length", "texts"])
+
+
+def get_prompt_variants(prompts, steps):
+    """same as get_learned_conditioning_prompt_schedules, but only returns the distinct prompt texts of each schedule, in the
+    order they first appear, and the number of entries the schedule would have had. Each prompt is parsed once and every
+    text is only built once, no matter how many steps alternation spreads it over.
+
+    An empty alternative like [|a] counts as empty text, where get_learned_conditioning_prompt_schedules raises.
+
+    >>> g = lambda p: get_prompt_variants([p], 10)[0]
+    >>> g("test")
+    PromptVariants(schedule_length=1, texts=['test'])
+    >>> g("a[b:[c:d:2]:1]e")
+    PromptVariants(schedule_length=3, texts=['abe', 'ace', 'ade'])
+    >>> g("[a|(b:1.1)]")
+    PromptVariants(schedule_length=10, texts=['a', '(b:1.1)'])
+    >>> g("[a|b] [c|d|e]")
+    PromptVariants(schedule_length=10, texts=['a c', 'b d', 'a e', 'b c', 'a d', 'b e'])
+    """
+
+    def collect_nodes(tree):
+        scheduled = []
+        alternates = []
+        for node in tree.iter_subtrees():
+            if node.data == "scheduled":
+                when = float(node.children[-1])
+                if when < 1:
+                    when *= steps
+                node.children[-1] = min(steps, int(when))
+                scheduled.append(node.children[-1])
+            elif node.data == "alternate":
+                alternates.append(len(node.children))
+        return scheduled, alternates
+
+    def text_at(step, node, out):
+        if isinstance(node, lark.Token):
+            out.append(str(node))
+        elif node.data == "plain":
+            out.append(node.children[0].value)
+        elif node.data == "scheduled":
+            before, after, _, when = node.children
+            chosen = before if step <= when else after
+            if chosen is not None:
+                text_at(step, chosen, out)
+        elif node.data == "alternate":
+            # only the first part of the chosen alternative is used, like in at_step
+            chosen = node.children[(step - 1) % len(node.children)]
+            if chosen.children:
+                text_at(step, chosen.children[0], out)
+        else:
+            for child in node.children:
+                if child is not None:
+                    text_at(step, child, out)
+
+    def get_variants(prompt):
+        try:
+            tree = parse_schedule(prompt)
+        except lark.exceptions.LarkError:
+            return PromptVariants(1, [prompt])
+
+        scheduled, alternates = collect_nodes(tree)
+        all_steps = set([steps] + scheduled)
+        if alternates:
+            all_steps.update(range(1, steps + 1))
+
+        # steps on the same side of every schedule and at the same place in
+        # every alternation produce the same text
+        texts = {}
+        seen = set()
+        for step in sorted(all_steps):
+            key = tuple(step <= when for when in scheduled) + tuple((step - 1) % n for n in alternates)
+            if key in seen:
+                continue
+            seen.add(key)
+            out = []
+            text_at(step, tree, out)
+            texts.setdefault("".join(out), None)
+
+        return PromptVariants(len(all_steps), list(texts))
+
+    variantsdict = {prompt: get_variants(prompt) for prompt in set(prompts)}
+    return [variantsdict[prompt] for prompt in prompts]
+
+
 ScheduledPromptConditioning = namedtuple("ScheduledPromptConditioning", ["end_at_step", "cond"])
 
 
@@ -312,59 +502,131 @@ def parse_prompt_attention(text):
      ['.', 1.1]]
     """
 
-    res = []
+    texts, weights = tokenize_prompt_attention(text)
+    return [[text, weight] for text, weight in zip(texts, weights)]
+
+
+round_bracket_multiplier = 1.1
+square_bracket_multiplier = 1 / 1.1
+
+
+def tokenize_prompt_attention(text, tags_only=False):
+    """same as parse_prompt_attention, but returns the texts and their weights as two separate arrays, the weights being an
+    array('d'). The prompt is scanned once: each piece of text remembers the brackets it's in, and its weight is worked out
+    at the end by applying their multipliers in the same order parse_prompt_attention would have.
+
+    With tags_only, only the texts are returned. Weights still decide which adjacent texts get merged, but prompts without
+    any brackets skip all of the weight bookkeeping.
+
+    >>> tokenize_prompt_attention('a (((house:1.3)) [on] a (hill:0.5), sun, (((sky))).')[0]
+    ['a ', 'house', ' ', 'on', ' a ', 'hill', ', sun, ', 'sky', '.']
+    >>> tokenize_prompt_attention('a BREAK b, c', tags_only=True)
+    ['a', 'BREAK', 'b, c']
+    """
+
+    texts = []
+    scopes = []  # brackets each piece of text is in, round ones first, both in the order they were opened
+    break_positions = []
+    multipliers = []  # per bracket, None while still open
+    close_order = []
     round_brackets = []
     square_brackets = []
+    scope = ()
+    closed = 0
 
-    round_bracket_multiplier = 1.1
-    square_bracket_multiplier = 1 / 1.1
+    for m in re_attention.finditer(text):
+        token, weight = m.group(0, 1)
+        c = token[0]
 
-    def multiply_range(start_position, multiplier):
-        for p in range(start_position, len(res)):
-            res[p][1] *= multiplier
+        if c == '\\':
+            texts.append(token[1:])
+            scopes.append(scope)
+            continue
 
-    for m in re_attention.finditer(text):
-        text = m.group(0)
-        weight = m.group(1)
-
-        if text.startswith('\\'):
-            res.append([text[1:], 1.0])
-        elif text == '(':
-            round_brackets.append(len(res))
-        elif text == '[':
-            square_brackets.append(len(res))
-        elif weight is not None and len(round_brackets) > 0:
-            multiply_range(round_brackets.pop(), float(weight))
-        elif text == ')' and len(round_brackets) > 0:
-            multiply_range(round_brackets.pop(), round_bracket_multiplier)
-        elif text == ']' and len(square_brackets) > 0:
-            multiply_range(square_brackets.pop(), square_bracket_multiplier)
+        if c == '(':
+            stack = round_brackets
+        elif c == '[':
+            stack = square_brackets
         else:
-            parts = re.split(re_break, text)
-            for i, part in enumerate(parts):
+            stack = None
+        if stack is not None:
+            stack.append(len(multipliers))
+            multipliers.append(None)
+            close_order.append(None)
+            scope = (*round_brackets, *square_brackets)
+            continue
+
+        if weight is not None and round_brackets:
+            stack, multiplier = round_brackets, float(weight)
+        elif token == ')' and round_brackets:
+            stack, multiplier = round_brackets, round_bracket_multiplier
+        elif token == ']' and square_brackets:
+            stack, multiplier = square_brackets, square_bracket_multiplier
+        if stack is not None:
+            bracket = stack.pop()
+            multipliers[bracket] = multiplier
+            close_order[bracket] = closed
+            closed += 1
+            scope = (*round_brackets, *square_brackets)
+        elif "BREAK" in token:
+            for i, part in enumerate(re_break.split(token)):
                 if i > 0:
-                    res.append(["BREAK", -1])
-                res.append([part, 1.0])
+                    break_positions.append(len(texts))
+                    texts.append("BREAK")
+                    scopes.append(scope)
+                texts.append(part)
+                scopes.append(scope)
+        else:
+            texts.append(token)
+            scopes.append(scope)
+
+    if tags_only and not multipliers:
+        weights = [1.0] * len(texts)
+    else:
+        # every piece of text in the same brackets ends up with the same weight
+        scope_weights = {(): 1.0}
+        weights = array("d")
+        for scope in scopes:
+            weight = scope_weights.get(scope)
+            if weight is None:
+                weight = 1.0
+                for _, multiplier in sorted((close_order[b], multipliers[b]) for b in scope if multipliers[b] is not None):
+                    weight *= multiplier
+                for b in scope:
+                    if multipliers[b] is None:
+                        weight *= round_bracket_multiplier if b in round_brackets else square_bracket_multiplier
+                scope_weights[scope] = weight
+            weights.append(weight)
+
+    for i in break_positions:
+        weights[i] = -weights[i]
+
+    if len(texts) == 0:
+        texts, weights = [""], [1.0]
 
-    for pos in round_brackets:
-        multiply_range(pos, round_bracket_multiplier)
+    # merge runs of identical weights
+    merged_texts = [texts[0]]
+    merged_weights = array("d", weights[:1])
+    last_weight = weights[0]
+    for i in range(1, len(texts)):
+        weight = weights[i]
+        if weight == last_weight:
+            merged_texts[-1] += texts[i]
+        else:
+            merged_texts.append(texts[i])
+            merged_weights.append(weight)
+            last_weight = weight
 
-    for pos in square_brackets:
-        multiply_range(pos, square_bracket_multiplier)
+    if tags_only:
+        return merged_texts
+    return merged_texts, merged_weights
 
-    if len(res) == 0:
-        res = [["", 1.0]]
 
-    # merge runs of identical weights
-    i = 0
-    while i + 1 < len(res):
-        if res[i][1] == res[i + 1][1]:
-            res[i][0] += res[i + 1][0]
-            res.pop(i + 1)
-        else:
-            i += 1
+def parse_prompt_attention_many(texts, tags_only=False):
+    """tokenize_prompt_attention for each of the texts, parsing repeated ones only once"""
+    results = {text: tokenize_prompt_attention(text, tags_only) for text in set(texts)}
+    return [results[text] for text in texts]
 
-    return res
 
 if __name__ == "__main__":
     import doctest
@@ -1,16 +1,20 @@
-import io
 import os
 import mmap
-import torch
+import sys
 import json
+import errno
+import shutil
+import tempfile
+import time
+import queue
+import threading
+import collections
+import zlib
 import hashlib
-import safetensors
-import safetensors.torch
 
 import sd_models
+import hash_cache
 
-# PyTorch 1.13 and later have _TypedStorage renamed to TypedStorage
-UntypedStorage = torch.storage.UntypedStorage if hasattr(torch.storage, 'UntypedStorage') else torch.storage._UntypedStorage
 
 def read_metadata(filename):
     """Reads the JSON metadata from a .safetensors file"""
@@ -27,6 +31,12 @@ def read_metadata(filename):
 def load_file(filename, device):
     """"Loads a .safetensors file without memory mapping that locks the model file.
     Works around safetensors issue: https://github.com/huggingface/safetensors/issues/164"""
+    # Only loading needs torch, hashing and editing metadata don't
+    import torch
+
+    # PyTorch 1.13 and later have _TypedStorage renamed to TypedStorage
+    UntypedStorage = torch.storage.UntypedStorage if hasattr(torch.storage, 'UntypedStorage') else torch.storage._UntypedStorage
+
     with open(filename, mode="r", encoding="utf8") as file_obj:
         with mmap.mmap(file_obj.fileno(), length=0, access=mmap.ACCESS_READ) as m:
             header = m.read(8)
@@ -41,6 +51,107 @@ def load_file(filename, device):
     return {name: create_tensor(storage, info, offset) for name, info in metadata.items() if name != "__metadata__"}, md
 
 
+def copy_range(src_fd, dst_fd, src_offset, dst_offset, count):
+    """Copies `count` bytes between two files without reading them into
+    Python, with copy_file_range (which can share the blocks on filesystems
+    that support it), else sendfile, else plain reads and writes."""
+    copied = 0
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < count:
+                n = os.copy_file_range(src_fd, dst_fd, count - copied, src_offset + copied, dst_offset + copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError as ex:
+            if ex.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                raise
+
+    if copied < count and hasattr(os, "sendfile"):
+        try:
+            os.lseek(dst_fd, dst_offset + copied, os.SEEK_SET)
+            while copied < count:
+                n = os.sendfile(dst_fd, src_fd, src_offset + copied, min(count - copied, 0x40000000))
+                if n == 0:
+                    break
+                copied += n
+        except OSError as ex:
+            if ex.errno not in (errno.EINVAL, errno.ENOSYS, errno.ENOTSOCK, errno.EOPNOTSUPP):
+                raise
+
+    while copied < count:
+        data = os.pread(src_fd, min(count - copied, READ_SIZE), src_offset + copied)
+        if not data:
+            raise EOFError(f"File ended {count - copied} bytes early")
+        copied += os.pwrite(dst_fd, data, dst_offset + copied)
+
+
+def read_header_bytes(filename):
+    """Reads everything in a .safetensors file before the tensor data, the
+    8-byte header length and the JSON header, as it's stored"""
+    with open(filename, mode="rb") as file_obj:
+        prefix = file_obj.read(8)
+        n = int.from_bytes(prefix, "little")
+        return prefix + file_obj.read(n)
+
+
+def write_metadata(filename, metadata):
+    """Replaces the metadata of a .safetensors file without loading its
+    tensors. If the new header fits in the space of the old one it's padded
+    to the same length and written over it; otherwise the file is written
+    again next to the original with the tensor bytes copied over as they
+    are, and moved into its place. If writing in place fails the old header
+    is written back. Returns whether it was written in place."""
+    original = read_header_bytes(filename)
+    n = len(original) - 8
+    header = json.loads(original[8:])
+
+    header = {"__metadata__": {k: str(v) for k, v in metadata.items()},
+              **{name: info for name, info in header.items() if name != "__metadata__"}}
+    header_bytes = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    if len(header_bytes) <= n:
+        with open(filename, mode="r+b") as file_obj:
+            try:
+                file_obj.seek(8)
+                file_obj.write(header_bytes + b" " * (n - len(header_bytes)))
+                file_obj.flush()
+                os.fsync(file_obj.fileno())
+            except BaseException:
+                file_obj.seek(0)
+                file_obj.write(original)
+                file_obj.flush()
+                os.fsync(file_obj.fileno())
+                raise
+        return True
+
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    prefix = len(header_bytes).to_bytes(8, "little") + header_bytes
+    directory, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=basename + ".", suffix=".tmp")
+    try:
+        with open(filename, mode="rb") as src, os.fdopen(fd, mode="wb") as dst:
+            dst.write(prefix)
+            dst.flush()
+            copy_range(src.fileno(), dst.fileno(), 8 + n, len(prefix), os.fstat(src.fileno()).st_size - 8 - n)
+            os.fsync(dst.fileno())
+        shutil.copymode(filename, tmp_path)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return False
+
+
+def restore_metadata(filename, backup_path):
+    """Writes the metadata saved as JSON by edit_metadata.py or
+    strip_metadata.py back into a .safetensors file with write_metadata"""
+    with open(backup_path, encoding="utf-8") as f:
+        return write_metadata(filename, json.load(f))
+
+
 def hash_file(filename):
     """Hashes a .safetensors file using the new hashing method.
     Only hashes the weights of the model."""
@@ -61,6 +172,63 @@ def hash_file(filename):
     return hash_sha256.hexdigest()
 
 
+# The 64 KB window sd_models.model_hash reads
+LEGACY_HASH_OFFSET = 0x100000
+LEGACY_HASH_LENGTH = 0x10000
+
+# safetensors writes the tensors ordered by dtype, largest first, then by name
+DTYPE_ORDER = {
+    dtype: i for i, dtype in enumerate(
+        ["BOOL", "U8", "I8", "F8_E5M2", "F8_E4M3", "I16", "U16", "F16", "BF16", "I32", "U32", "F32", "C64", "F64", "I64", "U64"]
+    )
+}
+
+
+def read_stripped_window(filename, offset, length):
+    """Returns bytes `offset` to `offset + length` of the file safetensors
+    would write for this model with only its `ss_` metadata, as sd-scripts
+    would have saved it. Only the new header is built; the rest of the
+    window is read from where each tensor is in the original file.
+
+    safetensors writes metadata keys in no particular order. Unless the
+    window reaches into the metadata, that doesn't change the bytes."""
+    with open(filename, mode="rb") as file_obj:
+        n = int.from_bytes(file_obj.read(8), "little")
+        header = json.loads(file_obj.read(n))
+
+        metadata = header.get("__metadata__", {})
+        stripped = {"__metadata__": {k: v for k, v in metadata.items() if k.startswith("ss_")}}
+        tensors = sorted(
+            ((name, info) for name, info in header.items() if name != "__metadata__"),
+            key=lambda item: (-DTYPE_ORDER[item[1]["dtype"]], item[0]),
+        )
+
+        segments = []  # (offset in the stripped file's data, offset in this file, length)
+        position = 0
+        for name, info in tensors:
+            start, stop = info["data_offsets"]
+            stripped[name] = {"dtype": info["dtype"], "shape": info["shape"], "data_offsets": [position, position + stop - start]}
+            segments.append((position, 8 + n + start, stop - start))
+            position += stop - start
+
+        # Same JSON as serde_json writes, padded to 8 bytes
+        header_bytes = json.dumps(stripped, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        header_bytes += b" " * (-len(header_bytes) % 8)
+        prefix = len(header_bytes).to_bytes(8, "little") + header_bytes
+
+        end = offset + length
+        window = bytearray(prefix[offset:end])
+        for position, file_position, size in segments:
+            segment_start = len(prefix) + position
+            lo = max(offset, segment_start)
+            hi = min(end, segment_start + size)
+            if lo < hi:
+                file_obj.seek(file_position + lo - segment_start)
+                window += file_obj.read(hi - lo)
+
+    return bytes(window)
+
+
 def legacy_hash_file(filename):
     """Hashes a model file using the legacy `sd_models.model_hash()` method."""
     hash_sha256 = hashlib.sha256()
@@ -75,13 +243,9 @@ def legacy_hash_file(filename):
     # updates the name/description/etc. The new hashing method fixes this
     # problem by only hashing the region of the file containing the tensors.
     if any(not k.startswith("ss_") for k in metadata):
-      # Strip the user metadata, re-serialize the file as if it were freshly
-      # created from sd-scripts, and hash that with model_hash's behavior.
-      tensors, metadata = load_file(filename, "cpu")
-      metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
-      model_bytes = safetensors.torch.save(tensors, metadata)
-
-      hash_sha256.update(model_bytes[0x100000:0x110000])
+      # Strip the user metadata and hash what model_hash would read from the
+      # file as if it were freshly created from sd-scripts.
+      hash_sha256.update(read_stripped_window(filename, LEGACY_HASH_OFFSET, LEGACY_HASH_LENGTH))
       return hash_sha256.hexdigest()[0:8]
     else:
       # This should work fine with model_hash since when the legacy hashing
@@ -90,13 +254,178 @@ def legacy_hash_file(filename):
       return sd_models.model_hash(filename)
 
 
-DTYPES = {"F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16}
+def full_hash_file(filename):
+    """SHA-256 of the whole file, the hash A1111 shows as AutoV2."""
+    hash_sha256 = hashlib.sha256()
+    blksize = 1024 * 1024
+
+    with open(filename, mode="rb") as file_obj:
+        for chunk in iter(lambda: file_obj.read(blksize), b""):
+            hash_sha256.update(chunk)
+
+    return hash_sha256.hexdigest()
+
+
+# Everything multi_hash_file can compute
+DIGESTS = ("model_hash", "legacy_hash", "sha256", "crc32")
+
+# multi_hash_file reads in blocks of this size, each starting at a multiple of it
+READ_SIZE = 8 * 1024 * 1024
+
+
+def multi_hash_file(filename, digests=DIGESTS, read_size=READ_SIZE):
+    """Computes any of the new hash, the legacy hash, the full SHA-256 and the
+    CRC32 of a model file, reading it once from start to end and feeding the
+    same blocks to every digest. Returns the hashes as a dict, the number of
+    bytes read and the seconds it took."""
+    with open(filename, mode="rb") as file_obj:
+        n = int.from_bytes(file_obj.read(8), "little")
+        metadata = json.loads(file_obj.read(n)).get("__metadata__", {})
+
+    weights_start = n + 8
+    legacy_end = LEGACY_HASH_OFFSET + LEGACY_HASH_LENGTH
+    # Models with user metadata get their legacy hash from the header they
+    # would have without it, like legacy_hash_file
+    stream_legacy = "legacy_hash" in digests and not any(not k.startswith("ss_") for k in metadata)
+
+    weights_sha256 = hashlib.sha256() if "model_hash" in digests else None
+    legacy_sha256 = hashlib.sha256() if stream_legacy else None
+    full_sha256 = hashlib.sha256() if "sha256" in digests else None
+    crc = 0
+
+    buffer = bytearray(read_size)
+    view = memoryview(buffer)
+    position = 0
+    start = time.perf_counter()
+    with open(filename, mode="rb", buffering=0) as file_obj:
+        while True:
+            length = file_obj.readinto(buffer)
+            if not length:
+                break
+            block = view[:length]
+            end = position + length
+            if full_sha256 is not None:
+                full_sha256.update(block)
+            if weights_sha256 is not None and end > weights_start:
+                weights_sha256.update(block[max(weights_start - position, 0):])
+            if legacy_sha256 is not None and position < legacy_end and end > LEGACY_HASH_OFFSET:
+                legacy_sha256.update(block[max(LEGACY_HASH_OFFSET - position, 0):legacy_end - position])
+            if "crc32" in digests:
+                crc = zlib.crc32(block, crc)
+            position = end
+    seconds = time.perf_counter() - start
+
+    hashes = {}
+    if weights_sha256 is not None:
+        hashes["model_hash"] = weights_sha256.hexdigest()
+    if "legacy_hash" in digests:
+        if stream_legacy:
+            hashes["legacy_hash"] = legacy_sha256.hexdigest()[0:8]
+        else:
+            hashes["legacy_hash"] = hashlib.sha256(
+                read_stripped_window(filename, LEGACY_HASH_OFFSET, LEGACY_HASH_LENGTH)
+            ).hexdigest()[0:8]
+    if full_sha256 is not None:
+        hashes["sha256"] = full_sha256.hexdigest()
+    if "crc32" in digests:
+        hashes["crc32"] = f"{crc:08x}"
+    return hashes, position, seconds
+
+
+def get_hashes(filename, cache=None, verify=False):
+    """Returns the new hash, the legacy hash, the full SHA-256 and the CRC32 of
+    a model file as a dict, and how fast it was read in MB/s. With a
+    hash_cache.HashCache they're only computed if the file changed since it
+    was last hashed, and the speed is None. `verify` hashes the file again
+    regardless and reports if the cached hashes were wrong."""
+    key = hash_cache.file_key(filename) if cache is not None else None
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None and not verify:
+        return cached, None
+
+    hashes, size, seconds = multi_hash_file(filename)
+    if cached is not None and cached != hashes:
+        print(f"CACHED HASH MISMATCH - {filename} ({cached} != {hashes})", file=sys.stderr)
+    if cache is not None:
+        cache.put(key, hashes)
+    return hashes, size / (1024 * 1024) / seconds if seconds else None
+
+
+def hash_files(filenames, cache=None, verify=False, jobs=4, reads_per_device=2):
+    """get_hashes for many files at once on `jobs` threads, which hash in
+    parallel since hashlib releases the GIL. Yields (filename, hashes, speed)
+    as each file finishes. The largest files are started first, and at most
+    `reads_per_device` files are read at the same time from each device, so
+    the threads spread over disks instead of competing for one."""
+    pending = sorted(
+        ((os.stat(filename), filename) for filename in filenames),
+        key=lambda item: item[0].st_size,
+        reverse=True,
+    )
+    pending = [(st.st_dev, filename) for st, filename in pending]
+    reading = collections.Counter()  # device -> files being read from it
+    condition = threading.Condition()
+    results = queue.Queue()
+    done = object()
+
+    def next_file():
+        with condition:
+            while pending:
+                for i, (device, filename) in enumerate(pending):
+                    if reading[device] < reads_per_device:
+                        del pending[i]
+                        reading[device] += 1
+                        return device, filename
+                condition.wait()
+            return None
+
+    def work():
+        try:
+            while (item := next_file()) is not None:
+                device, filename = item
+                try:
+                    results.put((filename, *get_hashes(filename, cache, verify)))
+                except Exception as ex:
+                    results.put(ex)
+                finally:
+                    with condition:
+                        reading[device] -= 1
+                        condition.notify_all()
+        finally:
+            results.put(done)
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(max(1, min(jobs, len(pending))))]
+    for thread in threads:
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            result = results.get()
+            if result is done:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+    finally:
+        # Stopped early or failed: let the files being hashed finish, skip the rest
+        with condition:
+            pending.clear()
+            condition.notify_all()
+        for thread in threads:
+            thread.join()
+
+
+DTYPES = {"F32": "float32", "F16": "float16", "BF16": "bfloat16"}
 
 
 def create_tensor(storage, info, offset):
     """Creates a tensor without holding on to an open handle to the parent model
     file."""
-    dtype = DTYPES[info["dtype"]]
+    import torch
+
+    dtype = getattr(torch, DTYPES[info["dtype"]])
     shape = info["shape"]
     start, stop = info["data_offsets"]
     return torch.asarray(storage[start + offset : stop + offset], dtype=torch.uint8).view(dtype=dtype).reshape(shape).clone().detach()
@@ -1,141 +1,99 @@
 from PIL import Image
-import PIL
-import warnings
 import gzip
-import json
-from pprint import pp
 import sys
+import numpy as np
 
-def read_info_from_image_stealth(image):
-    # geninfo, items = original_read_info_from_image(image)
-    # possible_sigs = {'stealth_pnginfo', 'stealth_pngcomp', 'stealth_rgbinfo', 'stealth_rgbcomp'}
+# Each signature is 15 bytes long, stored one bit per pixel in the alpha
+# channel or three bits per pixel in the RGB channels. It is followed by a
+# 32-bit big-endian payload length (in bits), then the payload itself.
+SIGNATURE_BITS = len("stealth_pnginfo") * 8
+PARAM_LEN_BITS = 32
+HEADER_BITS = SIGNATURE_BITS + PARAM_LEN_BITS
+
+# signature -> compressed
+ALPHA_SIGNATURES = {b"stealth_pnginfo": False, b"stealth_pngcomp": True}
+RGB_SIGNATURES = {b"stealth_rgbinfo": False, b"stealth_rgbcomp": True}
+
+ALPHA_CHANNELS = slice(3, 4)
+RGB_CHANNELS = slice(0, 3)
 
-    # respecting original pnginfo
-    # if geninfo is not None:
-    #     return geninfo, items
 
-    # trying to read stealth pnginfo
+def read_lsb_bits(image, channels, num_pixels):
+    """Returns the least significant bits of the given channels for the first
+    `num_pixels` pixels, in the column-major order stealth pnginfo is written
+    in. Only the columns that are needed get converted to an array."""
     width, height = image.size
-    pixels = image.load()
-
-    has_alpha = True if image.mode == 'RGBA' else False
-    mode = None
-    compressed = False
-    binary_data = ''
-    buffer_a = ''
-    buffer_rgb = ''
-    index_a = 0
-    index_rgb = 0
-    sig_confirmed = False
-    confirming_signature = True
-    reading_param_len = False
-    reading_param = False
-    read_end = False
-    for x in range(width):
-        for y in range(height):
-            if has_alpha:
-                r, g, b, a = pixels[x, y]
-                buffer_a += str(a & 1)
-                index_a += 1
-            else:
-                r, g, b = pixels[x, y]
-            buffer_rgb += str(r & 1)
-            buffer_rgb += str(g & 1)
-            buffer_rgb += str(b & 1)
-            index_rgb += 3
-            if confirming_signature:
-                if index_a == len('stealth_pnginfo') * 8:
-                    decoded_sig = bytearray(int(buffer_a[i:i + 8], 2) for i in
-                                            range(0, len(buffer_a), 8)).decode('utf-8', errors='ignore')
-                    if decoded_sig in {'stealth_pnginfo', 'stealth_pngcomp'}:
-                        confirming_signature = False
-                        sig_confirmed = True
-                        reading_param_len = True
-                        mode = 'alpha'
-                        if decoded_sig == 'stealth_pngcomp':
-                            compressed = True
-                        buffer_a = ''
-                        index_a = 0
-                    else:
-                        read_end = True
-                        break
-                elif index_rgb == len('stealth_pnginfo') * 8:
-                    decoded_sig = bytearray(int(buffer_rgb[i:i + 8], 2) for i in
-                                            range(0, len(buffer_rgb), 8)).decode('utf-8', errors='ignore')
-                    if decoded_sig in {'stealth_rgbinfo', 'stealth_rgbcomp'}:
-                        confirming_signature = False
-                        sig_confirmed = True
-                        reading_param_len = True
-                        mode = 'rgb'
-                        if decoded_sig == 'stealth_rgbcomp':
-                            compressed = True
-                        buffer_rgb = ''
-                        index_rgb = 0
-            elif reading_param_len:
-                if mode == 'alpha':
-                    if index_a == 32:
-                        param_len = int(buffer_a, 2)
-                        reading_param_len = False
-                        reading_param = True
-                        buffer_a = ''
-                        index_a = 0
-                else:
-                    if index_rgb == 33:
-                        pop = buffer_rgb[-1]
-                        buffer_rgb = buffer_rgb[:-1]
-                        param_len = int(buffer_rgb, 2)
-                        reading_param_len = False
-                        reading_param = True
-                        buffer_rgb = pop
-                        index_rgb = 1
-            elif reading_param:
-                if mode == 'alpha':
-                    if index_a == param_len:
-                        binary_data = buffer_a
-                        read_end = True
-                        break
-                else:
-                    if index_rgb >= param_len:
-                        diff = param_len - index_rgb
-                        if diff < 0:
-                            buffer_rgb = buffer_rgb[:diff]
-                        binary_data = buffer_rgb
-                        read_end = True
-                        break
-            else:
-                # impossible
-                read_end = True
-                break
-        if read_end:
-            break
-    if sig_confirmed and binary_data != '':
-        # Convert binary string to UTF-8 encoded text
-        byte_data = bytearray(int(binary_data[i:i + 8], 2) for i in range(0, len(binary_data), 8))
-        try:
-            if compressed:
-                decoded_data = gzip.decompress(bytes(byte_data)).decode('utf-8')
-            else:
-                decoded_data = byte_data.decode('utf-8', errors='ignore')
-            geninfo = decoded_data
-        except:
-            pass
-
-    result = json.loads(geninfo)
-    if "Comment" in result:
-        result["Comment"] = json.loads(result["Comment"])
-    return result, geninfo
-
-# LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
-# original_read_info_from_image = images.read_info_from_image
-# images.read_info_from_image = read_info_from_image_stealth
-# generation_parameters_copypaste.send_image_and_dimensions = send_rgb_image_and_dimension
-# original_resize_image = images.resize_image
-# images.resize_image = stealth_resize_image
-
-# script_callbacks.on_ui_settings(on_ui_settings)
-# script_callbacks.on_before_image_saved(add_stealth_pnginfo)
-# script_callbacks.on_after_component(on_after_component_change_pnginfo_image_mode)
-
-with Image.open(sys.argv[1]) as image:
-    result, geninfo = read_info_from_image_stealth(image)
-    print(geninfo)
+    columns = min(width, -(-num_pixels // height))
+    region = np.asarray(image.crop((0, 0, columns, height)))
+    plane = region[:, :, channels].transpose(1, 0, 2).reshape(-1)
+    return plane[: num_pixels * (channels.stop - channels.start)] & 1
+
+
+def bits_to_bytes(bits):
+    """Packs a bit array into bytes. A trailing partial byte is read as a
+    plain binary number, the same as the original string-based decoder."""
+    whole = len(bits) - len(bits) % 8
+    data = np.packbits(bits[:whole]).tobytes()
+    if whole != len(bits):
+        data += bytes([int("".join(str(b) for b in bits[whole:]), 2)])
+    return data
+
+
+def read_info_from_image_stealth(image):
+    """Decodes stealth pnginfo from the alpha channel (stealth_pnginfo,
+    stealth_pngcomp) or the RGB channels (stealth_rgbinfo, stealth_rgbcomp)
+    of an image. Returns the embedded text, or None if there isn't any."""
+    if image.mode not in ("RGB", "RGBA"):
+        return None
+
+    width, height = image.size
+    total_pixels = width * height
+    has_alpha = image.mode == "RGBA"
+
+    # The RGB signature is complete after 40 pixels and the alpha one after
+    # 120, so the RGB one gets checked first.
+    rgb_sig_pixels = SIGNATURE_BITS // 3
+    if total_pixels < rgb_sig_pixels:
+        return None
+
+    signature = bits_to_bytes(read_lsb_bits(image, RGB_CHANNELS, rgb_sig_pixels))
+    if signature in RGB_SIGNATURES:
+        compressed = RGB_SIGNATURES[signature]
+        channels = RGB_CHANNELS
+        bits_per_pixel = 3
+    elif has_alpha and total_pixels >= SIGNATURE_BITS:
+        signature = bits_to_bytes(read_lsb_bits(image, ALPHA_CHANNELS, SIGNATURE_BITS))
+        if signature not in ALPHA_SIGNATURES:
+            return None
+        compressed = ALPHA_SIGNATURES[signature]
+        channels = ALPHA_CHANNELS
+        bits_per_pixel = 1
+    else:
+        return None
+
+    # The payload ends on the first pixel after the length field whose bits
+    # reach the end of it.
+    header_pixels = -(-HEADER_BITS // bits_per_pixel)
+    if total_pixels <= header_pixels:
+        return None
+
+    header = read_lsb_bits(image, channels, header_pixels)
+    param_len = int.from_bytes(bits_to_bytes(header[SIGNATURE_BITS:HEADER_BITS]), "big")
+    payload_pixels = max(header_pixels + 1, -(-(HEADER_BITS + param_len) // bits_per_pixel))
+    if param_len == 0 or payload_pixels > total_pixels:
+        return None
+
+    bits = read_lsb_bits(image, channels, payload_pixels)
+    byte_data = bits_to_bytes(bits[HEADER_BITS:HEADER_BITS + param_len])
+    try:
+        if compressed:
+            return gzip.decompress(byte_data).decode("utf-8")
+        return byte_data.decode("utf-8", errors="ignore")
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    with Image.open(sys.argv[1]) as image:
+        geninfo = read_info_from_image_stealth(image)
+        print(geninfo)
@@ -0,0 +1,88 @@
+import collections
+import hashlib
+import json
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    digest BLOB PRIMARY KEY,
+    tags TEXT NOT NULL,
+    positive TEXT,
+    negative TEXT
+) WITHOUT ROWID;
+"""
+
+
+class TagCache:
+    """Results of read_tags keyed by a digest of (prompt_type, parameters).
+
+    Keeps up to `maxsize` entries in memory, least recently used first out.
+    With a `path` the entries are also stored in SQLite so that separate
+    import and retag runs share them. `salt` goes into every digest, change it
+    whenever the way tags are parsed changes so stale entries are never hit."""
+
+    def __init__(self, maxsize=4096, path=None, salt=b""):
+        self.maxsize = maxsize
+        self.path = path
+        self.salt = salt
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+        if path is not None:
+            # Parse worker processes each open their own connection, so every
+            # write is committed on its own instead of holding a transaction
+            self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+
+    def digest(self, prompt_type, parameters):
+        h = hashlib.blake2b(self.salt, digest_size=16)
+        h.update(prompt_type.encode("utf-8"))
+        h.update(b"\0")
+        h.update(parameters.encode("utf-8", "surrogatepass"))
+        return h.digest()
+
+    def get(self, prompt_type, parameters):
+        """Returns (tags, positive, negative) or None. The tags are a new set
+        the caller is free to modify."""
+        digest = self.digest(prompt_type, parameters)
+        entry = self.entries.get(digest)
+        if entry is not None:
+            self.entries.move_to_end(digest)
+        elif self.conn is not None:
+            row = self.conn.execute(
+                "SELECT tags, positive, negative FROM tags WHERE digest = ?", (digest,)
+            ).fetchone()
+            if row is not None:
+                entry = (frozenset(json.loads(row[0])), row[1], row[2])
+                self._remember(digest, entry)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        tags, positive, negative = entry
+        return set(tags), positive, negative
+
+    def put(self, prompt_type, parameters, tags, positive, negative):
+        digest = self.digest(prompt_type, parameters)
+        self._remember(digest, (frozenset(tags), positive, negative))
+        if self.conn is not None:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)",
+                (digest, json.dumps(sorted(tags)), positive, negative),
+            )
+
+    def _remember(self, digest, entry):
+        self.entries[digest] = entry
+        self.entries.move_to_end(digest)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""End-to-end benchmark of import_to_hydrus.py against a fake Hydrus.
+
+Writes a directory of synthetic A1111 images, imports it into a FakeHydrus
+with the given latency and error rate, imports it again (everything should be
+skipped by the ledger), then retags everything. Reports files/second and the
+number of requests each stage made:
+
+    python tests/bench_import.py --files 1000 --latency 2 -- --jobs 4 --upload-workers 2
+
+Arguments after `--` are passed on to the import command.
+"""
+
+import sys
+import os.path
+import argparse
+import collections
+import contextlib
+import io
+import random
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+import import_to_hydrus
+import bench_parsers
+from fake_hydrus import FakeHydrus
+
+FILES_PER_DIRECTORY = 100
+
+
+def make_images(directory, count, seed=0):
+    """Writes `count` PNGs with different A1111 infotext into date-named
+    subdirectories like the webui does"""
+    rng = random.Random(seed)
+    image = bench_parsers.make_image("RGB", 64, 96)
+    for i in range(count):
+        subdirectory = os.path.join(directory, f"2024-01-{i // FILES_PER_DIRECTORY + 1:02}")
+        os.makedirs(subdirectory, exist_ok=True)
+        data = bench_parsers.make_png(image, {"parameters": bench_parsers.make_a1111_infotext(rng)})
+        with open(os.path.join(subdirectory, f"{i:05}.png"), "wb") as f:
+            f.write(data)
+
+
+def run_stage(hydrus, command, verbose=False):
+    """Runs import_to_hydrus.py with `command` against the fake Hydrus.
+    Returns the seconds it took, the requests it made and the error it
+    stopped with, if any."""
+    arguments = import_to_hydrus.parser.parse_args(["--api-url", hydrus.url, "--api_key", "fake"] + command)
+    # every stage starts without parsed tags, like a new process would
+    import_to_hydrus.open_tag_cache(None)
+
+    before = collections.Counter(hydrus.requests)
+    error = None
+    start = time.perf_counter()
+    with contextlib.ExitStack() as output:
+        if not verbose:
+            sink = io.StringIO()
+            output.enter_context(contextlib.redirect_stdout(sink))
+            output.enter_context(contextlib.redirect_stderr(sink))
+        try:
+            import_to_hydrus.main(arguments)
+        except (Exception, SystemExit) as ex:
+            error = ex
+    elapsed = time.perf_counter() - start
+
+    return elapsed, hydrus.requests - before, error
+
+
+def print_stage(name, files, elapsed, requests, error):
+    print(f"{name:<10} {elapsed:>8.2f} s {files / elapsed:>10.1f} files/s {sum(requests.values()):>7} requests")
+    for path, count in sorted(requests.items()):
+        print(f"    {path:<28} {count:>7}")
+    if error is not None:
+        print(f"    !!! stopped with {type(error).__name__}: {error}")
+
+
+parser = argparse.ArgumentParser(description="Benchmark import_to_hydrus.py against a fake Hydrus")
+parser.add_argument("--files", "-n", type=int, default=500, help="Number of images to import")
+parser.add_argument("--latency", "-l", type=float, default=0.0, help="Milliseconds spent on every request")
+parser.add_argument("--error-rate", "-e", type=float, default=0.0, help="Fraction of requests that fail")
+parser.add_argument("--error-status", type=int, default=503, help="HTTP status of failed requests (503 is DatabaseLocked)")
+parser.add_argument("--error-path", action="append", dest="error_paths", help="Only fail requests to this path (can be given more than once)")
+parser.add_argument("--no-retag", action="store_false", dest="retag", help="Skip the retag stage")
+parser.add_argument("--verbose", "-v", action="store_true", help="Show the output of import_to_hydrus.py")
+parser.add_argument("--seed", type=int, default=0, help="Seed for the images and injected errors")
+parser.add_argument("import_arguments", nargs="*", help="Passed on to the import command")
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as tmpdir, FakeHydrus(
+        latency=args.latency / 1000,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        error_paths=args.error_paths,
+        seed=args.seed,
+    ) as hydrus:
+        images = os.path.join(tmpdir, "outputs")
+        make_images(images, args.files, args.seed)
+
+        # the ledger is created in the working directory
+        cwd = os.getcwd()
+        os.chdir(tmpdir)
+        try:
+            stages = [("import", ["import", images] + args.import_arguments),
+                      ("reimport", ["import", images] + args.import_arguments)]
+            if args.retag:
+                stages.append(("retag", ["retag", "prompt_type:a1111"]))
+            for name, command in stages:
+                print_stage(name, args.files, *run_stage(hydrus, command, args.verbose))
+        finally:
+            os.chdir(cwd)
+
+        with_notes = sum(1 for file in hydrus.files.values() if "parameters" in file.notes)
+        print(f"{len(hydrus.files)}/{args.files} files in Hydrus, {with_notes} with notes")
+        if hydrus.errors:
+            print(f"{sum(hydrus.errors.values())} errors injected: "
+                  + ", ".join(f"{path} {count}" for path, count in sorted(hydrus.errors.items())))
+        return 0 if with_notes == args.files else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
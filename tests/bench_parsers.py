@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+"""Throughput benchmark for the metadata parsers used by import_to_hydrus.py.
+
+Generates synthetic PNGs for each kind of metadata the importer understands,
+times every stage of getting from PNG bytes to tags, and compares the results
+against a stored baseline so that parser regressions show up:
+
+    python tests/bench_parsers.py
+    python tests/bench_parsers.py --save-baseline
+
+Timings depend on the machine, so save a baseline of your own before changing
+the parsers and compare against that.
+"""
+
+import sys
+import os.path
+import argparse
+import gzip
+import io
+import itertools
+import json
+import random
+import statistics
+import time
+
+import numpy as np
+from PIL import Image, PngImagePlugin
+
+sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
+import import_to_hydrus
+import tag_cache
+from stealth_pnginfo import read_info_from_image_stealth
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "bench_parsers_baseline.json")
+# Stages faster than this are mostly timer noise and aren't compared
+MIN_COMPARED_MS = 0.5
+
+TAGS = [
+    "1girl", "solo", "long hair", "looking at viewer", "smile", "blush", "short hair",
+    "open mouth", "bangs", "blue eyes", "skirt", "blonde hair", "simple background",
+    "brown hair", "shirt", "black hair", "thighhighs", "hair ornament", "red eyes",
+    "long sleeves", "white background", "dress", "holding", "ribbon", "twintails",
+    "jewelry", "school uniform", "standing", "sitting", "outdoors", "sky", "cloud",
+    "day", "tree", "flower", "water", "night", "starry sky", "city lights", "rain",
+    "masterpiece", "best quality", "highres", "absurdres", "detailed background",
+    "depth of field", "cinematic lighting", "from side", "upper body", "full body",
+    "cowboy shot", "hat", "gloves", "boots", "jacket", "scarf", "glasses", "wings",
+    "animal ears", "tail", "sword", "umbrella", "book", "cup", "window", "indoors",
+]
+LORAS = ["add_detail", "lcm_lora_sd15", "style_watercolor", "char_example_v2"]
+
+
+def make_tag(rng, balanced=True):
+    tag = rng.choice(TAGS)
+    roll = rng.random()
+    if roll < 0.15:
+        return f"({tag}:{rng.choice(['0.8', '1.1', '1.2', '1.35'])})"
+    if roll < 0.25:
+        depth = rng.randint(1, 3)
+        return "(" * depth + tag + ")" * (depth if balanced else rng.randint(1, 3))
+    if roll < 0.30:
+        return f"[{tag}]"
+    if roll < 0.36:
+        return f"[{tag}:{rng.choice(TAGS)}:{rng.choice(['0.3', '0.5', '12'])}]"
+    if roll < 0.40:
+        return f"[{tag}|{rng.choice(TAGS)}]"
+    return tag
+
+
+def make_a1111_prompt(rng, num_tags, balanced=True):
+    lines = []
+    for _ in range(num_tags // 10):
+        lines.append(", ".join(make_tag(rng, balanced) for _ in range(10)) + ",")
+        roll = rng.random()
+        if roll < 0.3:
+            lines.append("BREAK")
+        elif roll < 0.45:
+            lines.append("AND")
+    lines.append(f"<lora:{rng.choice(LORAS)}:0.{rng.randint(3, 9)}>")
+    return "\n".join(lines)
+
+
+def make_a1111_settings(rng):
+    return (
+        f"Steps: {rng.randint(20, 40)}, Sampler: DPM++ 2M Karras, CFG scale: 7, "
+        f"Seed: {rng.randint(0, 2**32)}, Size: 512x768, Model hash: 0873291ac5, "
+        "Model: AbyssOrangeMix2_nsfw, Denoising strength: 0.55, Clip skip: 2, ENSD: 31337, "
+        "Hires upscale: 2, Hires upscaler: Latent, "
+        "AddNet Enabled: True, AddNet Module 1: LoRA, "
+        "AddNet Model 1: example_lora(6e1e9b1e5ab2), AddNet Weight A 1: 0.8"
+    )
+
+
+def make_a1111_infotext(rng, num_tags=120, balanced=True):
+    positive = make_a1111_prompt(rng, num_tags, balanced)
+    negative = ", ".join(make_tag(rng) for _ in range(30))
+    return f"{positive}\nNegative prompt: {negative}\n{make_a1111_settings(rng)}"
+
+
+def make_xyz_grid_infotext(rng):
+    positive = make_a1111_prompt(rng, 40)
+    negative = ", ".join(rng.choice(TAGS) for _ in range(15))
+    seeds = ",".join(str(rng.randint(0, 2**32)) for _ in range(8))
+    return (
+        f"{positive}\nNegative prompt: {negative}\n{make_a1111_settings(rng)}, "
+        "Script: X/Y/Z plot, X Type: CFG Scale, X Values: \"4, 5.5, 7, 8.5, 10\", "
+        f"Y Type: Seed, Y Values: \"{seeds}\", Z Type: Sampler, "
+        "Z Values: \"Euler a, DPM++ 2M Karras, DDIM\""
+    )
+
+
+def make_comfyui_graph(rng, num_nodes):
+    graph = {}
+    ids = itertools.count(1)
+
+    def add(class_type, inputs):
+        node_id = str(next(ids))
+        graph[node_id] = {"class_type": class_type, "inputs": inputs}
+        return node_id
+
+    checkpoint = add("CheckpointLoaderSimple", {"ckpt_name": "model.safetensors"})
+    while len(graph) < num_nodes:
+        positive = add("CLIPTextEncode", {"text": make_a1111_prompt(rng, 30), "clip": [checkpoint, 1]})
+        negative = add("CLIPTextEncode", {"text": ", ".join(rng.choice(TAGS) for _ in range(10)), "clip": [checkpoint, 1]})
+        latent = add("EmptyLatentImage", {"width": 512, "height": 768, "batch_size": 1})
+        sampler = add("KSampler", {
+            "seed": rng.randint(0, 2**32), "steps": 20, "cfg": 7.0, "sampler_name": "euler",
+            "scheduler": "normal", "denoise": 1.0, "model": [checkpoint, 0],
+            "positive": [positive, 0], "negative": [negative, 0], "latent_image": [latent, 0],
+        })
+        decoded = add("VAEDecode", {"samples": [sampler, 0], "vae": [checkpoint, 2]})
+        for _ in range(rng.randint(2, 6)):
+            decoded = add(rng.choice(["ImageScale", "ImageBlur", "ImageSharpen", "Reroute"]), {"image": [decoded, 0]})
+        add("SaveImage", {"filename_prefix": "ComfyUI", "images": [decoded, 0]})
+    return json.dumps(graph)
+
+
+def make_nai_info(rng):
+    prompt = ", ".join(
+        "{" * rng.randint(0, 2) + rng.choice(TAGS) + "}" * rng.randint(0, 2)
+        for _ in range(60)
+    )
+    prompt = prompt.replace("{}", "")
+    comment = {
+        "prompt": prompt,
+        "steps": 28, "height": 1216, "width": 832, "scale": 5.0, "uncond_scale": 1.0,
+        "cfg_rescale": 0.0, "seed": rng.randint(0, 2**32), "n_samples": 1, "hide_debug_overlay": False,
+        "noise_schedule": "native", "sampler": "k_euler_ancestral", "controlnet_strength": 1.0,
+        "controlnet_model": None, "dynamic_thresholding": False, "dynamic_thresholding_percentile": 0.999,
+        "dynamic_thresholding_mimic_scale": 10.0, "sm": False, "sm_dyn": False, "skip_cfg_below_sigma": 0.0,
+        "lora_unet_weights": None, "lora_clip_weights": None,
+        "uc": "nsfw, lowres, {bad}, error, fewer, extra, missing, worst quality, jpeg artifacts",
+        "request_type": "PromptGenerateRequest", "signed_hash": "x" * 88,
+    }
+    return {
+        "Title": "AI generated image",
+        "Description": prompt,
+        "Software": "NovelAI",
+        "Source": "Stable Diffusion XL C1E1DE52",
+        "Generation time": "6.5",
+        "Comment": json.dumps(comment),
+    }
+
+
+def make_image(mode, width, height):
+    # A gradient compresses like a real picture instead of like noise
+    y, x = np.indices((height, width))
+    data = np.stack([(x + y) % 256, (x * 2) % 256, (y * 3) % 256, np.full_like(x, 255)], axis=-1)
+    return Image.fromarray(data[:, :, :len(mode)].astype(np.uint8), mode)
+
+
+def add_stealth_payload(image, text, mode="alpha", compressed=False):
+    """Same encoding as the stealth-pnginfo webui extension"""
+    signature = f"stealth_{'png' if mode == 'alpha' else 'rgb'}{'comp' if compressed else 'info'}"
+    payload = text.encode("utf-8")
+    if compressed:
+        payload = gzip.compress(payload)
+    bits = np.unpackbits(np.frombuffer(
+        signature.encode("utf-8") + (len(payload) * 8).to_bytes(4, "big") + payload, dtype=np.uint8
+    ))
+
+    data = np.array(image)
+    channels = slice(3, 4) if mode == "alpha" else slice(0, 3)
+    # column-major, like the extension writes it
+    plane = data[:, :, channels].transpose(1, 0, 2).reshape(-1)
+    plane[:len(bits)] = (plane[:len(bits)] & 0xFE) | bits
+    data[:, :, channels] = plane.reshape(data.shape[1], data.shape[0], -1).transpose(1, 0, 2)
+    return Image.fromarray(data, image.mode)
+
+
+def make_png(image, text_chunks=None):
+    pnginfo = PngImagePlugin.PngInfo()
+    for key, value in (text_chunks or {}).items():
+        pnginfo.add_text(key, value)
+    buf = io.BytesIO()
+    image.save(buf, "PNG", pnginfo=pnginfo)
+    return buf.getvalue()
+
+
+def make_cases(seed=0, variants=8):
+    """Returns {case name: [PNG bytes, ...]}, each PNG with different
+    metadata so the results can't be cached between them"""
+    rng = random.Random(seed)
+    small = make_image("RGB", 64, 96)
+    cases = {name: [] for name in ("a1111", "a1111_unbalanced", "a1111_xyz_grid", "comfyui", "nai_v3", "stealth_alpha", "stealth_rgb")}
+    for _ in range(variants):
+        cases["a1111"].append(make_png(small, {"parameters": make_a1111_infotext(rng)}))
+        # stray brackets send the prompt through the slow path of the schedule parser
+        cases["a1111_unbalanced"].append(make_png(small, {"parameters": make_a1111_infotext(rng, 40, balanced=False)}))
+        cases["a1111_xyz_grid"].append(make_png(small, {"parameters": make_xyz_grid_infotext(rng)}))
+        graph = make_comfyui_graph(rng, 300)
+        cases["comfyui"].append(make_png(small, {"prompt": graph, "workflow": json.dumps({"nodes": json.loads(graph)})}))
+        cases["nai_v3"].append(make_png(small, make_nai_info(rng)))
+        payload = json.dumps(make_nai_info(rng))
+        cases["stealth_alpha"].append(make_png(add_stealth_payload(make_image("RGBA", 832, 1216), payload, "alpha", True)))
+        cases["stealth_rgb"].append(make_png(add_stealth_payload(make_image("RGB", 832, 1216), payload, "rgb", False)))
+    return cases
+
+
+def timed(fn, *args):
+    start = time.perf_counter_ns()
+    result = fn(*args)
+    return result, time.perf_counter_ns() - start
+
+
+def run_case(pngs, iterations):
+    """Runs every PNG through the importer's stages `iterations` times.
+    Returns {stage: [seconds, ...]} and the files/second of the whole path."""
+    stages = {}
+
+    def record(stage, ns):
+        stages.setdefault(stage, []).append(ns / 1e9)
+
+    total_ns = 0
+    for i in range(iterations):
+        data = pngs[i % len(pngs)]
+        image, open_ns = timed(Image.open, io.BytesIO(data))
+        (prompt_type, params), parameters_ns = timed(import_to_hydrus.read_parameters, image)
+        (tags, _, _), tags_ns = timed(import_to_hydrus.read_tags, prompt_type, params)
+        if tags is None:
+            raise RuntimeError(f"no tags were read from a {prompt_type} image")
+        record("open", open_ns)
+        record("read_parameters", parameters_ns)
+        record("read_tags", tags_ns)
+        total_ns += open_ns + parameters_ns + tags_ns
+
+        # the stages read_parameters and read_tags spend most of their time in
+        if prompt_type == "a1111":
+            _, ns = timed(import_to_hydrus.parse_a1111_prompt, params)
+            record("parse_a1111_prompt", ns)
+        if "parameters" not in image.info and "prompt" not in image.info and "Comment" not in image.info:
+            _, ns = timed(read_info_from_image_stealth, Image.open(io.BytesIO(data)))
+            record("read_info_from_image_stealth", ns)
+
+    return stages, iterations / (total_ns / 1e9)
+
+
+def summarize(stages, files_per_second):
+    return {
+        "files_per_second": files_per_second,
+        "stages": {
+            stage: {
+                "median_ms": statistics.median(times) * 1000,
+                "p95_ms": sorted(times)[int(len(times) * 0.95) - 1 if len(times) > 1 else 0] * 1000,
+            }
+            for stage, times in stages.items()
+        },
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Prints the results next to the baseline and returns the names of the
+    measurements that got slower by more than `tolerance`"""
+    regressions = []
+    for case, result in results.items():
+        base = baseline.get(case)
+        line = f"{case:<16} {result['files_per_second']:>10.1f} files/s"
+        if base:
+            ratio = result["files_per_second"] / base["files_per_second"]
+            line += f"  ({ratio:.2f}x baseline)"
+            if ratio < 1 / (1 + tolerance):
+                regressions.append(f"{case} files/s")
+        print(line)
+
+        for stage, timing in result["stages"].items():
+            line = f"    {stage:<30} median {timing['median_ms']:>9.3f} ms  p95 {timing['p95_ms']:>9.3f} ms"
+            base_timing = base and base["stages"].get(stage)
+            if base_timing and max(timing["median_ms"], base_timing["median_ms"]) >= MIN_COMPARED_MS:
+                ratio = timing["median_ms"] / base_timing["median_ms"]
+                line += f"  ({ratio:.2f}x baseline)"
+                if ratio > 1 + tolerance:
+                    regressions.append(f"{case} {stage}")
+            print(line)
+    return regressions
+
+
+parser = argparse.ArgumentParser(description="Benchmark the metadata parsers of import_to_hydrus.py")
+parser.add_argument("--iterations", "-n", type=int, default=25, help="Files to parse per case and round")
+parser.add_argument("--rounds", "-r", type=int, default=3, help="Rounds per case, the fastest one is kept")
+parser.add_argument("--case", "-c", action="append", help="Only run this case (can be given more than once)")
+parser.add_argument("--baseline", "-b", type=str, default=DEFAULT_BASELINE, help="Baseline file to compare against")
+parser.add_argument("--save-baseline", action="store_true", help="Write the results to the baseline file")
+parser.add_argument("--tolerance", "-t", type=float, default=0.25, help="How much slower than the baseline counts as a regression")
+parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic inputs")
+
+
+def main(args):
+    # Every file has to be parsed, not looked up
+    import_to_hydrus.parsed_tags = tag_cache.TagCache(0)
+
+    cases = make_cases(args.seed)
+    if args.case:
+        unknown = set(args.case) - set(cases)
+        if unknown:
+            print(f"Unknown cases: {', '.join(sorted(unknown))}. Available: {', '.join(cases)}")
+            return 1
+        cases = {name: pngs for name, pngs in cases.items() if name in args.case}
+
+    results = {}
+    for case, pngs in cases.items():
+        # warm up imports, regexes and the schedule parser
+        run_case(pngs, min(len(pngs), 2))
+        # the fastest round is the one least disturbed by everything else
+        # running on the machine
+        rounds = [run_case(pngs, args.iterations) for _ in range(args.rounds)]
+        results[case] = summarize(*max(rounds, key=lambda r: r[1]))
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif regressions:
+        print(f"Slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,352 @@
+"""A stand-in for the Hydrus client API, for testing and benchmarking
+import_to_hydrus.py without a real Hydrus client.
+
+Serves the endpoints hydrus_api.Client uses for importing and retagging from
+an in-process HTTP server, keeps the files, tags and notes it is sent in
+memory, and can be told to respond slowly or with errors:
+
+    with FakeHydrus(latency=0.005, error_rate=0.01) as hydrus:
+        client = hydrus_api.Client("key", hydrus.url)
+        ...
+        print(hydrus.requests)
+"""
+
+import collections
+import hashlib
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+
+DEFAULT_SERVICES = {
+    "my tags": "6c6f63616c2074616773",
+    "stable-diffusion-webui": "73642d77656275692d74616773",
+}
+
+# hydrus_api.TagAction
+ACTION_ADD = "0"
+ACTION_DELETE = "1"
+# hydrus_api.TagStatus
+STATUS_CURRENT = "0"
+
+# Every basic permission, so hydrus_api.utils.verify_permissions passes
+ALL_PERMISSIONS = list(range(13))
+
+
+class FakeHydrusError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class FakeFile:
+    def __init__(self, file_id, hash_, data):
+        self.file_id = file_id
+        self.hash = hash_
+        self.data = data
+        self.tags = collections.defaultdict(set)  # service key -> current tags
+        self.notes = {}
+
+
+class FakeHydrus:
+    """Fake Hydrus client API on 127.0.0.1.
+
+    `latency` seconds are spent on every request, or `path_latency[path]` for
+    the paths it lists. A request fails with `error_status` with a probability
+    of `error_rate` (503 is DatabaseLocked to hydrus_api); `error_paths`
+    limits that to some paths. `fail_next` makes the next requests to a path
+    fail for tests that need it to happen exactly."""
+
+    def __init__(self, access_key=None, services=None, latency=0.0, path_latency=None,
+                 error_rate=0.0, error_status=503, error_paths=None, seed=0):
+        self.access_key = access_key
+        self.services = dict(DEFAULT_SERVICES if services is None else services)
+        self.latency = latency
+        self.path_latency = dict(path_latency or {})
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.error_paths = set(error_paths) if error_paths is not None else None
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.files = {}  # hash -> FakeFile
+        self.files_by_id = {}
+        self.requests = collections.Counter()  # path -> requests
+        self.errors = collections.Counter()  # path -> injected errors
+        self.failures = collections.defaultdict(list)  # path -> statuses to fail with next
+
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def fail_next(self, path, count=1, status=503):
+        with self.lock:
+            self.failures[path].extend([status] * count)
+
+    def service_name(self, service_key):
+        return next((name for name, key in self.services.items() if key == service_key), None)
+
+    def tags(self, hash_, service_name):
+        """Current tags of a file on a service, by name"""
+        with self.lock:
+            return set(self.files[hash_].tags.get(self.services[service_name], ()))
+
+    def notes(self, hash_):
+        with self.lock:
+            return dict(self.files[hash_].notes)
+
+    # Request handling
+
+    def _before_request(self, path, headers):
+        """Counts the request, waits out its latency and raises any error
+        that should be injected"""
+        with self.lock:
+            self.requests[path] += 1
+            status = None
+            if self.failures[path]:
+                status = self.failures[path].pop(0)
+            elif self.error_rate and (self.error_paths is None or path in self.error_paths) \
+                    and self.random.random() < self.error_rate:
+                status = self.error_status
+            if status is not None:
+                self.errors[path] += 1
+
+        delay = self.path_latency.get(path, self.latency)
+        if delay:
+            time.sleep(delay)
+
+        if self.access_key is not None and headers.get("Hydrus-Client-API-Access-Key") != self.access_key:
+            raise FakeHydrusError(403, "Invalid access key")
+        if status is not None:
+            raise FakeHydrusError(status, "Injected error")
+
+    def _get_file(self, params):
+        if "hash" in params:
+            file = self.files.get(params["hash"])
+        elif "file_id" in params:
+            file = self.files_by_id.get(int(params["file_id"]))
+        else:
+            raise FakeHydrusError(400, "hash or file_id is required")
+        if file is None:
+            raise FakeHydrusError(404, "File not found")
+        return file
+
+    def _files_for(self, body):
+        if "hashes" in body:
+            return [self._file_by_hash(h) for h in body["hashes"]]
+        if "hash" in body:
+            return [self._file_by_hash(body["hash"])]
+        if "file_ids" in body:
+            return [self.files_by_id[i] for i in body["file_ids"]]
+        if "file_id" in body:
+            return [self.files_by_id[body["file_id"]]]
+        raise FakeHydrusError(400, "hashes or file_ids are required")
+
+    def _file_by_hash(self, hash_):
+        file = self.files.get(hash_)
+        if file is None:
+            raise FakeHydrusError(404, f"Unknown hash: {hash_}")
+        return file
+
+    def _service_key(self, service_key):
+        if self.service_name(service_key) is None:
+            raise FakeHydrusError(400, f"Unknown service key: {service_key}")
+        return service_key
+
+    def handle_get(self, path, params):
+        if path == "/verify_access_key":
+            return {"basic_permissions": ALL_PERMISSIONS, "human_description": "fake hydrus"}
+
+        if path == "/get_service":
+            name = params.get("service_name")
+            if name is None:
+                name = self.service_name(params.get("service_key"))
+            if name not in self.services:
+                raise FakeHydrusError(404, "Service not found")
+            return {"service": self._service_info(name)}
+
+        if path == "/get_services":
+            return {"services": {key: self._service_info(name) for name, key in self.services.items()}}
+
+        if path == "/get_files/search_files":
+            wanted = [t for t in json.loads(params.get("tags", "[]")) if not t.startswith("system:")]
+            with self.lock:
+                file_ids = [
+                    file.file_id for file in self.files.values()
+                    if all(any(tag in tags for tags in file.tags.values()) for tag in wanted)
+                ]
+                hashes = [self.files_by_id[i].hash for i in file_ids]
+            result = {"file_ids": file_ids}
+            if json.loads(params.get("return_hashes", "false")):
+                result["hashes"] = hashes
+            return result
+
+        if path == "/get_files/file_metadata":
+            include_notes = json.loads(params.get("include_notes", "false"))
+            with self.lock:
+                if "hashes" in params:
+                    metadata = [self._metadata(self.files.get(h), h, include_notes) for h in json.loads(params["hashes"])]
+                elif "file_ids" in params:
+                    metadata = []
+                    for file_id in json.loads(params["file_ids"]):
+                        if file_id not in self.files_by_id:
+                            raise FakeHydrusError(404, f"Unknown file id: {file_id}")
+                        metadata.append(self._metadata(self.files_by_id[file_id], None, include_notes))
+                else:
+                    raise FakeHydrusError(400, "hashes or file_ids are required")
+            return {"services": {}, "metadata": metadata}
+
+        raise FakeHydrusError(404, f"Unknown path: {path}")
+
+    def handle_post(self, path, body, raw):
+        if path == "/add_files/add_file":
+            if raw is not None:
+                data = raw
+            else:
+                try:
+                    with open(body["path"], "rb") as f:
+                        data = f.read()
+                except OSError as ex:
+                    return {"status": 4, "hash": None, "note": str(ex)}
+            hash_ = hashlib.sha256(data).hexdigest()
+            with self.lock:
+                if hash_ in self.files:
+                    return {"status": 2, "hash": hash_, "note": "already in db"}
+                file = FakeFile(len(self.files) + 1, hash_, data)
+                self.files[hash_] = file
+                self.files_by_id[file.file_id] = file
+            return {"status": 1, "hash": hash_, "note": ""}
+
+        if path == "/add_tags/add_tags":
+            with self.lock:
+                files = self._files_for(body)
+                for service_key, tags in body.get("service_keys_to_tags", {}).items():
+                    service_key = self._service_key(service_key)
+                    for file in files:
+                        file.tags[service_key].update(tags)
+                for service_key, actions in body.get("service_keys_to_actions_to_tags", {}).items():
+                    service_key = self._service_key(service_key)
+                    for file in files:
+                        file.tags[service_key].update(actions.get(ACTION_ADD, ()))
+                        file.tags[service_key].difference_update(actions.get(ACTION_DELETE, ()))
+            return None
+
+        if path == "/add_notes/set_notes":
+            with self.lock:
+                (file,) = self._files_for(body)
+                file.notes.update(body["notes"])
+                return {"notes": dict(body["notes"])}
+
+        raise FakeHydrusError(404, f"Unknown path: {path}")
+
+    def _service_info(self, name):
+        return {"name": name, "service_key": self.services[name], "type": 5, "type_pretty": "local tag service"}
+
+    def _metadata(self, file, hash_, include_notes):
+        if file is None:
+            return {"hash": hash_, "file_id": None}
+        meta = {
+            "file_id": file.file_id,
+            "hash": file.hash,
+            "size": len(file.data),
+            "mime": "image/png",
+            "is_local": True,
+            "tags": {
+                key: {
+                    "name": name,
+                    "type": 5,
+                    "type_pretty": "local tag service",
+                    "storage_tags": {STATUS_CURRENT: sorted(file.tags.get(key, ()))},
+                    "display_tags": {STATUS_CURRENT: sorted(file.tags.get(key, ()))},
+                }
+                for name, key in self.services.items()
+            },
+        }
+        if include_notes:
+            meta["notes"] = dict(file.notes)
+        return meta
+
+
+def _make_handler(hydrus):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        # keep-alive, so connection pooling on the client side is exercised
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately, which Nagle's algorithm
+        # would hold up until the client's delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            try:
+                hydrus._before_request(url.path, self.headers)
+                if url.path == "/get_files/file":
+                    with hydrus.lock:
+                        file = hydrus._get_file(params)
+                    self._send(200, file.data, "image/png")
+                else:
+                    self._send_json(hydrus.handle_get(url.path, params))
+            except FakeHydrusError as ex:
+                self._send(ex.status, str(ex).encode("utf-8"), "text/plain")
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                hydrus._before_request(url.path, self.headers)
+                if self.headers.get("Content-Type") == "application/json":
+                    body, raw = json.loads(data), None
+                else:
+                    body, raw = {}, data
+                self._send_json(hydrus.handle_post(url.path, body, raw))
+            except FakeHydrusError as ex:
+                self._send(ex.status, str(ex).encode("utf-8"), "text/plain")
+            except (KeyError, ValueError) as ex:
+                self._send(400, repr(ex).encode("utf-8"), "text/plain")
+
+        def _send_json(self, result):
+            if result is None:
+                self._send(200, b"", "text/plain")
+            else:
+                self._send(200, json.dumps(result).encode("utf-8"), "application/json")
+
+        def _send(self, status, data, content_type):
+            try:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # fetch_parameters hangs up once it has the text chunks
+                self.close_connection = True
+
+    return Handler
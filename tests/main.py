@@ -6,10 +6,26 @@ import unittest
 
 sys.path.insert(0, os.path.dirname(__file__) + os.sep + "..")
 import test_import_to_hydrus
+import test_stealth_pnginfo
+import test_png_chunks
+import test_import_ledger
+import test_tag_cache
+import test_prompt_parser
+import test_dir_watcher
+import test_fake_hydrus
+import test_safetensors_hack
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.defaultTestLoader.loadTestsFromName("test_import_to_hydrus"))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromName("test_stealth_pnginfo"))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromName("test_png_chunks"))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromName("test_import_ledger"))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromName("test_tag_cache"))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromName("test_prompt_parser"))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromName("test_dir_watcher"))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromName("test_fake_hydrus"))
+    suite.addTest(unittest.defaultTestLoader.loadTestsFromName("test_safetensors_hack"))
     return suite
 
 if __name__ == '__main__':
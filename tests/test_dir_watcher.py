@@ -0,0 +1,47 @@
+import unittest
+import os
+import sys
+import tempfile
+import dir_watcher
+
+
+def touch(path, data=b"data"):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+class DirWatcherTest(unittest.TestCase):
+    def test_polling_finds_new_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            touch(os.path.join(tmpdir, "old.png"))
+            watcher = dir_watcher.PollingWatcher([tmpdir])
+            self.assertEqual(watcher.scan(), [])
+
+            touch(os.path.join(tmpdir, "new.png"))
+            os.makedirs(os.path.join(tmpdir, "2024-01-01"))
+            touch(os.path.join(tmpdir, "2024-01-01", "00001.png"))
+            self.assertEqual(sorted(watcher.scan()), [
+                os.path.join(tmpdir, "2024-01-01", "00001.png"),
+                os.path.join(tmpdir, "new.png"),
+            ])
+            self.assertEqual(watcher.scan(), [])
+
+            # replaced by a rename, same name but a new inode
+            touch(os.path.join(tmpdir, "tmp"))
+            os.replace(os.path.join(tmpdir, "tmp"), os.path.join(tmpdir, "old.png"))
+            self.assertEqual(watcher.scan(), [os.path.join(tmpdir, "old.png")])
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "inotify is Linux only")
+    def test_inotify_finds_written_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            watcher = dir_watcher.open_watcher([tmpdir], inotify=True)
+            try:
+                touch(os.path.join(tmpdir, "new.png"))
+                os.makedirs(os.path.join(tmpdir, "sub"))
+                self.assertEqual(watcher.changes(1), [os.path.join(tmpdir, "new.png")])
+
+                touch(os.path.join(tmpdir, "sub", "1.png"))
+                self.assertEqual(watcher.changes(1), [os.path.join(tmpdir, "sub", "1.png")])
+                self.assertEqual(watcher.changes(0), [])
+            finally:
+                watcher.close()
@@ -0,0 +1,122 @@
+import unittest
+import contextlib
+import io
+import os
+import tempfile
+import json
+import import_to_hydrus
+import import_stats
+from PIL import Image, PngImagePlugin
+from fake_hydrus import FakeHydrus
+
+
+def run(hydrus, *args):
+    arguments = import_to_hydrus.parser.parse_args(["--api-url", hydrus.url, "--api_key", "key"] + list(args))
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(io.StringIO()):
+        import_to_hydrus.main(arguments)
+    return out.getvalue()
+
+
+class FakeHydrusTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        # the ledger is created in the working directory
+        os.chdir(self.tmpdir.name)
+        self.images = os.path.join(self.tmpdir.name, "images")
+        os.makedirs(self.images)
+        for i in range(3):
+            pnginfo = PngImagePlugin.PngInfo()
+            pnginfo.add_text("parameters", f"1girl, tag{i}\nNegative prompt: lowres\nSteps: 20, Seed: {i}")
+            Image.new("RGB", (8, 8), (i + 100, 0, 0)).save(os.path.join(self.images, f"{i}.png"), pnginfo=pnginfo)
+
+    def tearDown(self):
+        # cmd_import leaves its closed ledger behind
+        import_to_hydrus.cache = set()
+        import_to_hydrus.black_check_cache = {}
+        import_to_hydrus.open_tag_cache(None)
+        import_to_hydrus.stats = import_stats.ImportStats()
+        import_to_hydrus.quiet = False
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+    def test_imports_and_retags(self):
+        with FakeHydrus(access_key="key") as hydrus:
+            run(hydrus, "import", self.images, "--tag", "personal")
+            self.assertEqual(len(hydrus.files), 3)
+            self.assertEqual(hydrus.requests["/add_files/add_file"], 3)
+            for hash_ in hydrus.files:
+                tags = hydrus.tags(hash_, "stable-diffusion-webui")
+                self.assertIn("1girl", tags)
+                self.assertIn("prompt_type:a1111", tags)
+                self.assertEqual(hydrus.tags(hash_, "my tags"), {"personal"})
+                self.assertEqual(hydrus.notes(hash_)["negative"], "lowres")
+
+            # everything is up to date, so retagging only reads
+            hydrus.requests.clear()
+            run(hydrus, "retag", "1girl")
+            self.assertEqual(hydrus.requests["/get_files/file_metadata"], 1)
+            self.assertEqual(hydrus.requests["/add_tags/add_tags"], 0)
+            self.assertEqual(hydrus.requests["/add_notes/set_notes"], 0)
+
+    def test_imports_in_parallel(self):
+        for i in range(3, 12):
+            directory = os.path.join(self.images, f"dir{i % 3}")
+            os.makedirs(directory, exist_ok=True)
+            pnginfo = PngImagePlugin.PngInfo()
+            pnginfo.add_text("parameters", f"1girl, tag{i}\nNegative prompt: lowres\nSteps: 20, Seed: {i}")
+            Image.new("RGB", (8, 8), (i + 100, 0, 0)).save(os.path.join(directory, f"{i}.png"), pnginfo=pnginfo)
+
+        with FakeHydrus(access_key="key") as hydrus:
+            args = ["import", self.images, "--tag", "personal", "--jobs", "2", "--upload-workers", "2", "--batch-size", "2"]
+            run(hydrus, *args)
+            self.assertEqual(len(hydrus.files), 12)
+            self.assertEqual(hydrus.requests["/add_files/add_file"], 12)
+            for hash_ in hydrus.files:
+                tags = hydrus.tags(hash_, "stable-diffusion-webui")
+                self.assertIn("1girl", tags)
+                self.assertEqual(len([tag for tag in tags if tag.startswith("tag")]), 1)
+                self.assertEqual(hydrus.tags(hash_, "my tags"), {"personal"})
+                self.assertEqual(hydrus.notes(hash_)["negative"], "lowres")
+                self.assertIn("parameters", hydrus.notes(hash_))
+
+            # every file is in the ledger now, so nothing is parsed or sent
+            hydrus.requests.clear()
+            run(hydrus, "--profile-json", "profile.json", *args)
+            with open("profile.json") as f:
+                summary = json.load(f)
+            self.assertEqual(summary["counters"]["skipped_in_ledger"], 12)
+            self.assertNotIn("files_parsed", summary["counters"])
+            for path in ("/add_files/add_file", "/add_tags/add_tags", "/add_notes/set_notes"):
+                self.assertEqual(hydrus.requests[path], 0)
+
+    def test_retries_locked_database(self):
+        with FakeHydrus(access_key="key", path_latency={"/add_notes/set_notes": 0.01}) as hydrus:
+            hydrus.fail_next("/add_notes/set_notes", 2, 503)
+            run(hydrus, "import", self.images)
+            self.assertEqual(hydrus.errors["/add_notes/set_notes"], 2)
+            self.assertEqual(hydrus.requests["/add_notes/set_notes"], 5)
+            for hash_ in hydrus.files:
+                self.assertIn("parameters", hydrus.notes(hash_))
+
+    def test_profiles_quietly(self):
+        black = os.path.join(self.images, "black.png")
+        pnginfo = PngImagePlugin.PngInfo()
+        pnginfo.add_text("parameters", "1girl\nSteps: 20, Seed: 9")
+        Image.new("RGB", (8, 8)).save(black, pnginfo=pnginfo)
+
+        with FakeHydrus(access_key="key") as hydrus:
+            output = run(hydrus, "--quiet", "--profile-json", "profile.json", "import", self.images)
+        self.assertNotIn(os.path.join(self.images, "0.png"), output)
+        self.assertIn("Profile", output)
+
+        with open("profile.json") as f:
+            summary = json.load(f)
+        self.assertEqual(summary["counters"]["files_seen"], 4)
+        self.assertEqual(summary["counters"]["files_parsed"], 3)
+        self.assertEqual(summary["counters"]["skipped_all_black"], 1)
+        self.assertEqual(summary["counters"]["files_uploaded"], 3)
+        self.assertEqual(summary["stages"]["upload"]["calls"], 3)
+        for stage in ("walk", "open", "black_check", "parse", "hash", "tag", "notes"):
+            self.assertIn(stage, summary["stages"])
@@ -0,0 +1,47 @@
+import unittest
+import os
+import tempfile
+import import_ledger
+
+
+class ImportLedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.tmpdir.cleanup()
+
+    def test_migrates_text_cache_once(self):
+        with open(import_ledger.TEXT_CACHE_PATH, "w", encoding="utf-8") as f:
+            f.write("/a/1.png\n/a/2.png\n")
+
+        ledger = import_ledger.ImportLedger()
+        self.assertEqual(len(ledger), 2)
+        self.assertIn("/a/1.png", ledger)
+        self.assertNotIn("/a/3.png", ledger)
+        ledger.close()
+
+        with open(import_ledger.TEXT_CACHE_PATH, "a", encoding="utf-8") as f:
+            f.write("/a/3.png\n")
+        ledger = import_ledger.ImportLedger()
+        self.assertNotIn("/a/3.png", ledger)
+        ledger.close()
+
+    def test_commits_per_batch(self):
+        with open("1.png", "wb") as f:
+            f.write(b"data")
+
+        ledger = import_ledger.ImportLedger()
+        ledger.add(os.path.realpath("1.png"), "deadbeef")
+        ledger.commit()
+        ledger.add("/uncommitted.png")
+        ledger.conn.close()
+
+        ledger = import_ledger.ImportLedger()
+        self.assertIn(os.path.realpath("1.png"), ledger)
+        self.assertEqual(ledger.get_hash(os.path.realpath("1.png")), "deadbeef")
+        self.assertNotIn("/uncommitted.png", ledger)
+        ledger.close()
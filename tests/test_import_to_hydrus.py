@@ -1,7 +1,90 @@
 import unittest
 import import_to_hydrus
+import import_ledger
+import png_chunks
+import test_png_chunks
 from pprint import pp
 import json
+import os
+import tempfile
+import time
+import collections
+import threading
+from unittest import mock
+import hydrus_api
+import io
+import requests
+from PIL import Image, PngImagePlugin
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.raw = io.BytesIO(data)
+
+    def iter_content(self, chunk_size):
+        return iter(lambda: self.raw.read(chunk_size), b"")
+
+    def close(self):
+        pass
+
+
+class FakeClient:
+    """Just enough of hydrus_api.Client to run do_import against"""
+
+    api_url = "http://127.0.0.1:45869"
+
+    def __init__(self, known_hashes=()):
+        self.session = requests.Session()
+        self.file_data = {}
+        self.get_file_responses = []
+        self.files = set(known_hashes)
+        self.added_files = []
+        self.add_tags_calls = 0
+        self.tags = collections.defaultdict(set)
+        self.notes = {}
+        self.notes_failures = 0
+        self.add_tags_requests = []
+        self.metadata = {}
+
+    def add_file(self, path):
+        self.added_files.append(path)
+        hash_ = import_to_hydrus.hash_file(path)
+        status = 2 if hash_ in self.files else 1
+        self.files.add(hash_)
+        return {"status": status, "hash": hash_}
+
+    def add_tags(self, hashes=None, file_ids=None, service_keys_to_tags=None, service_keys_to_actions_to_tags=None):
+        self.add_tags_calls += 1
+        self.add_tags_requests.append((hashes, service_keys_to_actions_to_tags))
+        for hash_ in hashes:
+            for service_key, tags in (service_keys_to_tags or {}).items():
+                self.tags[hash_].update(f"{service_key}/{t}" for t in tags)
+
+    def set_notes(self, notes, hash_=None, file_id=None):
+        if self.notes_failures > 0:
+            self.notes_failures -= 1
+            raise hydrus_api.ConnectionError("connection reset")
+        self.notes[hash_] = notes
+
+    def get_file(self, hash_=None, file_id=None):
+        resp = FakeResponse(self.file_data[file_id])
+        self.get_file_responses.append(resp)
+        return resp
+
+    def search_files(self, tags, **kwargs):
+        return {"file_ids": list(self.metadata)}
+
+    def get_file_metadata(self, hashes=None, file_ids=None, **kwargs):
+        if file_ids is not None:
+            return {"metadata": [self.metadata[file_id] for file_id in file_ids]}
+        return {"metadata": [
+            {"hash": h, "file_id": 1, "is_local": True} if h in self.files else {"hash": h, "file_id": None}
+            for h in hashes
+        ]}
+
+def parser_args(*args):
+    return import_to_hydrus.parser.parse_args(list(args))
+
 
 class ImportToHydrusTest(unittest.TestCase):
     def test_parses_break(self):
@@ -255,3 +338,347 @@ Steps: 40, Sampler: DPM++ 2M Karras, CFG scale: 9, Seed: 2976004442, Size: 576x5
             'nai_software:NovelAI'})
         self.assertEqual(positive, "{artist:nishikasai munieru}, 1girl, barefoot, solo, spread toes, soles, night, lamp, on bed, bedroom, moody, knees together, best quality, amazing quality, very aesthetic, absurdres")
         self.assertEqual(negative, "nsfw, lowres, {bad}, error, fewer, extra, missing, worst quality, jpeg artifacts, bad quality, watermark, unfinished, displeasing, chromatic aberration, signature, extra digits, artistic error, username, scan, [abstract], worst quality, low quality, artist name, signature, watermark")
+
+    def test_tag_cache_ignores_seed(self):
+        import_to_hydrus.open_tag_cache(None)
+        try:
+            for seed in (1, 2, 3):
+                tags, positive, negative = import_to_hydrus.read_tags(
+                    "a1111", f"1girl, solo\nNegative prompt: bad\nSteps: 20, Seed: {seed}, Size: 512x512"
+                )
+                self.assertIn(f"seed:{seed}", tags)
+                self.assertEqual({t for t in tags if t.startswith("seed:")}, {f"seed:{seed}"})
+            self.assertEqual((import_to_hydrus.parsed_tags.hits, import_to_hydrus.parsed_tags.misses), (2, 1))
+
+            # without a negative prompt the settings line ends up in a tag of its own
+            for seed in (1, 2):
+                tags, _, _ = import_to_hydrus.read_tags("a1111", f"1girl, solo\nSteps: 20, Seed: {seed}")
+                self.assertIn(f"Steps: 20, Seed: {seed}", tags)
+        finally:
+            import_to_hydrus.open_tag_cache(None)
+
+    def test_detects_all_black(self):
+        for mode in ("RGB", "RGBA", "L", "P"):
+            image = Image.new(mode, (300, 7000))
+            self.assertTrue(import_to_hydrus.is_all_black(image, "strips"))
+            self.assertTrue(import_to_hydrus.is_all_black(image, "full"))
+
+        image = Image.new("RGB", (300, 7000), (1, 0, 0))
+        self.assertTrue(import_to_hydrus.is_all_black(image, "strips"))
+        self.assertTrue(import_to_hydrus.is_all_black(image, "full"))
+
+        image = Image.new("RGB", (300, 7000))
+        image.putpixel((299, 0), (255, 255, 255))
+        self.assertFalse(import_to_hydrus.is_all_black(image, "strips"))
+        self.assertFalse(import_to_hydrus.is_all_black(image, "full"))
+
+    def test_detects_all_black_png_without_decoding_it(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "image.png")
+            for mode in ("RGB", "RGBA", "L"):
+                Image.new(mode, (300, 7000)).save(path)
+                self.assertTrue(import_to_hydrus.is_png_all_black(path, png_chunks.open_png_info(path)))
+
+            image = Image.new("RGB", (300, 7000))
+            image.putpixel((299, 6999), (255, 255, 255))
+            image.save(path)
+            self.assertFalse(import_to_hydrus.is_png_all_black(path, png_chunks.open_png_info(path)))
+
+    def test_skips_upload_of_known_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for i in range(3):
+                pnginfo = PngImagePlugin.PngInfo()
+                pnginfo.add_text("parameters", f"tag{i % 2}\nSteps: 20, Seed: {i % 2}")
+                path = os.path.join(tmpdir, f"{i}.png")
+                Image.new("RGB", (8, 8), (i % 2 + 100, 0, 0)).save(path, pnginfo=pnginfo)
+                paths.append(path)
+
+            # 0.png is already in Hydrus, 2.png is a copy of 0.png
+            known = import_to_hydrus.hash_file(paths[0])
+            client = FakeClient([known])
+            import_to_hydrus.cache = import_ledger.ImportLedger(os.path.join(tmpdir, "ledger.db"))
+
+            parse_results = [import_to_hydrus.parse_image(path) for path in paths]
+            import_to_hydrus.do_import(client, "sd", "my", parse_results, ["site:personal"])
+
+            self.assertEqual(client.added_files, [paths[1]])
+            self.assertEqual(len(client.notes), 2)
+            self.assertIn("sd/tag0", client.tags[known])
+            self.assertIn("my/site:personal", client.tags[known])
+            self.assertNotIn("sd/tag1", client.tags[known])
+            self.assertIn("sd/tag1", client.tags[import_to_hydrus.hash_file(paths[1])])
+            # shared tags + personal tags, then the unique tags of each file
+            self.assertEqual(client.add_tags_calls, 3)
+            for path in paths:
+                self.assertIn(path, import_to_hydrus.cache)
+            import_to_hydrus.cache.close()
+            import_to_hydrus.cache = set()
+
+    def test_add_tags_by_hash_needs_one_request_per_file_at_most(self):
+        # tags overlapping between some files but not all of them, which
+        # grouping by file set would send in a request per combination
+        vocabulary = [f"tag{i}" for i in range(12)]
+        hashes_to_tags = {
+            f"{i:064x}": {"steps:20", f"unique{i}", *vocabulary[i:i + 5], *vocabulary[i * 3 % 12:i * 3 % 12 + 2]}
+            for i in range(8)
+        }
+        client = FakeClient()
+        import_to_hydrus.add_tags_by_hash(client, {
+            "sd": hashes_to_tags,
+            "my": {hash_: ["site:personal"] for hash_ in hashes_to_tags},
+        })
+
+        self.assertEqual(client.add_tags_calls, len(hashes_to_tags) + 1)
+        for hash_, tags in hashes_to_tags.items():
+            self.assertEqual(client.tags[hash_], {f"sd/{t}" for t in tags} | {"my/site:personal"})
+
+        # a single file goes out in one request
+        client = FakeClient()
+        import_to_hydrus.add_tags_by_hash(client, {"sd": {"0" * 64: {"a", "b"}}, "my": {"0" * 64: ["site:personal"]}})
+        self.assertEqual(client.add_tags_calls, 1)
+
+    def test_commits_batch_only_after_notes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for i in range(2):
+                pnginfo = PngImagePlugin.PngInfo()
+                pnginfo.add_text("parameters", f"tag{i}\nSteps: 20, Seed: {i}")
+                path = os.path.join(tmpdir, f"{i}.png")
+                Image.new("RGB", (8, 8), (i + 100, 0, 0)).save(path, pnginfo=pnginfo)
+                paths.append(path)
+
+            import_to_hydrus.cache = import_ledger.ImportLedger(os.path.join(tmpdir, "ledger.db"))
+            old_retries = import_to_hydrus.NOTES_RETRIES
+            try:
+                # gives up on the note, so nothing in the batch is recorded
+                import_to_hydrus.NOTES_RETRIES = 0
+                client = FakeClient()
+                client.notes_failures = 1
+                parse_results = [import_to_hydrus.parse_image(path) for path in paths]
+                import_to_hydrus.do_import(client, "sd", "my", parse_results, [])
+                self.assertEqual(len(client.notes), 1)
+                for path in paths:
+                    self.assertNotIn(path, import_to_hydrus.cache)
+
+                # a retry gets the note through
+                import_to_hydrus.NOTES_RETRIES = 1
+                client.notes_failures = 1
+                parse_results = [import_to_hydrus.parse_image(path) for path in paths]
+                import_to_hydrus.do_import(client, "sd", "my", parse_results, [])
+                self.assertEqual(len(client.notes), 2)
+                for path in paths:
+                    self.assertIn(path, import_to_hydrus.cache)
+            finally:
+                import_to_hydrus.NOTES_RETRIES = old_retries
+                import_to_hydrus.cache.close()
+                import_to_hydrus.cache = set()
+
+    def test_retag_sends_only_changes(self):
+        parameters = "1girl, solo\nSteps: 20, Seed: 1"
+        tags, positive, negative = import_to_hydrus.read_tags("a1111", parameters)
+        tags = {t.lower() for t in tags}
+        notes = {"parameters": parameters, "positive": positive, "negative": negative}
+
+        client = FakeClient()
+        for file_id, extra in enumerate(([], ["old_tag"], ["old_tag"])):
+            current = sorted(tags - {"solo"} | set(extra)) if extra else sorted(tags)
+            client.metadata[file_id] = {
+                "hash": f"hash{file_id}",
+                "file_id": file_id,
+                "notes": dict(notes),
+                "tags": {"sd": {"name": "sd tags", "storage_tags": {"0": current}}},
+            }
+        arguments = parser_args("--service", "sd tags", "retag", "system:everything")
+        import_to_hydrus.cmd_retag(arguments, client)
+
+        # the up to date file is skipped, the other two share one request
+        self.assertEqual(client.add_tags_requests, [
+            (["hash1", "hash2"], {"sd": {"0": ["solo"], "1": ["old_tag"]}}),
+        ])
+        self.assertEqual(client.notes, {})
+
+    def test_update_tags_by_hash_needs_one_request_per_file_at_most(self):
+        hashes_to_actions_to_tags = {
+            f"hash{i}": {0: ["solo", f"tag{i % 3}", f"tag{i % 4 + 3}"], 1: ["old_tag", f"old{i % 2}"]}
+            for i in range(6)
+        }
+        client = FakeClient()
+        import_to_hydrus.update_tags_by_hash(client, "sd", hashes_to_actions_to_tags)
+
+        self.assertEqual(client.add_tags_calls, 7)
+        self.assertEqual(client.add_tags_requests[0], (
+            [f"hash{i}" for i in range(6)], {"sd": {"0": ["solo"], "1": ["old_tag"]}}
+        ))
+        self.assertEqual(client.add_tags_requests[1], (["hash0"], {"sd": {"0": ["tag0", "tag3"], "1": ["old0"]}}))
+
+    def test_fetches_only_png_metadata(self):
+        client = FakeClient()
+        for file_id, parameters in enumerate(("1girl\nSteps: 20, Seed: 1", None)):
+            pnginfo = PngImagePlugin.PngInfo()
+            if parameters is not None:
+                pnginfo.add_text("parameters", parameters)
+            out = io.BytesIO()
+            Image.effect_noise((512, 512), 64).convert("RGB").save(out, "PNG", pnginfo=pnginfo)
+            client.file_data[file_id] = out.getvalue()
+
+        self.assertEqual(
+            import_to_hydrus.fetch_parameters(client, 0),
+            ("a1111", "1girl\nSteps: 20, Seed: 1"),
+        )
+        self.assertEqual(len(client.get_file_responses), 1)
+        self.assertLess(client.get_file_responses[0].raw.tell(), 1024)
+
+        # no text chunks, so the pixels are downloaded for the stealth check
+        self.assertEqual(import_to_hydrus.fetch_parameters(client, 1), (None, None))
+        self.assertEqual(len(client.get_file_responses), 3)
+        self.assertEqual(client.get_file_responses[2].raw.tell(), len(client.file_data[1]))
+
+    def test_skips_unchanged_directories(self):
+        def make_png(path, parameters, age=3600):
+            pnginfo = PngImagePlugin.PngInfo()
+            if parameters is not None:
+                pnginfo.add_text("parameters", parameters)
+            Image.new("RGB", (8, 8), (100, 0, 0)).save(path, pnginfo=pnginfo)
+            os.utime(path, ns=(0, time.time_ns() - age * 1_000_000_000))
+
+        def age_directories(root, age=3600):
+            for directory, _, _ in os.walk(root):
+                os.utime(directory, ns=(0, time.time_ns() - age * 1_000_000_000))
+
+        def scan(root, ledger):
+            return sorted(os.path.basename(path) for path, _, _, _ in import_to_hydrus.scan_files(root, True, ledger))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "images")
+            os.makedirs(os.path.join(root, "a"))
+            os.makedirs(os.path.join(root, "b", "c"))
+            os.makedirs(os.path.join(root, "d"))
+            make_png(os.path.join(root, "a", "1.png"), "tag1\nSteps: 20, Seed: 1")
+            make_png(os.path.join(root, "b", "2.png"), None)
+            make_png(os.path.join(root, "b", "c", "3.png"), "tag3\nSteps: 20, Seed: 3")
+            make_png(os.path.join(root, "b", "c", "4.png"), "tag4\nSteps: 20, Seed: 4", age=0)
+            with open(os.path.join(root, "d", "broken.png"), "wb") as f:
+                f.write(b"\x89PNG\r\n\x1a\n" + b"\0" * 16)
+            age_directories(root)
+
+            ledger = import_ledger.ImportLedger(os.path.join(tmpdir, "ledger.db"))
+            import_to_hydrus.cache = ledger
+            try:
+                self.assertEqual(scan(root, ledger), ["1.png", "2.png", "3.png", "4.png", "broken.png"])
+                client = FakeClient()
+                import_to_hydrus.import_path(client, root, "sd", "my")
+                self.assertEqual(len(client.added_files), 3)
+
+                # 4.png was still fresh and broken.png couldn't be read, so
+                # their directories are listed again
+                self.assertEqual(scan(root, ledger), ["3.png", "4.png", "broken.png"])
+
+                make_png(os.path.join(root, "a", "5.png"), "tag5\nSteps: 20, Seed: 5")
+                age_directories(os.path.join(root, "a"), age=60)
+                self.assertEqual(scan(root, ledger), ["1.png", "3.png", "4.png", "5.png", "broken.png"])
+            finally:
+                ledger.close()
+                import_to_hydrus.cache = set()
+
+    def test_records_files_without_metadata(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            plain = os.path.join(tmpdir, "plain.png")
+            Image.new("RGB", (8, 8), (100, 0, 0)).save(plain)
+
+            # grayscale with the text after the image data, so no stealth fallback
+            pnginfo = PngImagePlugin.PngInfo()
+            pnginfo.add_text("parameters", "1girl\nSteps: 20, Seed: 1")
+            out = io.BytesIO()
+            Image.new("L", (8, 8), 100).save(out, "PNG", pnginfo=pnginfo)
+            late = os.path.join(tmpdir, "late.png")
+            with open(late, "wb") as f:
+                f.write(test_png_chunks.move_text_after_idat(out.getvalue()))
+
+            import_to_hydrus.cache = import_ledger.ImportLedger(os.path.join(tmpdir, "ledger.db"))
+            try:
+                self.assertIsNone(import_to_hydrus.parse_image(plain))
+                self.assertIn(plain, import_to_hydrus.cache)
+                result = import_to_hydrus.parse_image(late)
+                self.assertIn("1girl", result.tags)
+                self.assertNotIn(late, import_to_hydrus.cache)
+            finally:
+                import_to_hydrus.cache.close()
+                import_to_hydrus.cache = set()
+
+    def test_watch_uploads_on_workers(self):
+        class FakeWatcher:
+            def __init__(self, paths):
+                self.paths = paths
+                self.calls = 0
+
+            def changes(self, timeout):
+                self.calls += 1
+                if self.calls == 1:
+                    return self.paths
+                if self.calls > 3:
+                    raise KeyboardInterrupt
+                return []
+
+        class ThreadClient(FakeClient):
+            def add_file(self, path):
+                self.upload_threads.add(threading.current_thread())
+                return super().add_file(path)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for i in range(4):
+                pnginfo = PngImagePlugin.PngInfo()
+                pnginfo.add_text("parameters", f"tag{i}\nSteps: 20, Seed: {i}")
+                path = os.path.join(tmpdir, f"{i}.png")
+                Image.new("RGB", (8, 8), (100 + i, 0, 0)).save(path, pnginfo=pnginfo)
+                paths.append(path)
+
+            arguments = import_to_hydrus.parser.parse_args(
+                ["import", tmpdir, "--watch", "--upload-workers", "2", "--batch-size", "2", "--debounce", "0"]
+            )
+            client = ThreadClient()
+            client.upload_threads = set()
+            import_to_hydrus.cache = import_ledger.ImportLedger(os.path.join(tmpdir, "ledger.db"))
+            try:
+                import_to_hydrus.watch_import(arguments, client, FakeWatcher(paths), "sd", "my")
+                self.assertEqual(sorted(client.added_files), [os.path.realpath(path) for path in paths])
+                self.assertNotIn(threading.current_thread(), client.upload_threads)
+                for path in paths:
+                    self.assertIn(os.path.realpath(path), import_to_hydrus.cache)
+            finally:
+                import_to_hydrus.cache.close()
+                import_to_hydrus.cache = set()
+
+    def test_skips_files_removed_during_walk(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = os.path.join(tmpdir, "images")
+            os.makedirs(root)
+            for i in range(2):
+                pnginfo = PngImagePlugin.PngInfo()
+                pnginfo.add_text("parameters", f"tag{i}\nSteps: 20, Seed: {i}")
+                Image.new("RGB", (8, 8), (100 + i, 0, 0)).save(os.path.join(root, f"{i}.png"), pnginfo=pnginfo)
+            os.utime(root, ns=(0, time.time_ns() - 3600 * 1_000_000_000))
+
+            scan_files = import_to_hydrus.scan_files
+
+            def scan_and_remove(*args):
+                # the other image goes away after both were listed
+                for i, item in enumerate(scan_files(*args)):
+                    if i == 0:
+                        for name in os.listdir(root):
+                            if name != os.path.basename(item[0]):
+                                os.remove(os.path.join(root, name))
+                    yield item
+
+            ledger = import_ledger.ImportLedger(os.path.join(tmpdir, "ledger.db"))
+            import_to_hydrus.cache = ledger
+            try:
+                client = FakeClient()
+                with mock.patch.object(import_to_hydrus, "scan_files", scan_and_remove):
+                    import_to_hydrus.import_path(client, root, "sd", "my")
+                self.assertEqual(len(client.added_files), 1)
+                self.assertIsNone(ledger.get_directory(os.path.realpath(root)))
+            finally:
+                ledger.close()
+                import_to_hydrus.cache = set()
@@ -0,0 +1,118 @@
+import unittest
+import io
+import os
+import tempfile
+import struct
+from PIL import Image, PngImagePlugin
+import png_chunks
+
+
+def make_png(mode="RGB", **kwargs):
+    pnginfo = PngImagePlugin.PngInfo()
+    pnginfo.add_text("parameters", "1girl, solo\nSteps: 20, Seed: 1")
+    pnginfo.add_text("Comment", '{"prompt": "日本語"}')
+    pnginfo.add_text("zipped", "compressed " * 100, zip=True)
+    pnginfo.add_itxt("itxt_zipped", "圧縮 " * 100, lang="ja", tkey="key", zip=True)
+    out = io.BytesIO()
+    Image.new(mode, (32, 16)).save(out, "PNG", pnginfo=pnginfo, **kwargs)
+    out.seek(0)
+    return out
+
+
+def move_text_after_idat(data):
+    """Rewrites a PNG so its text chunks come after the image data, like some
+    encoders write them"""
+    chunks = []
+    pos = 8
+    while pos < len(data):
+        length, cid = struct.unpack(">I4s", data[pos:pos + 8])
+        chunks.append((cid, data[pos:pos + 12 + length]))
+        pos += 12 + length
+    text = [chunk for cid, chunk in chunks if cid in png_chunks.TEXT_CHUNKS]
+    rest = [chunk for cid, chunk in chunks if cid not in png_chunks.TEXT_CHUNKS]
+    return data[:8] + b"".join(rest[:-1] + text + rest[-1:])
+
+
+class UnseekableStream(io.RawIOBase):
+    def __init__(self, data):
+        self.inner = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def readinto(self, b):
+        data = self.inner.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class PngChunksTest(unittest.TestCase):
+    def test_matches_pil(self):
+        for mode in ("RGB", "RGBA", "L", "P"):
+            f = make_png(mode)
+            expected = Image.open(f).text
+            f.seek(0)
+            result = png_chunks.read_png_info(f)
+
+            self.assertEqual(result.info, expected)
+            self.assertEqual((result.width, result.height), (32, 16))
+            self.assertEqual(result.mode, mode)
+
+    def test_stops_at_idat(self):
+        data = make_png().getvalue()
+        stream = UnseekableStream(data)
+        result = png_chunks.read_png_info(stream)
+        self.assertEqual(result.info["parameters"], "1girl, solo\nSteps: 20, Seed: 1")
+        self.assertLess(stream.inner.tell(), data.index(b"IDAT") + 8)
+
+    def test_rejects_non_png(self):
+        out = io.BytesIO()
+        Image.new("RGB", (8, 8)).save(out, "JPEG")
+        out.seek(0)
+        with self.assertRaises(SyntaxError):
+            png_chunks.read_png_info(out)
+
+    def test_bad_crc(self):
+        data = bytearray(make_png().getvalue())
+        pos = data.index(b"parameters")
+        data[pos] ^= 0xFF
+        with self.assertRaises(SyntaxError):
+            png_chunks.read_png_info(io.BytesIO(bytes(data)))
+
+    def test_bands_match_pil(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "image.png")
+            for mode in ("RGB", "RGBA", "L", "LA", "P"):
+                # noise and a gradient so the encoder picks different row filters
+                noise = Image.frombytes("RGBA", (37, 50), os.urandom(37 * 50 * 4)).convert(mode)
+                gradient = Image.linear_gradient("L").resize((37, 50)).convert(mode)
+                for image in (noise, gradient):
+                    image.save(path)
+                    info = png_chunks.open_png_info(path)
+                    self.assertTrue(png_chunks.can_decode_bands(info))
+                    expected = Image.open(path)
+                    expected.load()
+                    for rows in (1, 3, 7, 50, 64):
+                        with self.subTest(mode=mode, rows=rows):
+                            bands = list(png_chunks.iter_bands(path, rows))
+                            self.assertEqual(len(bands), -(-50 // rows))
+                            self.assertTrue(all(band.mode == expected.mode for band in bands))
+                            self.assertEqual(b"".join(band.tobytes() for band in bands), expected.tobytes())
+
+    def test_bands_need_8_bit_non_interlaced(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "image.png")
+            Image.new("I;16", (8, 8)).save(path)
+            self.assertFalse(png_chunks.can_decode_bands(png_chunks.open_png_info(path)))
+            Image.new("1", (8, 8)).save(path)
+            self.assertFalse(png_chunks.can_decode_bands(png_chunks.open_png_info(path)))
+
+    def test_text_after_idat(self):
+        data = move_text_after_idat(make_png("L").getvalue())
+        self.assertEqual(png_chunks.read_png_info(io.BytesIO(data)).info, {})
+        result = png_chunks.read_png_info(UnseekableStream(data), after_idat=True)
+        self.assertEqual(result.info["parameters"], "1girl, solo\nSteps: 20, Seed: 1")
+        self.assertEqual(result.info, Image.open(io.BytesIO(make_png("L").getvalue())).text)
@@ -0,0 +1,67 @@
+import unittest
+from unittest import mock
+import prompt_parser
+
+
+PROMPTS = [
+    "test",
+    "a [b:3]",
+    "a [b: 3]",
+    "a [[[b]]:2]",
+    "[(a:2):3]",
+    "a [b : c : 1] d",
+    "a[b:[c:d:2]:1]e",
+    "a [unbalanced",
+    "a [b:.5] c",
+    "((a][:b:c [d:3]",
+    "[a|(b:1.1)]",
+    "[(x) y|c] [a:b:2]",
+    "[a|b] [c|d|e], [[f|g]:h:0.5]",
+    "[a:b:0], [c:d:-3]",
+    "masterpiece, (1girl:1.2), [smile|frown], [day:night:0.3], \\(literal\\)",
+]
+
+
+class PromptParserTest(unittest.TestCase):
+    def test_variants_match_schedules(self):
+        for steps in (1, 7, 20, 150):
+            schedules = prompt_parser.get_learned_conditioning_prompt_schedules(PROMPTS, steps)
+            variants = prompt_parser.get_prompt_variants(PROMPTS, steps)
+            for prompt, schedule, v in zip(PROMPTS, schedules, variants):
+                with self.subTest(prompt=prompt, steps=steps):
+                    self.assertEqual(v.schedule_length, len(schedule))
+                    self.assertEqual(v.texts, list(dict.fromkeys(text for _, text in schedule)))
+
+    def test_empty_alternative(self):
+        self.assertEqual(
+            prompt_parser.get_prompt_variants(["a [|b]"], 4),
+            [prompt_parser.PromptVariants(4, ["a ", "a b"])],
+        )
+
+    def test_fast_parser_matches_earley(self):
+        self.assertIsInstance(prompt_parser.fast_parse_schedule(PROMPTS[-1]), prompt_parser.lark.Tree)
+        with self.assertRaises(prompt_parser.FastParseUnsupported):
+            prompt_parser.fast_parse_schedule("((a][:b:c [d:3]")
+
+        fast = prompt_parser.get_learned_conditioning_prompt_schedules(PROMPTS, 10)
+        with mock.patch.object(prompt_parser, "fast_parse_schedule", side_effect=prompt_parser.FastParseUnsupported):
+            earley = prompt_parser.get_learned_conditioning_prompt_schedules(PROMPTS, 10)
+        self.assertEqual(fast, earley)
+
+    def test_tokenize_attention(self):
+        prompts = [
+            "a (((house:1.3)) [on] a (hill:0.5), sun, (((sky))).",
+            "(unnecessary)(parens), [(a)], (b:1.1)(c)",
+            "a BREAK (b BREAK c), [d",
+            "\\(literal\\], \\",
+            "",
+        ]
+        for prompt, (texts, weights), tags in zip(
+            prompts,
+            prompt_parser.parse_prompt_attention_many(prompts),
+            prompt_parser.parse_prompt_attention_many(prompts, tags_only=True),
+        ):
+            with self.subTest(prompt=prompt):
+                expected = prompt_parser.parse_prompt_attention(prompt)
+                self.assertEqual(list(zip(texts, weights)), [tuple(pair) for pair in expected])
+                self.assertEqual(tags, texts)
@@ -0,0 +1,263 @@
+import unittest
+import os
+import json
+import hashlib
+import zlib
+import errno
+import tempfile
+import threading
+import time
+from unittest import mock
+import random
+import torch
+import safetensors.torch
+import safetensors_hack
+import hash_cache
+
+
+def make_model(path, metadata=None, seed=0):
+    """A model larger than the 0x100000 offset the legacy hash reads at"""
+    generator = torch.Generator().manual_seed(seed)
+    tensors = {
+        "lora_unet_down.weight": torch.randn((512, 640), generator=generator, dtype=torch.float32),
+        "lora_unet_up.weight": torch.randn((640, 256), generator=generator, dtype=torch.float16),
+        "alpha": torch.tensor(8.0),
+    }
+    safetensors.torch.save_file(tensors, path, metadata)
+
+
+def reserialized_legacy_hash(path):
+    """legacy_hash_file as it used to be: saving the model again without its
+    user metadata and hashing the result"""
+    tensors, metadata = safetensors_hack.load_file(path, "cpu")
+    metadata = {k: v for k, v in metadata.items() if k.startswith("ss_")}
+    model_bytes = safetensors.torch.save(tensors, metadata)
+    return hashlib.sha256(model_bytes[0x100000:0x110000]).hexdigest()[0:8]
+
+
+def write_shuffled(path, tensors, metadata, seed=0):
+    """Writes a .safetensors file by hand, with its tensors in a random order
+    instead of the one safetensors uses"""
+    names = sorted(tensors)
+    random.Random(seed).shuffle(names)
+    header = {"__metadata__": metadata}
+    data = b""
+    for name in names:
+        tensor_bytes = safetensors.torch.save({"t": tensors[name]})
+        n = int.from_bytes(tensor_bytes[:8], "little")
+        info = json.loads(tensor_bytes[8:8 + n])["t"]
+        header[name] = {"dtype": info["dtype"], "shape": info["shape"], "data_offsets": [len(data), len(data) + len(tensor_bytes) - 8 - n]}
+        data += tensor_bytes[8 + n:]
+    header_bytes = json.dumps(header).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(len(header_bytes).to_bytes(8, "little") + header_bytes + data)
+
+
+class SafetensorsHackTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_caches_hashes_until_file_changes(self):
+        model = self.path("model.safetensors")
+        make_model(model, {"ss_network_dim": "8", "ssmd_display_name": "Test"})
+        cache = hash_cache.HashCache(self.path("hashes.db"))
+        try:
+            hashes, speed = safetensors_hack.get_hashes(model, cache)
+            self.assertEqual(hashes, safetensors_hack.multi_hash_file(model)[0])
+            self.assertIsNotNone(speed)
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+            self.assertEqual(safetensors_hack.get_hashes(model, cache), (hashes, None))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # --verify hashes again even though the entry is still valid
+            self.assertEqual(safetensors_hack.get_hashes(model, cache, verify=True)[0], hashes)
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+            # replaced by a different model under the same name
+            make_model(self.path("other.safetensors"), seed=1)
+            os.replace(self.path("other.safetensors"), model)
+            self.assertNotEqual(safetensors_hack.get_hashes(model, cache)[0], hashes)
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+        finally:
+            cache.close()
+
+        # kept between runs
+        cache = hash_cache.HashCache(self.path("hashes.db"))
+        try:
+            self.assertIsNotNone(cache.get(hash_cache.file_key(model)))
+        finally:
+            cache.close()
+
+    def test_legacy_hash_matches_resaving_model(self):
+        generator = torch.Generator().manual_seed(0)
+        tensors = {
+            f"lora_te_text_model_encoder_layers_{i}_{part}.{kind}": torch.randn(shape, generator=generator).to(dtype)
+            for i in range(3)
+            for part, dtype in (("mlp_fc1", torch.float16), ("self_attn_q_proj", torch.bfloat16), ("mlp_fc2", torch.float32))
+            for kind, shape in (("lora_down.weight", (96, 320)), ("lora_up.weight", (320, 96)), ("alpha", ()))
+        }
+        metadata = {
+            "ss_network_dim": "96",
+            "ss_tag_frequency": json.dumps({"1_hakurei reimu": {"reimu": 12, "\u304b\u308f\u3044\u3044": 3}}),
+            "ss_output_name": "r\u00e9imu/\"test\"\n\x01\x7f",
+            "ssmd_display_name": "Reimu",
+            "ssmd_description": "Trained on\t\u3042 images",
+        }
+
+        for name, write in (
+            ("saved", lambda path: safetensors.torch.save_file(tensors, path, metadata)),
+            ("shuffled", lambda path: write_shuffled(path, tensors, metadata)),
+        ):
+            with self.subTest(name):
+                path = self.path(f"{name}.safetensors")
+                write(path)
+                self.assertEqual(safetensors_hack.legacy_hash_file(path), reserialized_legacy_hash(path))
+
+    def test_legacy_hash_window_in_header(self):
+        # a single ss_ key, so the metadata order can't differ
+        path = self.path("model.safetensors")
+        make_model(path, {"ss_tag_frequency": "x" * 0x108000, "ssmd_display_name": "Test"})
+        self.assertEqual(safetensors_hack.legacy_hash_file(path), reserialized_legacy_hash(path))
+
+    def test_multi_hash_matches_separate_hashes(self):
+        for name, metadata in (("training", {"ss_network_dim": "8"}), ("user", {"ss_network_dim": "8", "ssmd_display_name": "Test"})):
+            path = self.path(f"{name}.safetensors")
+            make_model(path, metadata)
+            with open(path, "rb") as f:
+                crc32 = f"{zlib.crc32(f.read()):08x}"
+            expected = {
+                "model_hash": safetensors_hack.hash_file(path),
+                "legacy_hash": safetensors_hack.legacy_hash_file(path),
+                "sha256": safetensors_hack.full_hash_file(path),
+                "crc32": crc32,
+            }
+            # blocks that split the header, the legacy window and the file end
+            for read_size in (safetensors_hack.READ_SIZE, 0x10000, 1000):
+                with self.subTest(name=name, read_size=read_size):
+                    hashes, size, _ = safetensors_hack.multi_hash_file(path, read_size=read_size)
+                    self.assertEqual(hashes, expected)
+                    self.assertEqual(size, os.path.getsize(path))
+
+            hashes, _, _ = safetensors_hack.multi_hash_file(path, digests=("legacy_hash", "crc32"))
+            self.assertEqual(hashes, {"legacy_hash": expected["legacy_hash"], "crc32": crc32})
+
+    def test_hash_files_largest_first_and_per_device(self):
+        paths = []
+        for i, size in enumerate((1000, 5000, 3000, 4000)):
+            path = self.path(f"model{i}.safetensors")
+            safetensors.torch.save_file({"weight": torch.zeros(size)}, path)
+            paths.append(path)
+
+        get_hashes = safetensors_hack.get_hashes
+        lock = threading.Lock()
+        reading = []
+        most_reading = 0
+
+        def slow_get_hashes(filename, cache=None, verify=False):
+            nonlocal most_reading
+            with lock:
+                reading.append(filename)
+                most_reading = max(most_reading, len(reading))
+            time.sleep(0.05)
+            with lock:
+                reading.remove(filename)
+            return get_hashes(filename, cache, verify)
+
+        with mock.patch.object(safetensors_hack, "get_hashes", slow_get_hashes):
+            results = list(safetensors_hack.hash_files(paths, jobs=1))
+            self.assertEqual([r[0] for r in results], [paths[1], paths[3], paths[2], paths[0]])
+            self.assertEqual(results[0][1], get_hashes(paths[1])[0])
+
+            # all on the same device
+            results = list(safetensors_hack.hash_files(paths, jobs=4, reads_per_device=2))
+            self.assertEqual(sorted(r[0] for r in results), sorted(paths))
+            self.assertEqual(most_reading, 2)
+
+    def assertSameTensors(self, path, expected):
+        tensors, _ = safetensors_hack.load_file(path, "cpu")
+        self.assertEqual(tensors.keys(), expected.keys())
+        for name, tensor in expected.items():
+            self.assertTrue(torch.equal(tensors[name], tensor), name)
+
+    def test_write_metadata_in_place(self):
+        path = self.path("model.safetensors")
+        make_model(path, {"ss_network_dim": "8", "ssmd_display_name": "A long display name"})
+        tensors, _ = safetensors_hack.load_file(path, "cpu")
+        before = os.stat(path)
+
+        self.assertTrue(safetensors_hack.write_metadata(path, {"ss_network_dim": "8", "ssmd_display_name": "Short"}))
+        self.assertEqual(safetensors_hack.read_metadata(path), {"ss_network_dim": "8", "ssmd_display_name": "Short"})
+        self.assertEqual((os.stat(path).st_ino, os.stat(path).st_size), (before.st_ino, before.st_size))
+        self.assertSameTensors(path, tensors)
+
+        self.assertTrue(safetensors_hack.write_metadata(path, {}))
+        self.assertEqual(safetensors_hack.read_metadata(path), {})
+        self.assertSameTensors(path, tensors)
+
+    def test_write_metadata_restores_header_on_failure(self):
+        path = self.path("model.safetensors")
+        make_model(path, {"ss_network_dim": "8", "ssmd_display_name": "A long display name"})
+        with open(path, "rb") as f:
+            before = f.read()
+        self.assertEqual(safetensors_hack.read_header_bytes(path), before[:8 + int.from_bytes(before[:8], "little")])
+
+        with mock.patch.object(os, "fsync", side_effect=[OSError(errno.EIO, "I/O error"), None]) as failing_fsync:
+            with self.assertRaises(OSError):
+                safetensors_hack.write_metadata(path, {"ss_network_dim": "8"})
+        self.assertEqual(failing_fsync.call_count, 2)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), before)
+
+    def test_restore_metadata_after_tensors_moved(self):
+        path = self.path("model.safetensors")
+        original = {"ss_network_dim": "8", "ssmd_display_name": "A long display name"}
+        make_model(path, original)
+        tensors, _ = safetensors_hack.load_file(path, "cpu")
+        backup_path = self.path("model.safetensors.metadata.backup.json")
+        with open(backup_path, "w", encoding="utf-8") as f:
+            json.dump(safetensors_hack.read_metadata(path), f)
+
+        self.assertTrue(safetensors_hack.write_metadata(path, {"ss_network_dim": "8"}))
+        self.assertFalse(safetensors_hack.write_metadata(path, {"ssmd_description": "x" * 10000}))
+        safetensors_hack.restore_metadata(path, backup_path)
+        self.assertEqual(safetensors_hack.read_metadata(path), original)
+        self.assertSameTensors(path, tensors)
+
+    def test_write_metadata_grows_header(self):
+        path = self.path("model.safetensors")
+        metadata = {"ss_network_dim": "8", "ssmd_description": "\u3042" * 1000}
+
+        copy_file_range = getattr(os, "copy_file_range", None)
+        sendfile = getattr(os, "sendfile", None)
+
+        def unsupported(code):
+            def fail(*args):
+                raise OSError(code, os.strerror(code))
+            return fail
+
+        for name, patches in (
+            ("copy_file_range", {"pread": unsupported(errno.EIO)}),
+            ("sendfile", {"copy_file_range": unsupported(errno.EXDEV), "pread": unsupported(errno.EIO)}),
+            ("read/write", {"copy_file_range": unsupported(errno.EXDEV), "sendfile": unsupported(errno.EINVAL)}),
+        ):
+            with self.subTest(name):
+                if name == "copy_file_range" and copy_file_range is None or name == "sendfile" and sendfile is None:
+                    continue
+                make_model(path, {"ss_network_dim": "8"})
+                os.chmod(path, 0o640)
+                tensors, _ = safetensors_hack.load_file(path, "cpu")
+                model_hash = safetensors_hack.hash_file(path)
+                with mock.patch.multiple(os, create=True, **patches):
+                    self.assertFalse(safetensors_hack.write_metadata(path, metadata))
+                self.assertEqual(safetensors_hack.read_metadata(path), metadata)
+                self.assertEqual(safetensors_hack.hash_file(path), model_hash)
+                self.assertSameTensors(path, tensors)
+                self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+                self.assertEqual(os.listdir(self.tmpdir.name), ["model.safetensors"])
@@ -0,0 +1,60 @@
+import unittest
+import gzip
+import numpy as np
+from PIL import Image
+import stealth_pnginfo
+
+
+def add_stealth_pnginfo(image, text, mode="alpha", compressed=False):
+    """Same encoding as the stealth-pnginfo webui extension."""
+    signature = f"stealth_{'png' if mode == 'alpha' else 'rgb'}{'comp' if compressed else 'info'}"
+    param = text.encode("utf-8")
+    if compressed:
+        param = gzip.compress(param)
+    binary_param = "".join(format(byte, "08b") for byte in param)
+    binary_data = "".join(format(byte, "08b") for byte in signature.encode("utf-8"))
+    binary_data += format(len(binary_param), "032b") + binary_param
+
+    pixels = image.load()
+    width, height = image.size
+    index = 0
+    for x in range(width):
+        for y in range(height):
+            pixel = list(pixels[x, y])
+            channels = [3] if mode == "alpha" else [0, 1, 2]
+            for c in channels:
+                if index < len(binary_data):
+                    pixel[c] = (pixel[c] & ~1) | int(binary_data[index])
+                    index += 1
+            pixels[x, y] = tuple(pixel)
+    return image
+
+
+def make_image(mode, width=64, height=48):
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 256, (height, width, len(mode)), dtype=np.uint8)
+    return Image.fromarray(data, mode).copy()
+
+
+class StealthPngInfoTest(unittest.TestCase):
+    text = '{"Description": "1girl, solo, {best quality}", "Software": "NovelAI"}'
+
+    def test_reads_alpha(self):
+        for compressed in (False, True):
+            image = add_stealth_pnginfo(make_image("RGBA"), self.text, "alpha", compressed)
+            self.assertEqual(stealth_pnginfo.read_info_from_image_stealth(image), self.text)
+
+    def test_reads_rgb(self):
+        for mode in ("RGB", "RGBA"):
+            for compressed in (False, True):
+                image = add_stealth_pnginfo(make_image(mode), self.text, "rgb", compressed)
+                self.assertEqual(stealth_pnginfo.read_info_from_image_stealth(image), self.text)
+
+    def test_no_signature(self):
+        self.assertIsNone(stealth_pnginfo.read_info_from_image_stealth(make_image("RGBA")))
+        self.assertIsNone(stealth_pnginfo.read_info_from_image_stealth(make_image("RGB")))
+        self.assertIsNone(stealth_pnginfo.read_info_from_image_stealth(make_image("RGB").convert("L")))
+
+    def test_truncated_payload(self):
+        image = add_stealth_pnginfo(make_image("RGBA", 8, 24), self.text * 4, "alpha")
+        self.assertIsNone(stealth_pnginfo.read_info_from_image_stealth(image))
@@ -0,0 +1,37 @@
+import unittest
+import os
+import tempfile
+import tag_cache
+
+
+class TagCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = tag_cache.TagCache(maxsize=2)
+        cache.put("a1111", "a", {"a"}, "a", "")
+        cache.put("a1111", "b", {"b"}, "b", "")
+        cache.get("a1111", "a")
+        cache.put("a1111", "c", {"c"}, "c", "")
+
+        self.assertIsNone(cache.get("a1111", "b"))
+        self.assertEqual(cache.get("a1111", "a"), ({"a"}, "a", ""))
+        self.assertIsNone(cache.get("comfyui", "a"))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        tags, _, _ = cache.get("a1111", "c")
+        tags.add("changed")
+        self.assertEqual(cache.get("a1111", "c")[0], {"c"})
+
+    def test_shares_entries_on_disk(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "tags.db")
+            cache = tag_cache.TagCache(path=path, salt=b"v1")
+            cache.put("a1111", "1girl", {"1girl", "prompt_type:a1111"}, "1girl", None)
+            cache.close()
+
+            cache = tag_cache.TagCache(path=path, salt=b"v1")
+            self.assertEqual(cache.get("a1111", "1girl"), ({"1girl", "prompt_type:a1111"}, "1girl", None))
+            cache.close()
+
+            cache = tag_cache.TagCache(path=path, salt=b"v2")
+            self.assertIsNone(cache.get("a1111", "1girl"))
+            cache.close()
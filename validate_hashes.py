@@ -1,44 +1,90 @@
 #!/usr/bin/env python
 
 import glob
-import sys
 import safetensors
 import json
 import mmap
 import pprint
 import os.path
 
+import argparse
+
 import safetensors_hack
+import hash_cache
+
+parser = argparse.ArgumentParser()
+parser.add_argument("model_dir")
+parser.add_argument("--hash-cache", default=hash_cache.DEFAULT_PATH, help="SQLite file to keep computed hashes in")
+parser.add_argument("--verify", action="store_true", help="Hash every file again instead of using the cached hashes")
+parser.add_argument("--jobs", "-j", type=int, help="Hash this many files at once, printing a JSON line for each as it finishes")
+parser.add_argument("--reads-per-device", type=int, default=2, help="With --jobs, how many files to read at once from the same disk")
+args = parser.parse_args()
 
-model_dir = sys.argv[1]
+model_dir = args.model_dir
 if not model_dir:
     print("Provide a model path.")
     exit(1)
 
+cache = hash_cache.HashCache(args.hash_cache)
+
 total = 0
 with_hash = 0
 mismatches = 0
 
-for filename in glob.iglob(f"{model_dir}/**/*.safetensors", recursive=True):
-    metadata = safetensors_hack.read_metadata(filename)
-    if "sshs_model_hash" in metadata and "sshs_legacy_hash" in metadata:
-        precalc_hash = metadata["sshs_model_hash"]
-        precalc_legacy_hash = metadata["sshs_legacy_hash"]
-        hash = safetensors_hack.hash_file(filename)
-        legacy_hash = safetensors_hack.legacy_hash_file(filename)
-
-        mismatch = False
-        if precalc_hash != hash:
-            print(f"HASH MISMATCH - {filename} ({precalc_hash} != {hash})")
-            mismatch = True
-        if precalc_legacy_hash != legacy_hash:
-            print(f"LEGACY HASH MISMATCH - {filename} ({precalc_legacy_hash} != {legacy_hash})")
-            mismatch = True
+if args.jobs:
+    embedded = {}
+    for filename in glob.iglob(f"{model_dir}/**/*.safetensors", recursive=True):
+        metadata = safetensors_hack.read_metadata(filename)
+        if "sshs_model_hash" in metadata and "sshs_legacy_hash" in metadata:
+            embedded[filename] = metadata
+        total += 1
+
+    for filename, hashes, speed in safetensors_hack.hash_files(embedded, cache, args.verify, args.jobs, args.reads_per_device):
+        precalc_hash = embedded[filename]["sshs_model_hash"]
+        precalc_legacy_hash = embedded[filename]["sshs_legacy_hash"]
+        mismatch = precalc_hash != hashes["model_hash"] or precalc_legacy_hash != hashes["legacy_hash"]
+        print(json.dumps({
+            "file": filename,
+            "precalc_model_hash": precalc_hash,
+            "precalc_legacy_hash": precalc_legacy_hash,
+            "model_hash": hashes["model_hash"],
+            "legacy_hash": hashes["legacy_hash"],
+            "mismatch": mismatch,
+            "mb_per_second": speed,
+        }), flush=True)
 
         with_hash += 1
         if mismatch:
             mismatches += 1
+else:
+    for filename in glob.iglob(f"{model_dir}/**/*.safetensors", recursive=True):
+        metadata = safetensors_hack.read_metadata(filename)
+        if "sshs_model_hash" in metadata and "sshs_legacy_hash" in metadata:
+            precalc_hash = metadata["sshs_model_hash"]
+            precalc_legacy_hash = metadata["sshs_legacy_hash"]
+            hashes, speed = safetensors_hack.get_hashes(filename, cache, args.verify)
+            if speed is not None:
+                print(f"Hashed {filename} ({speed:.1f} MB/s)")
+            hash = hashes["model_hash"]
+            legacy_hash = hashes["legacy_hash"]
+
+            mismatch = False
+            if precalc_hash != hash:
+                print(f"HASH MISMATCH - {filename} ({precalc_hash} != {hash})")
+                mismatch = True
+            if precalc_legacy_hash != legacy_hash:
+                print(f"LEGACY HASH MISMATCH - {filename} ({precalc_legacy_hash} != {legacy_hash})")
+                mismatch = True
+
+            with_hash += 1
+            if mismatch:
+                mismatches += 1
+
+        total += 1
 
-    total += 1
+cache.close()
 
-print(f"Validated: {total} total, {with_hash} with embedded hash, {mismatches} mismatches")
+if args.jobs:
+    print(json.dumps({"total": total, "with_hash": with_hash, "mismatches": mismatches}))
+else:
+    print(f"Validated: {total} total, {with_hash} with embedded hash, {mismatches} mismatches")